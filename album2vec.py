@@ -0,0 +1,354 @@
+from datetime import datetime
+from multiprocessing import get_context, shared_memory
+import os
+import sys
+import time
+
+import numpy as np
+
+from corpus import Corpus
+from embeddings import Embeddings
+
+
+class SharedArray:
+    """ NumPy array in shared memory, worker processes attach to it by name and write to it without locks. """
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def __getstate__(self):
+        return {"shape": self.shape, "dtype": self.dtype.str, "name": self.shm.name}
+
+    def __setstate__(self, state):
+        self.__init__(state["shape"], state["dtype"], state["name"])
+
+    def close(self):
+        del self.array
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class Album2Vec:
+    """ Skip-gram with negative sampling (word2vec) on album collections: every user's collection is a sentence
+    of album ids, albums that are often in the same collections get similar vectors.
+
+    Collections have no order, so every epoch the albums of a collection are shuffled and the window runs over
+    the shuffled collection. Training is vectorized with NumPy, batch_size (center, context) pairs are updated at
+    once. workers processes train on their own part of the corpus at the same time, all updating the same vectors
+    in shared memory without locks (Hogwild). The learning rate decays linearly with the progress of all workers.
+
+    Albums in fewer than min_count collections get no vector. Very popular albums are subsampled: an album with
+    frequency f is kept with probability sqrt(sample / f) + sample / f. Negatives are drawn from the unigram
+    distribution raised to 0.75, using a table of table_size album indices.
+    """
+    def __init__(self, dim=100, window=5, negative=5, epochs=5, min_count=2, sample=1e-3, learning_rate=0.025,
+                 min_learning_rate=0.0001, batch_size=1024, table_size=10 ** 7, workers=None, seed=1,
+                 report_every=10):
+        self.dim = dim
+        self.window = window
+        self.negative = negative
+        self.epochs = epochs
+        self.min_count = min_count
+        self.sample = sample
+        self.learning_rate = learning_rate
+        self.min_learning_rate = min_learning_rate
+        self.batch_size = batch_size
+        self.table_size = table_size
+        self.workers = workers or os.cpu_count()
+        self.seed = seed
+        self.report_every = report_every
+
+    def settings(self):
+        return {name: getattr(self, name) for name in ["dim", "window", "negative", "epochs", "min_count", "sample",
+                                                       "learning_rate", "min_learning_rate", "batch_size"]}
+
+    def vocabulary(self, counts):
+        """ Album ids with at least min_count collections, sorted. """
+        return np.flatnonzero(counts >= self.min_count)
+
+    def negative_table(self, counts):
+        """ table_size album indices, every album appears in proportion to its count ** 0.75. """
+        weights = counts.astype(np.float64) ** 0.75
+        bounds = np.round(np.cumsum(weights) / weights.sum() * self.table_size).astype(np.int64)
+        return np.repeat(np.arange(len(counts), dtype=np.int32), np.diff(bounds, prepend=0))
+
+    def keep_probabilities(self, counts):
+        """ Probability that an album is kept when its collection is trained on. """
+        if not self.sample:
+            return np.ones(len(counts))
+        frequency = counts / counts.sum()
+        ratio = self.sample / frequency
+        return np.minimum(np.sqrt(ratio) + ratio, 1.0)
+
+    def train(self, corpus):
+        """ Trains vectors for the albums in corpus (a Corpus or the directory of one), returns Embeddings. """
+        if not isinstance(corpus, Corpus):
+            corpus = Corpus(corpus)
+
+        album_counts = corpus.album_counts()
+        album_ids = self.vocabulary(album_counts)
+        if not len(album_ids):
+            raise ValueError(f"No albums in at least {self.min_count} collections")
+
+        # word2vec initialization: small random input vectors, zero output vectors
+        rng = np.random.RandomState(self.seed)
+        vectors = (rng.random_sample((len(album_ids), self.dim)) - 0.5) / self.dim
+        context_vectors = np.zeros((len(album_ids), self.dim))
+
+        return self.fit(corpus, album_ids, album_counts[album_ids], vectors, context_vectors,
+                        np.arange(len(corpus)), self.epochs, self.learning_rate, {"method": "album2vec"})
+
+    def update(self, previous, corpus, epochs=None, learning_rate=None):
+        """ Updates the previous album2vec Embeddings with what was added to corpus since they were trained,
+        instead of training everything again. Returns new Embeddings.
+
+        The collections added since (the corpus is append-only, so everything after previous' corpus_sentences) are
+        trained on, together with the older collections that contain an album that gets a vector now but didn't
+        have one before. All other collections are left out. The vectors of known albums start from the previous
+        ones, new albums start from a random vector. Counts for subsampling and negatives are from the full corpus.
+        learning_rate defaults to half of self.learning_rate, to keep the known vectors close to where they were.
+        """
+        if not isinstance(corpus, Corpus):
+            corpus = Corpus(corpus)
+        if not isinstance(previous, Embeddings):
+            previous = Embeddings.load(previous)
+        if previous.context_vectors is None or previous.dim != self.dim:
+            raise ValueError(f"Can only update {self.dim} dimensional album2vec embeddings")
+        trained_sentences = previous.meta["corpus_sentences"]
+        if trained_sentences > len(corpus):
+            raise ValueError(f"Embeddings were trained on {trained_sentences:,} collections, but the corpus only "
+                             f"has {len(corpus):,}, it is not the same corpus")
+
+        album_counts = corpus.album_counts()
+        new_album_ids = np.setdiff1d(self.vocabulary(album_counts), previous.album_ids)
+        album_ids = np.concatenate([previous.album_ids, new_album_ids])
+
+        rng = np.random.RandomState(self.seed)
+        vectors = np.concatenate([previous.vectors, (rng.random_sample((len(new_album_ids), self.dim)) - 0.5) / self.dim])
+        context_vectors = np.concatenate([previous.context_vectors, np.zeros((len(new_album_ids), self.dim))])
+
+        sentences = np.concatenate([self.sentences_with(corpus, new_album_ids, trained_sentences),
+                                    np.arange(trained_sentences, len(corpus))])
+        print(f"[{datetime.now()}] Updating with {len(corpus) - trained_sentences:,} new collections, "
+              f"{len(sentences) - len(corpus) + trained_sentences:,} older collections with "
+              f"{len(new_album_ids):,} new albums")
+
+        return self.fit(corpus, album_ids, album_counts[album_ids], vectors, context_vectors, sentences,
+                        epochs or self.epochs, learning_rate or self.learning_rate / 2,
+                        {"method": "album2vec", "new_albums": len(new_album_ids), "updated_sentences": len(sentences),
+                         "updated_from": {name: previous.meta.get(name) for name in ["trained_at", "corpus_sentences",
+                                                                                     "corpus_max_user_id"]}})
+
+    @staticmethod
+    def sentences_with(corpus, album_ids, sentences, chunk_size=10_000_000):
+        """ Indices of the first `sentences` collections of corpus that contain any of album_ids. Scans the
+        memory mapped tokens in chunks. """
+        end = int(corpus.offsets[sentences]) if sentences else 0
+        if not len(album_ids) or not end:
+            return np.zeros(0, dtype=np.int64)
+        wanted = np.zeros(corpus.meta["max_album_id"] + 1, dtype=bool)
+        wanted[album_ids] = True
+
+        found = []
+        for start in range(0, end, chunk_size):
+            positions = start + np.flatnonzero(wanted[corpus.tokens[start:min(start + chunk_size, end)]])
+            found.append(np.searchsorted(corpus.offsets, positions, side="right") - 1)
+        return np.unique(np.concatenate(found))
+
+    def fit(self, corpus, album_ids, counts, vectors, context_vectors, sentences, epochs, learning_rate, meta):
+        """ Trains the given starting vectors on the collections in sentences, returns Embeddings. """
+        shared_vectors = SharedArray(vectors.shape, np.float32)
+        shared_vectors.array[:] = vectors
+        shared_context_vectors = SharedArray(context_vectors.shape, np.float32)
+        shared_context_vectors.array[:] = context_vectors
+        table = SharedArray((self.table_size,), np.int32)
+        table.array[:] = self.negative_table(counts)
+
+        try:
+            pairs = self.run_workers(corpus, album_ids, counts, shared_vectors, shared_context_vectors, table,
+                                     sentences, epochs, learning_rate)
+            return Embeddings(album_ids, shared_vectors.array.copy(), dict(
+                self.settings(),
+                **meta,
+                epochs=epochs,
+                learning_rate=learning_rate,
+                trained_at=datetime.now().isoformat(timespec="seconds"),
+                corpus_sentences=len(corpus),
+                corpus_max_user_id=corpus.max_user_id,
+                pairs=pairs,
+            ), context_vectors=shared_context_vectors.array.copy())
+        finally:
+            for shared in [shared_vectors, shared_context_vectors, table]:
+                shared.close()
+
+    def run_workers(self, corpus, album_ids, counts, vectors, context_vectors, table, sentences, epochs,
+                    learning_rate):
+        """ Trains with self.workers processes, prints pairs/sec while they run. Returns the amount of pairs. """
+        # Dense index of every album id in the corpus, -1 for albums without a vector
+        index_of = np.full(corpus.meta["max_album_id"] + 1, -1, dtype=np.int32)
+        index_of[album_ids] = np.arange(len(album_ids), dtype=np.int32)
+        keep = self.keep_probabilities(counts).astype(np.float32)
+
+        # Split the collections over the workers so every worker gets about the same amount of albums
+        albums = np.cumsum(corpus.offsets[sentences + 1] - corpus.offsets[sentences])
+        total_albums = int(albums[-1]) * epochs if len(albums) else 0
+        bounds = np.searchsorted(albums, np.linspace(0, albums[-1] if len(albums) else 0, self.workers + 1))
+        bounds[0], bounds[-1] = 0, len(sentences)
+
+        # Every worker writes its own progress (albums done, pairs trained) here, read for the learning rate and
+        # the throughput report
+        progress = SharedArray((self.workers, 2), np.int64)
+        progress.array[:] = 0
+
+        # Spawn works on every platform, the workers attach to the shared arrays and memory map the corpus
+        context = get_context("spawn")
+        processes = [context.Process(target=train_worker, args=(
+            self, corpus.directory, sentences[bounds[i]:bounds[i + 1]], epochs, learning_rate, total_albums,
+            index_of, keep, vectors, context_vectors, table, progress, i
+        )) for i in range(self.workers)]
+        started = time.monotonic()
+        last_report, last_pairs = started, 0
+        try:
+            for process in processes:
+                process.start()
+            while any(process.is_alive() for process in processes):
+                for process in processes:
+                    process.join(timeout=self.report_every / len(processes))
+                now = time.monotonic()
+                if now - last_report >= self.report_every:
+                    pairs = int(progress.array[:, 1].sum())
+                    done = progress.array[:, 0].sum() / max(total_albums, 1)
+                    print(f"[{datetime.now()}] {done:.1%} trained, {(pairs - last_pairs) / (now - last_report):,.0f} "
+                          f"pairs/sec")
+                    last_report, last_pairs = now, pairs
+
+            failed = [process.exitcode for process in processes if process.exitcode != 0]
+            if failed:
+                raise RuntimeError(f"{len(failed)} training workers failed, exit codes {failed}")
+
+            pairs = int(progress.array[:, 1].sum())
+            elapsed = time.monotonic() - started
+            print(f"[{datetime.now()}] Trained {pairs:,} pairs in {elapsed:.1f}s, {pairs / elapsed:,.0f} pairs/sec")
+            return pairs
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            progress.close()
+
+    def sentence_pairs(self, rng, tokens, sentence_ids):
+        """ (center, context) index pairs of a block of collections. tokens are the vector indices of the kept
+        albums, sentence_ids the collection each belongs to, sorted. Albums are shuffled within their collection,
+        and every center uses a random window of 1 to self.window albums on both sides, like word2vec. """
+        order = np.lexsort((rng.random_sample(len(tokens)), sentence_ids))
+        tokens = tokens[order]
+        windows = rng.randint(1, self.window + 1, size=len(tokens))
+
+        centers, contexts = [], []
+        for distance in range(1, self.window + 1):
+            same_sentence = sentence_ids[:-distance] == sentence_ids[distance:]
+            # Context to the right of the center
+            mask = same_sentence & (windows[:-distance] >= distance)
+            centers.append(tokens[:-distance][mask])
+            contexts.append(tokens[distance:][mask])
+            # Context to the left of the center
+            mask = same_sentence & (windows[distance:] >= distance)
+            centers.append(tokens[distance:][mask])
+            contexts.append(tokens[:-distance][mask])
+
+        centers, contexts = np.concatenate(centers), np.concatenate(contexts)
+        order = rng.permutation(len(centers))
+        return centers[order], contexts[order]
+
+    def train_batch(self, rng, centers, contexts, vectors, context_vectors, table, learning_rate):
+        """ One SGD step of skip-gram with negative sampling for a batch of pairs. """
+        negatives = table[rng.randint(0, len(table), size=(len(centers), self.negative))]
+        targets = np.concatenate([contexts[:, None], negatives], axis=1)
+        labels = np.zeros(targets.shape, dtype=np.float32)
+        labels[:, 0] = 1
+
+        center_vectors = vectors[centers]
+        target_vectors = context_vectors[targets]
+        scores = np.einsum("bd,bkd->bk", center_vectors, target_vectors)
+        # (label - sigmoid(score)) * learning rate, the gradient of the log likelihood
+        gradients = (labels - 1 / (1 + np.exp(-np.clip(scores, -6, 6)))) * learning_rate
+        # Negatives that drew the context itself are skipped like in word2vec, otherwise popular albums, which are
+        # drawn most often, are pushed away from the contexts they are trained towards
+        gradients[:, 1:][negatives == contexts[:, None]] = 0
+
+        scatter_add(vectors, centers, np.einsum("bk,bkd->bd", gradients, target_vectors))
+        scatter_add(context_vectors, targets.ravel(), (gradients[:, :, None] * center_vectors[:, None, :])
+                    .reshape(-1, self.dim))
+
+
+def scatter_add(array, rows, updates):
+    """ array[rows] += updates, adding up the updates of rows that occur more than once. Same as np.add.at, but
+    sums the duplicates with one sort and np.add.reduceat, which is many times faster. """
+    order = np.argsort(rows, kind="stable")
+    rows = rows[order]
+    starts = np.flatnonzero(np.concatenate([[True], rows[1:] != rows[:-1]]))
+    array[rows[starts]] += np.add.reduceat(updates[order], starts, axis=0)
+
+
+def train_worker(model, corpus_directory, sentences, epochs, learning_rate, total_albums, index_of, keep, vectors,
+                 context_vectors, table, progress, worker, block_albums=100_000):
+    """ Trains on the collections in sentences for epochs epochs, in blocks of about block_albums albums. The
+    learning rate decays from learning_rate as all workers together get through total_albums. Runs in a worker
+    process. """
+    corpus = Corpus(corpus_directory)
+    rng = np.random.RandomState(model.seed + worker + 1)
+    starts = corpus.offsets[sentences]
+    lengths = corpus.offsets[sentences + 1] - starts
+
+    # Blocks of collections, trained in a different order every epoch
+    block_bounds = np.unique(np.concatenate([
+        [0], np.searchsorted(np.cumsum(lengths), np.arange(block_albums, lengths.sum(), block_albums)), [len(sentences)]
+    ]))
+    blocks = list(zip(block_bounds[:-1], block_bounds[1:]))
+
+    for _ in range(epochs):
+        for block in rng.permutation(len(blocks)):
+            first, last = blocks[block]
+            # Gather the albums of the block's collections, which don't have to be next to each other in the corpus
+            block_lengths = lengths[first:last]
+            positions = np.repeat(starts[first:last] - np.cumsum(block_lengths) + block_lengths, block_lengths) + \
+                np.arange(block_lengths.sum())
+            album_ids = np.asarray(corpus.tokens[positions])
+            sentence_ids = np.repeat(np.arange(first, last), block_lengths)
+
+            # Drop albums without a vector and subsample popular albums
+            tokens = index_of[album_ids]
+            kept = tokens >= 0
+            kept[kept] = rng.random_sample(kept.sum()) < keep[tokens[kept]]
+            centers, contexts = model.sentence_pairs(rng, tokens[kept], sentence_ids[kept])
+
+            for i in range(0, len(centers), model.batch_size):
+                done = progress.array[:, 0].sum() / max(total_albums, 1)
+                rate = max(learning_rate * (1 - done), model.min_learning_rate)
+                model.train_batch(rng, centers[i:i + model.batch_size], contexts[i:i + model.batch_size],
+                                  vectors.array, context_vectors.array, table.array, rate)
+                progress.array[worker, 1] += len(centers[i:i + model.batch_size])
+
+            progress.array[worker, 0] += len(album_ids)
+
+    for shared in [vectors, context_vectors, table, progress]:
+        shared.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [3, 4]:
+        print("Usage: python album2vec.py <corpus directory> <embeddings.npz> [previous embeddings.npz]")
+        sys.exit(1)
+
+    if len(sys.argv) == 4:
+        # Only train on what was added to the corpus since the previous embeddings
+        embeddings = Album2Vec().update(sys.argv[3], sys.argv[1])
+    else:
+        embeddings = Album2Vec().train(sys.argv[1])
+    embeddings.save(sys.argv[2])
+    print(f"Saved {len(embeddings):,} album vectors to {sys.argv[2]}")
@@ -1,36 +1,553 @@
+import time
 import traceback
 import sqlite3
 
-from queries import CREATE_TABLE_ALBUM, CREATE_TABLE_ALBUM_METADATA,\
-                    CREATE_TABLE_ARTIST, CREATE_TABLE_LOGS, CREATE_TABLE_USER,\
-                    CREATE_TABLE_USER_SUPPORTS
+import numpy as np
+
+from queries import ADD_LOGS_FETCHED_AT_QUERY, ADD_LOGS_FINGERPRINT_QUERY, ADD_LOGS_LEASE_EXPIRES_QUERY,\
+                    ADD_LOGS_LEASE_OWNER_QUERY, ADD_LOGS_PRIORITY_QUERY, ADD_LOGS_REFRESH_AT_QUERY,\
+                    ADD_LOGS_REFRESH_INTERVAL_QUERY, ALBUMS_BY_YEAR_COUNT_QUERY, ALBUMS_BY_YEAR_QUERY,\
+                    ALBUM_DETAILS_QUERY, ALBUM_METADATA_TAGS_QUERY, ALBUM_SUPPORTERS_QUERY,\
+                    CLAIMABLE_URLS_BY_PRIORITY_QUERY, CLAIMABLE_URLS_QUERY, COPY_USER_SUPPORTS_QUERY,\
+                    CREATE_INDEX_ALBUM_METADATA_ARTIST, CREATE_INDEX_ALBUM_METADATA_YEAR, CREATE_INDEX_ALBUM_TAG_ALBUM,\
+                    CREATE_INDEX_LOGS_LEASES, CREATE_INDEX_LOGS_PENDING, CREATE_INDEX_LOGS_PRIORITY,\
+                    CREATE_INDEX_LOGS_REFRESH, CREATE_INDEX_USER_SUPPORTS_ALBUM, CREATE_TABLE_ALBUM,\
+                    CREATE_TABLE_ALBUM_METADATA, CREATE_TABLE_ALBUM_TAG, CREATE_TABLE_ARTIST, CREATE_TABLE_LOGS,\
+                    CREATE_TABLE_SCHEMA_VERSION, CREATE_TABLE_TAG, CREATE_TABLE_USER, CREATE_TABLE_USER_SUPPORTS,\
+                    DROP_INDEX_LOGS_PENDING, DROP_USER_SUPPORTS_QUERY, IDS_BY_URL_QUERY, INSERT_ALBUM_QUERY,\
+                    INSERT_ALBUM_TAG_QUERY, INSERT_ARTIST_QUERY, INSERT_TAG_QUERY, INSERT_USER_QUERY,\
+                    INSERT_USER_SUPPORTS_QUERY, LEASE_URL_QUERY, LOGS_URLS_AFTER_ID_QUERY, OTHER_LEASES_QUERY,\
+                    PENDING_URLS_COUNT_QUERY, REFRESH_DUE_QUERY, RELEASE_LEASES_QUERY, RENAME_LOGS_SCRAPED_QUERY,\
+                    RENAME_USER_SUPPORTS_QUERY, RENEW_LEASES_QUERY, SCHEDULE_USER_REFRESHES_QUERY, SCHEMA_SQL_QUERY,\
+                    SCHEMA_VERSION_QUERY, SET_LOGS_FINGERPRINT_QUERY, SET_SCHEMA_VERSION_QUERY, TABLE_COUNT_QUERY,\
+                    TABLE_EXISTS_QUERY, TABLE_MAX_ROWID_QUERY, TAGGED_ALBUMS_COUNT_QUERY, TAGGED_ALBUMS_IN_YEARS_QUERY,\
+                    TAGGED_ALBUMS_QUERY, TAG_IDS_BY_NAME_QUERY, URL_SCRAPED_QUERY, USER_COLLECTION_URLS_QUERY,\
+                    USER_SUPPORTS_AFTER_USER_QUERY, YEAR_ALBUMS_WITH_TAG_QUERY
+from metrics import METRICS
+from urls import canonicalize, fingerprint, stored_fingerprint
+from utils import LRUCache, OutdatedSchemaError
+
+
+# Tables with an (id, url) pair that are cached in BandcampDB.id_cache
+ID_TABLES = ("album", "artist", "user")
+
+# Amount of prepared statements the connection keeps around. All queries in queries.py are constant strings with
+# ? placeholders, so after the first call sqlite reuses the compiled statement instead of parsing and planning again
+STATEMENT_CACHE_SIZE = 256
+
+# Rows fetched from sqlite at a time by iter_select and iter_batches
+SELECT_BATCH_SIZE = 1000
+
+# Tables reported by BandcampDB.stats
+STATS_TABLES = ("album", "album_metadata", "artist", "user", "user_supports", "tag", "album_tag", "logs")
+# Tables without a rowid, those are always counted
+WITHOUT_ROWID_TABLES = ("user_supports", "album_tag")
+
+# Stay below SQLITE_MAX_VARIABLE_NUMBER of older sqlite versions (999) when using IN (?, ?, ...)
+MAX_QUERY_PARAMETERS = 900
+
+# Seconds a connection waits for the write lock when another crawl process holds it, before giving up
+BUSY_TIMEOUT = 60
+
+# Set on every connection. WAL lets readers (corpus exports, training) work while the scraper writes, and
+# with synchronous = NORMAL a commit doesn't wait for the disk: a power loss can lose the last commits, but never
+# corrupts the database. cache_size is in KiB when negative
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64_000,
+    "mmap_size": 2 ** 30,
+    "temp_store": "MEMORY",
+}
+
+# Indexes every database has, created with IF NOT EXISTS so they can be run again
+INDEXES = [CREATE_INDEX_USER_SUPPORTS_ALBUM, CREATE_INDEX_LOGS_PENDING, CREATE_INDEX_LOGS_PRIORITY,
+           CREATE_INDEX_LOGS_REFRESH, CREATE_INDEX_LOGS_LEASES, CREATE_INDEX_ALBUM_METADATA_ARTIST,
+           CREATE_INDEX_ALBUM_METADATA_YEAR, CREATE_INDEX_ALBUM_TAG_ALBUM]
+
+
+def normalize_tag(tag):
+    """ Lowercase and single spaced, so "Dream Pop" and "dream  pop" are the same tag. """
+    return " ".join(tag.lower().split())
+
+
+def split_tags(tags):
+    """ The normalized tags in an album_metadata.tags string, which AlbumPage joins with ', '. """
+    return list(dict.fromkeys(tag for tag in map(normalize_tag, (tags or "").split(",")) if tag))
+
+
+def backfill_album_tags(conn):
+    """ Migration step that fills the tag and album_tag tables from the tags column of album_metadata. Reads
+    album_metadata in batches, so memory use only depends on the amount of distinct tags. """
+    tag_ids = {}
+    rows = conn.execute(ALBUM_METADATA_TAGS_QUERY)
+    while True:
+        batch = rows.fetchmany(10 * SELECT_BATCH_SIZE)
+        if not batch:
+            return
+        links = []
+        for album_id, tags in batch:
+            for tag in split_tags(tags):
+                if tag not in tag_ids:
+                    conn.execute(INSERT_TAG_QUERY, (tag,))
+                    tag_ids[tag] = conn.execute(TAG_IDS_BY_NAME_QUERY.format(placeholders="?"), (tag,)).fetchone()[0]
+                links.append((tag_ids[tag], album_id))
+        conn.executemany(INSERT_ALBUM_TAG_QUERY, links)
+
+
+def backfill_logs_fingerprints(conn):
+    """ Migration step that fills logs.fingerprint with the fingerprint of the canonical form of every url, in
+    batches of rows by id. """
+    last_id = 0
+    while True:
+        batch = conn.execute(LOGS_URLS_AFTER_ID_QUERY, (last_id, 10 * SELECT_BATCH_SIZE)).fetchall()
+        if not batch:
+            return
+        conn.executemany(SET_LOGS_FINGERPRINT_QUERY,
+                         [(stored_fingerprint(fingerprint(canonicalize(url))), log_id) for log_id, url in batch])
+        last_id = batch[-1][0]
+
+
+# Schema changes in order, MIGRATIONS[i] upgrades a database from version i + 1 to i + 2. Databases from before
+# schema_version existed are version 1
+MIGRATIONS = [
+    # user_supports without rowid
+    [CREATE_TABLE_USER_SUPPORTS.format(table="user_supports_new"), COPY_USER_SUPPORTS_QUERY, DROP_USER_SUPPORTS_QUERY,
+     RENAME_USER_SUPPORTS_QUERY, CREATE_INDEX_USER_SUPPORTS_ALBUM, CREATE_INDEX_ALBUM_METADATA_ARTIST],
+    # logs.scraped becomes a pending/done/leased state with a lease owner and expiry, scraped urls keep state 1
+    [RENAME_LOGS_SCRAPED_QUERY, ADD_LOGS_LEASE_OWNER_QUERY, ADD_LOGS_LEASE_EXPIRES_QUERY, DROP_INDEX_LOGS_PENDING,
+     CREATE_INDEX_LOGS_PENDING, CREATE_INDEX_LOGS_LEASES],
+    # logs.priority for the yield scheduler
+    [ADD_LOGS_PRIORITY_QUERY, CREATE_INDEX_LOGS_PRIORITY],
+    # When pages were scraped and when user pages are refreshed
+    [ADD_LOGS_FETCHED_AT_QUERY, ADD_LOGS_REFRESH_INTERVAL_QUERY, ADD_LOGS_REFRESH_AT_QUERY, CREATE_INDEX_LOGS_REFRESH,
+     SCHEDULE_USER_REFRESHES_QUERY],
+    # Tags in their own table, linked to albums, filled from album_metadata.tags. Functions are run with the connection
+    [CREATE_TABLE_TAG, CREATE_TABLE_ALBUM_TAG, CREATE_INDEX_ALBUM_TAG_ALBUM, CREATE_INDEX_ALBUM_METADATA_YEAR,
+     backfill_album_tags],
+    # Fingerprints of the canonical urls in logs, so the frontier loads them without hashing every url
+    [ADD_LOGS_FINGERPRINT_QUERY, backfill_logs_fingerprints],
+]
+SCHEMA_VERSION = len(MIGRATIONS) + 1
+
+# Queries the crawl and exports run all the time, with example parameters and the index sqlite should use for them
+HOT_QUERIES = [
+    ("claimable urls", CLAIMABLE_URLS_QUERY, (0, 1000), "logs_pending"),
+    ("claimable urls by priority", CLAIMABLE_URLS_BY_PRIORITY_QUERY, (0, 1000), "logs_priority"),
+    ("refresh due", REFRESH_DUE_QUERY, (0, 100), "logs_refresh"),
+    ("user collection urls", USER_COLLECTION_URLS_QUERY, ("https://bandcamp.com/fan",), "PRIMARY KEY"),
+    ("release leases", RELEASE_LEASES_QUERY, ("owner",), "logs_leases"),
+    ("other leases", OTHER_LEASES_QUERY, ("owner", 0), "logs_leases"),
+    ("pending url count", PENDING_URLS_COUNT_QUERY, (), "logs_pending"),
+    ("url scraped", URL_SCRAPED_QUERY, ("https://bandcamp.com/fan",), "sqlite_autoindex_logs_1"),
+    ("album ids by url", IDS_BY_URL_QUERY.format(table="album", placeholders="?, ?"), ("a", "b"),
+     "sqlite_autoindex_album_1"),
+    ("album supporters", ALBUM_SUPPORTERS_QUERY, (1,), "COVERING INDEX user_supports_album"),
+    ("tag ids by name", TAG_IDS_BY_NAME_QUERY.format(placeholders="?, ?"), ("a", "b"), "sqlite_autoindex_tag_1"),
+    ("tagged albums", TAGGED_ALBUMS_QUERY, (1,), "PRIMARY KEY"),
+    ("albums by year", ALBUMS_BY_YEAR_QUERY, (2000, 2010), "COVERING INDEX album_metadata_year"),
+    ("tagged albums in years", TAGGED_ALBUMS_IN_YEARS_QUERY, (1, 2000, 2010), "PRIMARY KEY"),
+    ("year albums with tag", YEAR_ALBUMS_WITH_TAG_QUERY, (1, 2000, 2010), "COVERING INDEX album_metadata_year"),
+    ("collections after user", USER_SUPPORTS_AFTER_USER_QUERY, (0,), "PRIMARY KEY"),
+]
+
+
+def is_locked(error):
+    """ Whether error is sqlite giving up on a lock another connection held for longer than BUSY_TIMEOUT. """
+    return isinstance(error, sqlite3.OperationalError) and "locked" in str(error)
 
 
 class BandcampDB:
-    def __init__(self, db_name, create_new_db=False):
+    """ Connection to the sqlite database with the scraped data.
+
+    By default every commit() is a real commit. Passing flush_every_pages and/or flush_every_seconds turns on
+    write-behind mode: commit() calls are postponed and the writes of many pages share one transaction, which is
+    committed once flush_every_pages pages are done (see page_done) or flush_every_seconds have passed since the
+    last flush, whichever comes first. The deadline is checked whenever a page is done or commit() is called, so
+    a crash loses at most the last flush_every_pages - 1 pages, or the pages done in the last
+    flush_every_seconds plus the time it takes to scrape one page. Because a page's data and its logs state
+    are in the same transaction, lost pages are simply unscraped again after a restart and get redone. All writes
+    are INSERT OR IGNORE, so redoing a page, or committing part of one through flush(), is harmless.
+
+    Several crawl processes can share one database, they claim urls with leases (see claim_urls and Frontier). A
+    write transaction holds sqlite's write lock until it is committed, so with write-behind the other processes
+    wait for every flush. Crawl processes that share a database should commit every page instead.
+    """
+    def __init__(self, db_name, create_new_db=False, id_cache_size=100_000, flush_every_pages=None,
+                 flush_every_seconds=None, allow_outdated=False):
         self.db_name = db_name
-        self.conn = sqlite3.connect(self.db_name)
+        self.conn = sqlite3.connect(self.db_name, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE)
         self.cursor = self.conn.cursor()
+        for pragma, value in PRAGMAS.items():
+            self.cursor.execute(f"PRAGMA {pragma} = {value}")
+
+        # Write-behind settings, when both are None every commit() is a real commit
+        self.flush_every_pages = flush_every_pages
+        self.flush_every_seconds = flush_every_seconds
+        self.pages_since_flush = 0
+        self.last_flush = time.monotonic()
+
+        # Url to id mapping per table, saves a select for every album/artist/user we have seen recently
+        self.id_cache = {table: LRUCache(id_cache_size) for table in ID_TABLES}
+        # Same for tag names
+        self.tag_id_cache = LRUCache(id_cache_size)
+
+        # Amount of statements sent to sqlite, an executemany counts as one
+        self.query_count = 0
 
         if create_new_db:
             self.create_tables()
+        elif self.schema_version() < SCHEMA_VERSION and not allow_outdated:
+            # Queries of newer versions would fail halfway through a crawl on missing tables and columns
+            version = self.schema_version()
+            self.conn.close()
+            raise OutdatedSchemaError(f"Database '{db_name}' has schema version {version}, the latest is "
+                                      f"{SCHEMA_VERSION}. Run 'python main.py migrate {db_name}' to upgrade it")
+
+    def execute(self, query, params=()):
+        """ Wrapper for executing query, values are passed separately in params and bound to the ? placeholders. """
+        self.query_count += 1
+        try:
+            return self.cursor.execute(query, params)
+        except (sqlite3.OperationalError, sqlite3.IntegrityError) as e:
+            self.raise_if_locked(e)
+            print(traceback.format_exc())
+            print(query)
 
-    def execute(self, query):
-        """ Wrapper for executing query. """
+    def executemany(self, query, rows):
+        """ Wrapper for executing a parameterized query once for every row of parameters. """
+        self.query_count += 1
         try:
-            return self.cursor.execute(query)
-        except (sqlite3.OperationalError, sqlite3.IntegrityError):
+            return self.cursor.executemany(query, rows)
+        except (sqlite3.OperationalError, sqlite3.IntegrityError) as e:
+            self.raise_if_locked(e)
             print(traceback.format_exc())
             print(query)
 
-    def select(self, query):
-        """ Returns result of select query as JSON. """
-        result = self.execute(query)
-        column_names = [tup[0] for tup in result.description]
-        return [dict(zip(column_names, row)) for row in result.fetchall()]
+    def raise_if_locked(self, error):
+        """ Raises error if another connection held the lock for longer than BUSY_TIMEOUT, e.g. another crawl process
+        sharing the database, so the page that is being written fails instead of being half written. The write that
+        failed was the first of its transaction, a connection that wrote already holds the write lock, so nothing is
+        lost by rolling back. That has to be done, the transaction's snapshot would make every later write fail. """
+        if is_locked(error):
+            self.conn.rollback()
+            raise error
+
+    def select(self, query, params=()):
+        """ Returns result of select query as JSON. Loads every row at once, use iter_select for large results. """
+        return [dict(row) for row in self.iter_select(query, params, row_factory=sqlite3.Row)]
+
+    def iter_batches(self, query, params=(), batch_size=SELECT_BATCH_SIZE, row_factory=None):
+        """ Runs a select query on its own cursor and yields the rows in lists of at most batch_size, so a result
+        of any size is read in constant memory. Rows are tuples, or sqlite3.Row with row_factory=sqlite3.Row. The
+        own cursor means other queries can run between two batches. """
+        self.query_count += 1
+        cursor = self.conn.cursor()
+        cursor.row_factory = row_factory
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            cursor.close()
+
+    def iter_select(self, query, params=(), batch_size=SELECT_BATCH_SIZE, row_factory=None):
+        """ Yields the rows of a select query one by one, fetched batch_size at a time. See iter_batches. """
+        for rows in self.iter_batches(query, params, batch_size, row_factory):
+            yield from rows
+
+    def select_value(self, query, params=()):
+        """ First column of the first row of a select query, None if there are no rows. """
+        row = self.execute(query, params).fetchone()
+        return row[0] if row is not None else None
+
+    def stats(self, estimate=False):
+        """ Amount of rows per table, counted by sqlite with COUNT(*) (using the smallest index) instead of loading
+        the rows. With estimate=True the tables with an id use their highest rowid instead, a single lookup. Rows are
+        never deleted, but INSERT OR IGNORE of a known url still uses up an id, so that is an upper bound.
+        user_supports and album_tag have no rowid and are always counted. """
+        stats = {}
+        for table in STATS_TABLES:
+            if not estimate or table in WITHOUT_ROWID_TABLES:
+                stats[table] = self.select_value(TABLE_COUNT_QUERY.format(table=table))
+            else:
+                stats[table] = self.select_value(TABLE_MAX_ROWID_QUERY.format(table=table))
+        stats["pending urls"] = self.select_value(PENDING_URLS_COUNT_QUERY)
+        return stats
+
+    def resolve_ids(self, table, urls):
+        """ Returns {url: id} for urls in table, urls that are not in the table are left out. Uses one select
+        for every MAX_QUERY_PARAMETERS urls that are not in the id cache. """
+        cache = self.id_cache[table]
+        ids = {}
+        missing = []
+        for url in dict.fromkeys(urls):
+            cached_id = cache.get(url)
+            if cached_id is None:
+                missing.append(url)
+            else:
+                ids[url] = cached_id
+
+        for i in range(0, len(missing), MAX_QUERY_PARAMETERS):
+            chunk = missing[i:i + MAX_QUERY_PARAMETERS]
+            query = IDS_BY_URL_QUERY.format(table=table, placeholders=", ".join("?" * len(chunk)))
+            for row_id, url in self.execute(query, chunk).fetchall():
+                cache[url] = row_id
+                ids[url] = row_id
+
+        return ids
+
+    def album_ids(self, album_urls):
+        """ Returns {url: id} for all album urls, urls that are not in the album table yet are inserted first.
+        Albums in the id cache cost no queries, the rest costs one executemany and one select per chunk. """
+        cache = self.id_cache["album"]
+        missing = [url for url in dict.fromkeys(album_urls) if url not in cache]
+        if missing:
+            self.executemany(INSERT_ALBUM_QUERY, [(url,) for url in missing])
+        return self.resolve_ids("album", album_urls)
+
+    def artist_id(self, artist_name, artist_url):
+        """ Returns the id of an artist, inserting the artist if it is not in the artist table yet. """
+        return self._get_or_insert_id("artist", INSERT_ARTIST_QUERY, (artist_name, artist_url), artist_url)
+
+    def user_id(self, username, user_url):
+        """ Returns the id of a user, inserting the user if it is not in the user table yet. """
+        return self._get_or_insert_id("user", INSERT_USER_QUERY, (username, user_url), user_url)
+
+    def _get_or_insert_id(self, table, insert_query, params, url):
+        cached_id = self.id_cache[table].get(url)
+        if cached_id is not None:
+            return cached_id
+
+        # INSERT OR IGNORE only changes a row if the url is new, in that case lastrowid is the new id and we
+        # don't need the select
+        cursor = self.execute(insert_query, params)
+        if cursor.rowcount == 1:
+            self.id_cache[table][url] = cursor.lastrowid
+            return cursor.lastrowid
+        return self.resolve_ids(table, [url])[url]
+
+    def insert_user_supports(self, user_id, album_ids):
+        """ Links a user to all albums in album_ids in a single executemany. """
+        self.executemany(INSERT_USER_SUPPORTS_QUERY, [(user_id, album_id) for album_id in album_ids])
+
+    def user_collection_urls(self, user_url):
+        """ Album urls in the collection of the user with user_url, empty if the user isn't in the database. """
+        return {url for url, in self.iter_select(USER_COLLECTION_URLS_QUERY, (user_url,))}
+
+    def tag_ids(self, tags, insert=False):
+        """ Returns {normalized tag: id} for tags, with insert=True tags that are not in the tag table yet are
+        inserted first, otherwise they are left out. """
+        names = list(dict.fromkeys(map(normalize_tag, tags)))
+        ids = {}
+        missing = []
+        for name in names:
+            cached_id = self.tag_id_cache.get(name)
+            if cached_id is None:
+                missing.append(name)
+            else:
+                ids[name] = cached_id
+
+        if missing and insert:
+            self.executemany(INSERT_TAG_QUERY, [(name,) for name in missing])
+        for i in range(0, len(missing), MAX_QUERY_PARAMETERS):
+            chunk = missing[i:i + MAX_QUERY_PARAMETERS]
+            query = TAG_IDS_BY_NAME_QUERY.format(placeholders=", ".join("?" * len(chunk)))
+            for tag_id, name in self.execute(query, chunk).fetchall():
+                self.tag_id_cache[name] = tag_id
+                ids[name] = tag_id
+        return ids
+
+    def set_album_tags(self, album_id, tags):
+        """ Links an album to the tags in an album_metadata.tags string. """
+        tag_ids = self.tag_ids(split_tags(tags), insert=True)
+        if tag_ids:
+            self.executemany(INSERT_ALBUM_TAG_QUERY, [(tag_id, album_id) for tag_id in tag_ids.values()])
+
+    def tagged_album_ids(self, all_of=(), any_of=(), years=None):
+        """ Ids of the albums that have every tag in all_of and at least one of the tags in any_of, released in
+        years (first, last) if given, as a sorted numpy array. E.g. shoegaze albums from 2020:
+
+            database.tagged_album_ids(all_of=["shoegaze"], years=(2020, 2020))
+
+        Every tag is one range of the album_tag table, the ranges are combined with numpy, so a filter costs a
+        lookup per tag instead of a scan of album_metadata. The years are applied in sqlite together with the first
+        tag of all_of, or every tag of any_of, see tagged_albums. Tags are normalized, an unknown tag matches
+        nothing. """
+        if not all_of and not any_of and years is None:
+            raise ValueError("Filter on at least one tag or the years")
+
+        tag_ids = self.tag_ids(list(all_of) + list(any_of))
+        albums = None
+        if all_of:
+            for i, tag in enumerate(map(normalize_tag, all_of)):
+                tagged = self.tagged_albums(tag_ids.get(tag), years if i == 0 else None)
+                albums = tagged if albums is None else np.intersect1d(albums, tagged, assume_unique=True)
+        if any_of:
+            tagged = np.unique(np.concatenate([self.tagged_albums(tag_ids.get(tag), None if all_of else years)
+                                               for tag in map(normalize_tag, any_of)]))
+            albums = tagged if albums is None else np.intersect1d(albums, tagged, assume_unique=True)
+        if albums is None:
+            albums = self.id_array(ALBUMS_BY_YEAR_QUERY, years)
+        return albums
+
+    def tagged_albums(self, tag_id, years=None):
+        """ Sorted ids of the albums with tag_id, released in years (first, last) if given. With years the query
+        starts from whichever of the two has fewer albums. Both are counted first, but only until it is clear which
+        one has fewer, so the counting reads a few times the albums of the smaller one from the indexes. """
+        if tag_id is None:
+            return np.zeros(0, dtype=np.int64)
+        if years is None:
+            return self.id_array(TAGGED_ALBUMS_QUERY, (tag_id,))
+
+        # Counted up to a limit that grows until one of them is below it
+        limit = 1024
+        while True:
+            tagged = self.select_value(TAGGED_ALBUMS_COUNT_QUERY, (tag_id, limit))
+            released = self.select_value(ALBUMS_BY_YEAR_COUNT_QUERY, (*years, limit))
+            if tagged < limit or released < limit:
+                break
+            limit *= 8
+        query = YEAR_ALBUMS_WITH_TAG_QUERY if released < tagged else TAGGED_ALBUMS_IN_YEARS_QUERY
+        return self.id_array(query, (tag_id, *years))
+
+    def id_array(self, query, params=()):
+        """ Sorted numpy int64 array of the ids a group_concat query returns. """
+        ids = self.select_value(query, params)
+        if not ids:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.array(ids.split(","), dtype=np.int64))
+
+    def album_details(self, album_ids):
+        """ Returns {album id: dict with url, name, year, tags, artist_name and artist_url} for the album ids in
+        the album table. Metadata fields are None for albums whose page wasn't scraped yet. """
+        album_ids = list(dict.fromkeys(int(album_id) for album_id in album_ids))
+        details = {}
+        for i in range(0, len(album_ids), MAX_QUERY_PARAMETERS):
+            chunk = album_ids[i:i + MAX_QUERY_PARAMETERS]
+            query = ALBUM_DETAILS_QUERY.format(placeholders=", ".join("?" * len(chunk)))
+            for album_id, url, name, year, tags, artist_name, artist_url in self.execute(query, chunk).fetchall():
+                details[album_id] = {"url": url, "name": name, "year": year, "tags": tags,
+                                     "artist_name": artist_name, "artist_url": artist_url}
+        return details
+
+    def album_supporters(self, album_id):
+        """ Ids of the users that have album_id in their collection. """
+        return [user_id for user_id, in self.iter_select(ALBUM_SUPPORTERS_QUERY, (album_id,))]
+
+    def claim_urls(self, owner, amount, lease_seconds, exploration=1.0):
+        """ Leases up to amount urls that are pending, or whose lease expired, to owner for lease_seconds and returns
+        them. An exploration share of them are the oldest urls in logs order, the others the ones with the highest
+        priority, so the default is plain logs order. The claim is its own transaction, pending writes are committed
+        first. BEGIN IMMEDIATE takes the write lock before the urls are read, so two processes can never claim the
+        same url. """
+        now = time.time()
+        # Plain read first, so processes with nothing to claim don't queue up for the write lock
+        if self.select_value(CLAIMABLE_URLS_QUERY, (now, 1)) is None:
+            return []
+
+        self.flush()
+        self.query_count += 2
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = []
+            by_priority = round(amount * (1 - exploration))
+            if by_priority > 0:
+                rows = self.conn.execute(CLAIMABLE_URLS_BY_PRIORITY_QUERY, (now, by_priority)).fetchall()
+                self.query_count += 1
+            if len(rows) == by_priority < amount:
+                # Oldest urls not claimed by priority already
+                claimed = {row_id for row_id, _, _ in rows}
+                oldest = self.conn.execute(CLAIMABLE_URLS_QUERY, (now, amount)).fetchall()
+                self.query_count += 1
+                rows += [row for row in oldest if row[0] not in claimed][:amount - len(rows)]
+            self.conn.executemany(LEASE_URL_QUERY, [(owner, now + lease_seconds, row_id) for row_id, _, _ in rows])
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+        # Leased urls that are claimed again were leased by a process that stopped renewing, probably crashed
+        METRICS.count("leases_claimed_total", len(rows))
+        METRICS.count("leases_reclaimed_total", sum(state == 2 for _, _, state in rows))
+        return [url for _, url, _ in rows]
+
+    def renew_leases(self, owner, lease_seconds):
+        """ Extends all leases of owner to lease_seconds from now. Commits, so other processes see it right away. """
+        self.execute(RENEW_LEASES_QUERY, (time.time() + lease_seconds, owner))
+        self.flush()
+
+    def release_leases(self, owner):
+        """ Makes the urls leased by owner pending again, e.g. when a crawl stops before they were scraped. """
+        self.execute(RELEASE_LEASES_QUERY, (owner,))
+        self.flush()
+
+    def schema_version(self):
+        if not self.select_value(TABLE_EXISTS_QUERY, ("schema_version",)):
+            return 1
+        return self.select_value(SCHEMA_VERSION_QUERY)
+
+    def migrate(self):
+        """ Upgrades the database in place to the latest schema. Every migration runs in its own transaction, so
+        an interrupted migration leaves the database at the last completed version. Returns the amount of
+        migrations that ran. """
+        self.flush()
+        start_version = self.schema_version()
+        for version in range(start_version, SCHEMA_VERSION):
+            started = time.monotonic()
+            print(f"Migrating '{self.db_name}' from schema version {version} to {version + 1}")
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if version == 1:
+                    self.conn.execute(CREATE_TABLE_SCHEMA_VERSION)
+                for step in MIGRATIONS[version - 1]:
+                    if callable(step):
+                        step(self.conn)
+                    else:
+                        self.conn.execute(step)
+                self.conn.execute(SET_SCHEMA_VERSION_QUERY, (version + 1,))
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+            print(f"Migrated to schema version {version + 1} in {time.monotonic() - started:.1f}s")
+
+        # Move the migration out of the write ahead log into the database file, and refresh the planner statistics
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.conn.execute("PRAGMA analysis_limit = 1000")
+        self.conn.execute("ANALYZE")
+        self.conn.commit()
+        return SCHEMA_VERSION - start_version
+
+    def explain(self, query, params=()):
+        """ Query plan of query, one line per step. """
+        return [row[-1] for row in self.conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()]
+
+    def check_query_plans(self):
+        """ Checks that the hot queries use the index they are meant to, instead of scanning a table. Returns
+        {query name: plan} for the queries that don't, so an empty dict means everything is fine.
+
+        The plans are made on an empty in-memory copy of the schema, without the ANALYZE statistics of this
+        database. With statistics of a small database sqlite rightly scans tables of a few pages, which says nothing
+        about the plans once the tables are large. Without statistics it plans for large tables. """
+        schema = sqlite3.connect(":memory:")
+        for sql, in self.conn.execute(SCHEMA_SQL_QUERY).fetchall():
+            schema.execute(sql)
+
+        problems = {}
+        for name, query, params, index in HOT_QUERIES:
+            plan = [row[-1] for row in schema.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()]
+            if not any(index in step for step in plan):
+                problems[name] = plan
+        schema.close()
+        return problems
 
     def create_tables(self):
-        """ Creates album, artist, user, and user_supports tables. """
+        """ Creates album, artist, user, user_supports, tag and album_tag tables, their indexes, and the schema
+        version. """
         # Initialize album table
         self.execute(CREATE_TABLE_ALBUM)
 
@@ -47,15 +564,53 @@ class BandcampDB:
         self.execute(CREATE_TABLE_USER)
 
         # Initialize user_supports table
-        self.execute(CREATE_TABLE_USER_SUPPORTS)
+        self.execute(CREATE_TABLE_USER_SUPPORTS.format(table="user_supports"))
 
-    def commit(self):
-        """ Wrapper around conn.commit. """
+        # Tags and which albums have them
+        self.execute(CREATE_TABLE_TAG)
+        self.execute(CREATE_TABLE_ALBUM_TAG)
+
+        for query in INDEXES:
+            self.execute(query)
+
+        self.execute(CREATE_TABLE_SCHEMA_VERSION)
+        self.execute(SET_SCHEMA_VERSION_QUERY, (SCHEMA_VERSION,))
         self.conn.commit()
 
+    @property
+    def write_behind(self):
+        return self.flush_every_pages is not None or self.flush_every_seconds is not None
+
+    def commit(self):
+        """ Wrapper around conn.commit. In write-behind mode this only commits when a flush is due. """
+        if self.write_behind:
+            self.flush_if_due()
+        else:
+            with METRICS.timer("stage_seconds", stage="db_commit"):
+                self.conn.commit()
+
+    def page_done(self):
+        """ Marks the end of all writes for one scraped page, including its logs update. """
+        self.pages_since_flush += 1
+        self.commit()
+
+    def flush_if_due(self):
+        """ Commits if flush_every_pages pages are done or flush_every_seconds passed since the last flush. """
+        if self.flush_every_pages is not None and self.pages_since_flush >= self.flush_every_pages:
+            self.flush()
+        elif self.flush_every_seconds is not None and time.monotonic() - self.last_flush >= self.flush_every_seconds:
+            self.flush()
+
+    def flush(self):
+        """ Commits all pending writes, regardless of write-behind mode. """
+        with METRICS.timer("stage_seconds", stage="db_commit"):
+            self.conn.commit()
+        self.pages_since_flush = 0
+        self.last_flush = time.monotonic()
+
     def commit_and_close(self):
         """ Commits all updates to table and closes connection. """
-        self.conn.commit()
+        self.flush()
         self.conn.close()
 
 
@@ -80,35 +635,26 @@ if __name__ == "__main__":
     user_count = 5000
 
     # Dummy artist data
-    for _ in tqdm(range(artist_count), desc="Generating artist data"):
-        db.execute(f"INSERT INTO artist ('name', 'url') VALUES ('{random_string(10)}', 'http://{random_string(5)}.bandcamp.com')")
+    db.executemany(
+        "INSERT INTO artist (name, url) VALUES (?, ?)",
+        [(random_string(10), f"http://{random_string(5)}.bandcamp.com") for _ in tqdm(range(artist_count), desc="Generating artist data")]
+    )
 
     # Dummy album data
-    for _ in tqdm(range(album_count), desc="Generating album data"):
-        db.execute(f"""
-            INSERT INTO album
-            ('name', 'url', 'artist_id', 'year', 'tags')
-            VALUES
-            ('{random_string(5)}', 'http://{random_string(5)}.bandcamp.com', {random.choice([i for i in range(1, 1 + artist_count)])}, {random.choice([i for i in range(2015, 2023)])}, '{random_string(20)}')
-        """)
+    db.executemany(
+        "INSERT INTO album (url) VALUES (?)",
+        [(f"http://{random_string(5)}.bandcamp.com/album/{random_string(8)}",) for _ in tqdm(range(album_count), desc="Generating album data")]
+    )
 
     # Dummy user data
-    for user_id in tqdm(range(user_count), desc="Generating user data"):
-        db.execute(f"""
-            INSERT INTO user
-            ('name', 'url')
-            VALUES
-            ('{random_string(5)}_{random_string(7)}', 'http://{random_string(5)}.bandcamp.com')
-        """)
+    for user_id in tqdm(range(1, user_count + 1), desc="Generating user data"):
+        db.execute(
+            "INSERT INTO user (name, url) VALUES (?, ?)",
+            (f"{random_string(5)}_{random_string(7)}", f"http://bandcamp.com/{random_string(8)}")
+        )
 
         # Randomly choose albums user supports
-        for supports in range(random.choice([i for i in range(1, 10)])):
-            db.execute(f"""
-                INSERT INTO user_supports
-                ('user_id', 'album_id')
-                VALUES
-                ({user_id}, {random.choice([i for i in range(1, album_count + 1)])})
-            """)
+        db.insert_user_supports(user_id, random.sample(range(1, album_count + 1), random.randint(1, 9)))
 
     print(db.select("SELECT * FROM artist where id = (SELECT MAX(id) FROM artist)"))
     
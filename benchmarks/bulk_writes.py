@@ -0,0 +1,75 @@
+""" Compares the per-album write path UserPage.write_to_database used to have with the bulk write API of
+BandcampDB. Reports statements and wall time per collection for a cold id cache (all albums new) and a warm
+one (all albums seen before).
+
+Run from the repository root: python -m benchmarks.bulk_writes
+"""
+import os
+import random
+import string
+import tempfile
+import time
+
+from bandcamp_db import BandcampDB
+
+
+COLLECTION_SIZES = [20, 200, 2000]
+
+# Old str.format queries, kept here so the benchmark can replay the old write path
+OLD_INSERT_USER_QUERY = "INSERT OR IGNORE INTO user (name, url) VALUES ('{username}', '{user_url}')"
+OLD_USER_ID_QUERY = "SELECT id FROM user WHERE url = '{user_url}'"
+OLD_INSERT_ALBUM_QUERY = "INSERT OR IGNORE INTO album (url) VALUES ('{album_url}')"
+OLD_ALBUM_ID_QUERY = "SELECT id FROM album WHERE url = '{album_url}'"
+OLD_INSERT_USER_SUPPORTS_QUERY = "INSERT OR IGNORE INTO user_supports (user_id, album_id) VALUES ({user_id}, {album_id})"
+
+
+def random_string(n):
+    return ''.join(random.choice(string.ascii_lowercase) for _ in range(n))
+
+
+def random_collection(size):
+    return [f"https://{random_string(8)}.bandcamp.com/album/{random_string(10)}" for _ in range(size)]
+
+
+def write_user_old(database, username, user_url, collection):
+    database.execute(OLD_INSERT_USER_QUERY.format(username=username, user_url=user_url))
+    user_id = database.select(OLD_USER_ID_QUERY.format(user_url=user_url))[0]["id"]
+    for album_url in collection:
+        database.execute(OLD_INSERT_ALBUM_QUERY.format(album_url=album_url))
+        album_id = database.select(OLD_ALBUM_ID_QUERY.format(album_url=album_url))[0]["id"]
+        database.execute(OLD_INSERT_USER_SUPPORTS_QUERY.format(user_id=user_id, album_id=album_id))
+    database.commit()
+
+
+def write_user_bulk(database, username, user_url, collection):
+    user_id = database.user_id(username, user_url)
+    album_ids = database.album_ids(collection)
+    database.insert_user_supports(user_id, album_ids.values())
+    database.commit()
+
+
+def measure(write_function, database, collection):
+    """ Writes a new user with collection, returns (statements, seconds). """
+    username = random_string(10)
+    queries_before = database.query_count
+    start = time.perf_counter()
+    write_function(database, username, f"https://bandcamp.com/{username}", collection)
+    return database.query_count - queries_before, time.perf_counter() - start
+
+
+def run():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f"{'size':>6} {'path':>5} {'cache':>5} {'statements':>11} {'ms':>9}")
+        for size in COLLECTION_SIZES:
+            for name, write_function in [("old", write_user_old), ("bulk", write_user_bulk)]:
+                database = BandcampDB(os.path.join(tmp_dir, f"{name}_{size}.db"), create_new_db=True)
+                collection = random_collection(size)
+                # First user sees only new albums, second user has the same collection so all albums are known
+                for cache in ["cold", "warm"]:
+                    statements, seconds = measure(write_function, database, collection)
+                    print(f"{size:>6} {name:>5} {cache:>5} {statements:>11,} {seconds * 1000:>9.2f}")
+                database.commit_and_close()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,200 @@
+""" End to end crawl benchmark against the generated stand-in site of benchmarks.site, without network access.
+Every scenario crawls the site into a new database, in one or several crawl processes, and reports pages/sec,
+database queries per page, user-album links per page, peak memory (max RSS of the largest process) and the time
+spent in the page parse() methods. Most scenarios crawl the whole site, the budget ones stop after a part of it to
+compare how many links the crawl schedulers gather in the same amount of pages. Crawls run in their own processes, so
+peak memory and import state of one scenario doesn't leak into the next.
+
+Results are printed and written as json, together with the git revision, so runs of different commits can be
+compared:
+
+    python -m benchmarks.crawl [results.json]
+"""
+from contextlib import redirect_stdout
+from datetime import datetime
+import json
+from multiprocessing import get_context
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.site import SiteGraph, start_site
+from queries import INSERT_LOGS_QUERY
+from scheduler import SCHEDULERS, CrawlBudget
+from urls import fingerprint, stored_fingerprint
+
+
+SITE = dict(artists=20, albums_per_artist=5, fans=150, collection_sizes=(5, 80), filler=100_000, seed=1)
+SEED_URL = SiteGraph.artist_url(0)
+
+# name: (crawl mode, latency per response in seconds, error rate, crawl processes sharing the database, scheduler,
+# pages per crawl process)
+SCENARIOS = {
+    "serial": ("serial", 0.0, 0.0, 1, "fifo", None),
+    "serial_latency": ("serial", 0.02, 0.0, 1, "fifo", None),
+    "serial_errors": ("serial", 0.02, 0.05, 1, "fifo", None),
+    "concurrent_latency": ("concurrent", 0.02, 0.0, 1, "fifo", None),
+    "pipeline_latency": ("pipeline", 0.02, 0.0, 1, "fifo", None),
+    "serial_latency_2_processes": ("serial", 0.02, 0.0, 2, "fifo", None),
+    "serial_latency_4_processes": ("serial", 0.02, 0.0, 4, "fifo", None),
+    "fifo_budget": ("serial", 0.0, 0.0, 1, "fifo", 80),
+    "yield_budget": ("serial", 0.0, 0.0, 1, "yield", 80),
+}
+WORKERS = 8
+# Urls claimed at a time when several processes share the database or the scheduler prioritizes, like
+# main.CLAIM_BATCH_SIZE
+CLAIM_BATCH_SIZE = 10
+
+
+def timed_parse(page_class, parse_seconds):
+    """ Wraps page_class.parse so its time is added to parse_seconds[page_class.__name__]. """
+    parse = page_class.parse
+
+    def wrapper(self):
+        started = time.perf_counter()
+        try:
+            return parse(self)
+        finally:
+            parse_seconds[page_class.__name__] = parse_seconds.get(page_class.__name__, 0.0) + \
+                time.perf_counter() - started
+    page_class.parse = wrapper
+
+
+def run_scenario(mode, base_url, db_name, processes, scheduler, page_budget):
+    """ Crawls the site until there are no urls left in the database, returns the measurements of this process. Runs
+    in a fresh process. """
+    from bandcamp_db import BandcampDB
+    from http_client import HttpClient
+    from pipeline import CrawlPipeline
+    from scraper import Scraper
+    from standin_server import StandInSession
+    from webpages import AlbumPage, ArtistPage, UserPage
+
+    # Parsing happens in other processes in the pipeline, it isn't measured there
+    parse_seconds = {}
+    if mode != "pipeline":
+        for page_class in [AlbumPage, ArtistPage, UserPage]:
+            timed_parse(page_class, parse_seconds)
+
+    # Processes sharing a database commit every page, like main.py does
+    if processes > 1:
+        database = BandcampDB(db_name=db_name, flush_every_pages=1)
+    else:
+        database = BandcampDB(db_name=db_name, flush_every_pages=50, flush_every_seconds=10)
+    scraper = Scraper(database=database, scheduler=SCHEDULERS[scheduler](), budget=CrawlBudget(pages=page_budget))
+    scraper.http_client = HttpClient(session=StandInSession(base_url), backoff=0.05)
+    if processes > 1 or scheduler != "fifo":
+        scraper.frontier.batch_size = CLAIM_BATCH_SIZE
+
+    started = time.perf_counter()
+    # The scraper prints a line per page, which would drown out the results
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        if mode == "serial":
+            scraper.start_scrape()
+        elif mode == "concurrent":
+            scraper.start_concurrent_scrape(workers=WORKERS, min_host_delay=0)
+        else:
+            CrawlPipeline(scraper, fetch_workers=WORKERS, min_host_delay=0).run()
+    elapsed = time.perf_counter() - started
+
+    queries = database.query_count
+    scraper.quit()
+    return {
+        "seconds": elapsed,
+        "queries": queries,
+        # ru_maxrss is in kB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "parse_seconds": sum(parse_seconds.values()) if parse_seconds else None,
+    }
+
+
+def scenario_process(connection, *args):
+    connection.send(run_scenario(*args))
+
+
+def benchmark(name):
+    from bandcamp_db import BandcampDB
+
+    mode, latency, error_rate, processes, scheduler, page_budget = SCENARIOS[name]
+    server, base_url = start_site(latency=latency, error_rate=error_rate, **SITE)
+    context = get_context("spawn")
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            db_name = os.path.join(directory, "crawl.db")
+            database = BandcampDB(db_name=db_name, create_new_db=True)
+            database.executemany(INSERT_LOGS_QUERY, [(SEED_URL, stored_fingerprint(fingerprint(SEED_URL)))])
+            database.commit()
+
+            # Not a Pool, its daemon workers can't start the parse processes of the pipeline
+            pipes = [context.Pipe(duplex=False) for _ in range(processes)]
+            workers = [context.Process(target=scenario_process,
+                                       args=(sender, mode, base_url, db_name, processes, scheduler, page_budget))
+                       for _, sender in pipes]
+            for worker in workers:
+                worker.start()
+            results = [receiver.recv() for receiver, _ in pipes]
+            for worker in workers:
+                worker.join()
+
+            pages = database.select_value("SELECT COUNT(*) FROM logs WHERE state = 1")
+            stats = database.stats()
+            database.commit_and_close()
+    finally:
+        server.terminate()
+        server.join()
+
+    seconds = max(result["seconds"] for result in results)
+    parse_seconds = [result["parse_seconds"] for result in results if result["parse_seconds"] is not None]
+    return {
+        "pages": pages,
+        "seconds": round(seconds, 3),
+        "pages_per_second": round(pages / seconds, 2),
+        "queries_per_page": round(sum(result["queries"] for result in results) / max(pages, 1), 2),
+        "links_per_page": round(stats["user_supports"] / max(pages, 1), 2),
+        "peak_rss_mb": round(max(result["peak_rss_mb"] for result in results), 1),
+        "parse_ms_per_page": round(1000 * sum(parse_seconds) / max(pages, 1), 2) if parse_seconds else None,
+        "albums": stats["album"],
+        "users": stats["user"],
+        "user_supports": stats["user_supports"],
+        "mode": mode,
+        "latency": latency,
+        "error_rate": error_rate,
+        "processes": processes,
+        "scheduler": scheduler,
+        "page_budget": page_budget,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "crawl_benchmark.json"
+
+    results = {}
+    for name in SCENARIOS:
+        results[name] = benchmark(name)
+        result = results[name]
+        parse = f"{result['parse_ms_per_page']:.2f}" if result["parse_ms_per_page"] is not None else "-"
+        print(f"{name:28s} {result['pages']:5,} pages  {result['pages_per_second']:7.2f} pages/sec  "
+              f"{result['queries_per_page']:6.2f} queries/page  {result['links_per_page']:6.2f} links/page  "
+              f"{result['peak_rss_mb']:7.1f} MB peak  "
+              f"{parse:>6s} ms parse/page")
+
+    with open(path, "w") as f:
+        json.dump({
+            "revision": git_revision(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "site": SITE,
+            "results": results,
+        }, f, indent=2)
+    print(f"Wrote results to {path}")
@@ -0,0 +1,37 @@
+""" album2vec against PPMI/SVD on the same generated corpus as benchmarks.incremental: time, the share of
+nearest neighbours of the same genre, and how much the two agree on neighbours.
+
+Run from the repository root: python -m benchmarks.embedding_methods
+"""
+import os
+import random
+import tempfile
+import time
+
+from album2vec import Album2Vec
+from bandcamp_db import BandcampDB
+from benchmarks.incremental import ALBUMS_PER_GENRE, EPOCHS, GENRES, USERS, WORKERS, add_users, genre_precision
+from corpus import export_corpus
+from ppmi import PPMISVD
+from similarity import neighbour_overlap
+
+
+def run(directory):
+    database = BandcampDB(os.path.join(directory, "benchmark.db"), create_new_db=True)
+    database.executemany("INSERT INTO album (url) VALUES (?)",
+                         [(f"https://artist.bandcamp.com/album/{i}",) for i in range(GENRES * ALBUMS_PER_GENRE)])
+    add_users(database, USERS, range(GENRES), random.Random(1))
+    corpus = export_corpus(database, os.path.join(directory, "corpus"))
+    database.commit_and_close()
+
+    results = {}
+    for name, method in [("album2vec", Album2Vec(epochs=EPOCHS, workers=WORKERS)), ("ppmi", PPMISVD())]:
+        start = time.perf_counter()
+        results[name] = method.train(corpus)
+        print(f"{name:>10}  {time.perf_counter() - start:7.1f}s  same-genre@10 {genre_precision(results[name]):.3f}")
+    print(f"neighbour overlap@10 {neighbour_overlap(results['album2vec'], results['ppmi']):.3f}")
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        run(directory)
@@ -0,0 +1,86 @@
+""" Incremental album2vec updates compared with a full retrain. Generates a crawl of users that each collect
+albums of mostly one genre, trains on the first part of the users, adds the rest and then both updates the
+snapshot and trains again from scratch. Reports the time of both, and their quality: the share of nearest
+neighbours that are of the same genre, and the neighbour overlap of the update with the full retrain. The overlap
+of two full retrains with a different seed is the best an update can be expected to get.
+
+Run from the repository root: python -m benchmarks.incremental
+"""
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from album2vec import Album2Vec
+from bandcamp_db import BandcampDB
+from corpus import export_corpus
+from similarity import ExactIndex, neighbour_overlap
+
+
+GENRES = 20
+ALBUMS_PER_GENRE = 100
+USERS = 3000
+# Share of the users that is crawled after the first snapshot, the new part also brings new albums
+NEW_USERS = 0.2
+EPOCHS = 3
+WORKERS = 2
+
+
+def add_users(database, users, genres, rng):
+    for _ in range(users):
+        user_id = database.user_id("user", f"https://bandcamp.com/fan{rng.random()}")
+        genre, other = rng.choice(genres), rng.randrange(GENRES)
+        albums = rng.sample(range(genre * ALBUMS_PER_GENRE + 1, (genre + 1) * ALBUMS_PER_GENRE + 1), rng.randint(5, 40))
+        albums += rng.sample(range(other * ALBUMS_PER_GENRE + 1, (other + 1) * ALBUMS_PER_GENRE + 1), rng.randint(0, 3))
+        database.insert_user_supports(user_id, set(albums))
+    database.commit()
+
+
+def genre_precision(embeddings, k=10):
+    """ Share of the k nearest neighbours of every album that is of the same genre. """
+    rows, _ = ExactIndex(embeddings).search_vectors(embeddings.vectors, k + 1)
+    genres = (embeddings.album_ids - 1) // ALBUMS_PER_GENRE
+    return float(np.mean(genres[rows[:, 1:]] == genres[:, None]))
+
+
+def timed(train):
+    start = time.perf_counter()
+    embeddings = train()
+    return embeddings, time.perf_counter() - start
+
+
+def run(directory):
+    rng = random.Random(1)
+    database = BandcampDB(os.path.join(directory, "benchmark.db"), create_new_db=True)
+    database.executemany("INSERT INTO album (url) VALUES (?)",
+                         [(f"https://artist.bandcamp.com/album/{i}",) for i in range(GENRES * ALBUMS_PER_GENRE)])
+    corpus_directory = os.path.join(directory, "corpus")
+
+    # The last genres only show up in the new users, so the update has to add albums
+    old_users = int(USERS * (1 - NEW_USERS))
+    add_users(database, old_users, range(GENRES - 2), rng)
+    export_corpus(database, corpus_directory)
+    snapshot = Album2Vec(epochs=EPOCHS, workers=WORKERS).train(corpus_directory)
+
+    add_users(database, USERS - old_users, range(GENRES), rng)
+    corpus = export_corpus(database, corpus_directory)
+
+    updated, update_time = timed(lambda: Album2Vec(epochs=EPOCHS, workers=WORKERS).update(snapshot, corpus))
+    full, full_time = timed(lambda: Album2Vec(epochs=EPOCHS, workers=WORKERS).train(corpus))
+    other_full = Album2Vec(epochs=EPOCHS, workers=WORKERS, seed=2).train(corpus)
+
+    print(f"{len(corpus):,} collections, {USERS - old_users:,} new, {len(full):,} albums, "
+          f"{updated.meta['new_albums']:,} new")
+    print(f"full retrain     {full_time:7.1f}s  same-genre@10 {genre_precision(full):.3f}")
+    print(f"update           {update_time:7.1f}s  same-genre@10 {genre_precision(updated):.3f}  "
+          f"({update_time / full_time:.0%} of the full retrain time)")
+    print(f"neighbour overlap@10 update vs full retrain {neighbour_overlap(updated, full):.3f}, "
+          f"full retrain vs full retrain {neighbour_overlap(other_full, full):.3f}")
+    database.commit_and_close()
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        run(directory)
@@ -0,0 +1,73 @@
+""" Generates html in the shape of bandcamp album, artist and fan pages, with the elements AlbumPage, ArtistPage
+and UserPage read. filler adds unrelated markup and script, so page sizes are closer to the real pages
+(roughly 100-300kB). """
+from html import escape
+import json
+import random
+
+
+def filler_html(size):
+    """ Unrelated markup of about size characters, like the navigation, players and scripts of a real page. """
+    blocks = []
+    length = 0
+    while length < size:
+        block = (
+            f'<div class="menubar-item"><a href="/{random.getrandbits(32)}">item</a><span class="x">'
+            f'{random.getrandbits(64)}</span></div>'
+            f'<script>var d{random.getrandbits(16)} = {{"a": [1, 2, 3], "b": "{random.getrandbits(64)}"}};</script>'
+        )
+        blocks.append(block)
+        length += len(block)
+    return "".join(blocks)
+
+
+def page(title, body, filler=0, pagedata=None):
+    blob = escape(json.dumps(pagedata or {}), quote=True)
+    return (
+        f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{escape(title)}</title></head><body>'
+        f'<div id="pagedata" data-blob="{blob}"></div>{filler_html(filler // 2)}{body}{filler_html(filler // 2)}'
+        f'</body></html>'
+    )
+
+
+def album_page_html(name, artist_name, artist_url, supporter_urls, tags, year=2021, more_button=False, filler=0):
+    supporters = "".join(f'<a class="pic" href="{escape(url)}"><img src="x.jpg"></a>' for url in supporter_urls)
+    tag_links = "".join(f'<a class="tag" href="https://bandcamp.com/tag/{escape(tag)}">{escape(tag)}</a>' for tag in tags)
+    more = '<a class="more-thumbs" href="#">more...</a>' if more_button else ""
+    body = (
+        f'<div id="name-section"><h2 class="trackTitle">\n    {escape(name)}\n</h2>'
+        f'<h3>by <span><a href="{escape(artist_url)}">{escape(artist_name)}</a></span></h3></div>'
+        f'<p id="band-name-location"><span class="title">{escape(artist_name)}</span>'
+        f'<span class="location secondaryText">Somewhere</span></p>'
+        f'<div class="tralbumData tralbum-credits">\n released March 3, {year}\n <br>credits</div>'
+        f'<div class="tralbumData tralbum-tags tralbum-tags-nu">{tag_links}</div>'
+        f'<div class="deets populated">{supporters}{more}</div>'
+    )
+    return page(f"{name} | {artist_name}", body, filler)
+
+
+def artist_page_html(artist_name, album_paths, filler=0):
+    items = "".join(
+        f'<li class="music-grid-item square"><a href="{escape(path)}"><p class="title">{escape(path)}</p></a></li>'
+        for path in album_paths
+    )
+    body = (
+        f'<p id="band-name-location"><span class="title">{escape(artist_name)}</span></p>'
+        f'<ol id="music-grid" class="music-grid">{items}</ol>'
+    )
+    return page(artist_name, body, filler)
+
+
+def fan_page_html(fan_id, username, item_urls, show_more=False, filler=0):
+    items = "".join(
+        f'<li id="collection-item-container_{i}" class="collection-item-container">'
+        f'<a class="item-link" target="_blank" href="{escape(url)}"><img src="x.jpg"></a>'
+        f'<a class="item-link also-link" href="{escape(url)}">also</a></li>'
+        for i, url in enumerate(item_urls)
+    )
+    more = '<button class="show-more">view all items</button>' if show_more else ""
+    body = (
+        f'<div class="fan-bio"><div class="name"><span>{escape(username)}</span></div></div>'
+        f'<div class="collection-items"><ol class="collection-grid">{items}</ol>{more}</div>'
+    )
+    return page(username, body, filler, pagedata={"fan_data": {"fan_id": fan_id, "name": username}})
@@ -0,0 +1,67 @@
+""" Micro-benchmark of the logs insert, comparing the old str.format queries with the parameterized
+INSERT_LOGS_QUERY. Reports inserted urls per second for:
+
+- one multi-row VALUES string per page, like Scraper.format_urls_for_insert_log_query used to build
+- one str.format statement per url, which sqlite has to parse and plan every time
+- executemany with the cached ? statement
+
+Run from the repository root: python -m benchmarks.parameterized_inserts
+"""
+import os
+import random
+import string
+import tempfile
+import time
+
+from bandcamp_db import BandcampDB
+from queries import INSERT_LOGS_QUERY
+
+
+PAGES = 200
+URLS_PER_PAGE = 100
+
+OLD_INSERT_LOGS_QUERY = "INSERT OR IGNORE INTO logs (url) VALUES {urls}"
+
+
+def random_url():
+    return f"https://{''.join(random.choice(string.ascii_lowercase) for _ in range(8))}.bandcamp.com/album/{random.getrandbits(64)}"
+
+
+def insert_values_string(database, urls):
+    database.execute(OLD_INSERT_LOGS_QUERY.format(urls=',\n'.join([f"('{url}')" for url in urls])))
+
+
+def insert_formatted_rows(database, urls):
+    for url in urls:
+        database.execute(OLD_INSERT_LOGS_QUERY.format(urls=f"('{url}')"))
+
+
+def insert_parameterized(database, urls):
+    # Without fingerprints, like the old queries, so only the way the urls are passed differs
+    database.executemany(INSERT_LOGS_QUERY, [(url, None) for url in urls])
+
+
+def run():
+    pages = [[random_url() for _ in range(URLS_PER_PAGE)] for _ in range(PAGES)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, insert in [("values string", insert_values_string), ("formatted rows", insert_formatted_rows),
+                             ("parameterized", insert_parameterized)]:
+            database = BandcampDB(os.path.join(tmp_dir, f"{name}.db"), create_new_db=True)
+            start = time.perf_counter()
+            for urls in pages:
+                insert(database, urls)
+            database.commit()
+            seconds = time.perf_counter() - start
+            print(f"{name:>15}: {PAGES * URLS_PER_PAGE / seconds:>12,.0f} urls/sec")
+            database.commit_and_close()
+
+        # A single quote in one url used to break the insert of the whole page
+        database = BandcampDB(os.path.join(tmp_dir, "quotes.db"), create_new_db=True)
+        insert_parameterized(database, ["https://bandcamp.com/o'neil", random_url()])
+        print(f"Urls with quotes stored: {database.select('SELECT COUNT(*) AS count FROM logs')[0]['count']} of 2")
+        database.commit_and_close()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,118 @@
+""" Compares SoupExtractor (full BeautifulSoup tree) with XPathExtractor (compiled lxml XPaths). First checks that
+both extract exactly the same fields from every page of the corpus, then reports parse + extract time and peak
+memory per page type.
+
+The corpus is the page cache of a crawl when a directory is given, otherwise generated pages are used:
+
+    python -m benchmarks.parsing [page_cache]
+"""
+from multiprocessing import get_context
+import random
+import resource
+import sys
+import time
+
+from benchmarks.pages import album_page_html, artist_page_html, fan_page_html
+from extractors import SoupExtractor, XPathExtractor
+
+
+FIELDS = {
+    "album": ["has_more_buttons", "supporters", "album_name", "artist_url", "artist_name", "credits_text", "tags"],
+    "artist": ["artist_name", "album_hrefs"],
+    "user": ["has_show_more", "collection", "username", "pagedata_blob"],
+}
+
+PAGES_PER_TYPE = 50
+
+
+def generated_corpus():
+    """ {page type: [html, ...]}, user pages include large rendered collections. """
+    def url(i):
+        return f"https://artist{i}.bandcamp.com/album/name-{i}"
+
+    return {
+        "album": [album_page_html(f"Album {i}", f"Artist {i}", f"https://artist{i}.bandcamp.com",
+                                  [f"https://bandcamp.com/fan{j}?from=fanthanks" for j in range(random.randint(0, 60))],
+                                  ["shoegaze", "dream pop", f"tag{i}"], filler=150_000) for i in range(PAGES_PER_TYPE)],
+        "artist": [artist_page_html(f"Artist {i}", [f"/album/a{j}" for j in range(random.randint(1, 40))], filler=100_000)
+                   for i in range(PAGES_PER_TYPE)],
+        "user": [fan_page_html(i, f"fan{i}", [url(j) for j in range(random.choice([20, 500, 3000]))], filler=100_000)
+                 for i in range(PAGES_PER_TYPE)],
+    }
+
+
+def page_cache_corpus(directory):
+    from page_cache import PageCache
+    from scraper import Scraper
+
+    page_cache = PageCache(directory)
+    corpus = {page_type: [] for page_type in FIELDS}
+    type_names = {"AlbumPage": "album", "ArtistPage": "artist", "UserPage": "user"}
+    for kind in ["http", "rendered"]:
+        for url in page_cache.urls(kind):
+            try:
+                page_type = type_names[Scraper.get_page_type(url).__name__]
+            except Exception:
+                continue
+            corpus[page_type].append(page_cache.get(url, kind))
+    page_cache.close()
+    return corpus
+
+
+def extract(extractor_class, page_type, html):
+    extractor = extractor_class(html)
+    fields = {}
+    for field in FIELDS[page_type]:
+        try:
+            fields[field] = getattr(extractor, field)()
+        except (AttributeError, KeyError):
+            fields[field] = "<missing>"
+    return fields
+
+
+def compare(corpus):
+    mismatches = 0
+    for page_type, pages in corpus.items():
+        for i, html in enumerate(pages):
+            soup_fields = extract(SoupExtractor, page_type, html)
+            xpath_fields = extract(XPathExtractor, page_type, html)
+            for field in FIELDS[page_type]:
+                if soup_fields[field] != xpath_fields[field]:
+                    mismatches += 1
+                    print(f"Mismatch on {page_type} page {i}, {field}: {soup_fields[field]!r} != {xpath_fields[field]!r}")
+    return mismatches
+
+
+def measure(extractor_class, page_type, pages, connection):
+    """ Runs in a fresh process, so the peak rss only includes this parser on this page type. """
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for html in pages:
+        extract(extractor_class, page_type, html)
+    seconds = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    connection.send((seconds, peak_kb))
+
+
+def run(corpus):
+    mismatches = compare(corpus)
+    print(f"{sum(len(pages) for pages in corpus.values())} pages compared, {mismatches} field mismatches\n")
+
+    context = get_context("fork")
+    print(f"{'page type':>9} {'parser':>6} {'pages':>6} {'ms/page':>9} {'peak MB':>8}")
+    for page_type, pages in corpus.items():
+        if not pages:
+            continue
+        for name, extractor_class in [("soup", SoupExtractor), ("xpath", XPathExtractor)]:
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=measure, args=(extractor_class, page_type, pages, sender))
+            process.start()
+            seconds, peak_kb = receiver.recv()
+            process.join()
+            print(f"{page_type:>9} {name:>6} {len(pages):>6} {seconds / len(pages) * 1000:>9.2f} {peak_kb / 1024:>8.1f}")
+    return mismatches
+
+
+if __name__ == "__main__":
+    corpus = page_cache_corpus(sys.argv[1]) if len(sys.argv) > 1 else generated_corpus()
+    sys.exit(1 if run(corpus) else 0)
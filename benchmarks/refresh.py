@@ -0,0 +1,89 @@
+""" Refresh crawl benchmark against the stand-in site of benchmarks.site, without network access. Crawls the whole
+site, then serves it again with new_purchases albums added to random collections and compares a refresh of all
+user pages (Scraper.refresh) with a full crawl of the changed site into a new database: time, http requests, and
+whether the refresh found every new purchase.
+
+    python -m benchmarks.refresh [new purchases]
+"""
+from contextlib import redirect_stdout
+import os
+import sys
+import tempfile
+import time
+
+from bandcamp_db import BandcampDB
+from benchmarks.crawl import SEED_URL, SITE
+from benchmarks.site import SiteGraph, start_site
+from http_client import HttpClient
+from queries import INSERT_LOGS_QUERY
+from scraper import Scraper
+from standin_server import StandInSession
+from urls import fingerprint, stored_fingerprint
+
+
+LATENCY = 0.02
+
+
+def new_database(db_name):
+    database = BandcampDB(db_name=db_name, create_new_db=True)
+    database.executemany(INSERT_LOGS_QUERY, [(SEED_URL, stored_fingerprint(fingerprint(SEED_URL)))])
+    database.commit_and_close()
+
+
+def run(db_name, site_options, refresh):
+    """ Crawls, or refreshes with refresh=True, the database against a site with site_options. Returns the
+    seconds it took, the http requests and the amount of user_supports rows afterwards. """
+    server, base_url = start_site(latency=LATENCY, **site_options)
+    try:
+        database = BandcampDB(db_name=db_name, flush_every_pages=50, flush_every_seconds=10)
+        scraper = Scraper(database=database)
+        scraper.http_client = HttpClient(session=StandInSession(base_url), backoff=0.05)
+
+        started = time.perf_counter()
+        # The scraper prints a line per page, which would drown out the results
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            if refresh:
+                scraper.refresh()
+            else:
+                scraper.start_scrape()
+        elapsed = time.perf_counter() - started
+
+        requests = scraper.http_client.counters["requests"]
+        links = database.stats()["user_supports"]
+        scraper.quit()
+    finally:
+        server.terminate()
+        server.join()
+    return elapsed, requests, links
+
+
+def expected_new_links(new_purchases):
+    before, after = SiteGraph(**SITE), SiteGraph(**SITE, new_purchases=new_purchases)
+    return sum(len(set(new)) - len(set(old)) for old, new in zip(before.collections, after.collections))
+
+
+if __name__ == "__main__":
+    new_purchases = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    changed_site = dict(SITE, new_purchases=new_purchases)
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_name = os.path.join(directory, "refresh.db")
+        new_database(db_name)
+        _, _, links_before = run(db_name, SITE, refresh=False)
+
+        # Everything is due now instead of in a week
+        database = BandcampDB(db_name=db_name)
+        database.execute("UPDATE logs SET refresh_at = 0 WHERE refresh_at IS NOT NULL")
+        database.commit_and_close()
+        refresh_seconds, refresh_requests, links_after = run(db_name, changed_site, refresh=True)
+
+        full_db_name = os.path.join(directory, "full.db")
+        new_database(full_db_name)
+        full_seconds, full_requests, full_links = run(full_db_name, changed_site, refresh=False)
+
+    print(f"refresh:    {refresh_seconds:6.2f}s  {refresh_requests:5,} requests  "
+          f"{links_after - links_before:4,} new links (expected {expected_new_links(new_purchases):,})")
+    print(f"full crawl: {full_seconds:6.2f}s  {full_requests:5,} requests  {full_links:,} links "
+          f"(refreshed database has {links_after:,})")
+    print(f"refresh costs {refresh_requests / full_requests:.0%} of the requests and "
+          f"{refresh_seconds / full_seconds:.0%} of the time of a full crawl")
@@ -0,0 +1,61 @@
+""" Recall and latency of the approximate IVFIndex against the exact ExactIndex, for a range of nprobe values.
+Recall@k is the share of the exact top k that the approximate search also returns.
+
+Uses the given embeddings file, or generated clustered vectors otherwise:
+
+    python -m benchmarks.similarity [embeddings.npz]
+"""
+import sys
+import time
+
+import numpy as np
+
+from embeddings import Embeddings
+from similarity import ExactIndex, IVFIndex
+
+
+ALBUMS = 100_000
+DIM = 100
+CLUSTERS = 500
+QUERIES = 1000
+K = 10
+NPROBES = [1, 2, 4, 8, 16, 32, 64]
+
+
+def generated_embeddings(rng):
+    """ Albums around random genre centers, roughly how trained album vectors are spread. """
+    centers = rng.standard_normal((CLUSTERS, DIM)).astype(np.float32)
+    vectors = centers[rng.randint(0, CLUSTERS, ALBUMS)] + rng.standard_normal((ALBUMS, DIM)).astype(np.float32)
+    return Embeddings(np.arange(1, ALBUMS + 1), vectors)
+
+
+def timed(search, queries):
+    """ Returns the result of search(queries) and the time per query in ms. """
+    start = time.perf_counter()
+    result = search(queries)
+    return result, (time.perf_counter() - start) / len(queries) * 1000
+
+
+def run(embeddings, rng):
+    queries = embeddings.vectors[rng.choice(len(embeddings), min(QUERIES, len(embeddings)), replace=False)]
+    queries = queries + rng.standard_normal(queries.shape).astype(np.float32) * 0.1
+    print(f"{len(embeddings):,} albums, {embeddings.dim} dimensions, {len(queries):,} queries, top {K}")
+
+    exact = ExactIndex(embeddings)
+    (exact_rows, _), exact_ms = timed(lambda q: exact.search_vectors(q, K), queries)
+    print(f"{'exact':>12}  recall 1.000  {exact_ms:8.3f} ms/query")
+
+    start = time.perf_counter()
+    index = IVFIndex(embeddings)
+    print(f"IVF index with {len(index.centroids)} lists built in {time.perf_counter() - start:.1f}s")
+    for nprobe in NPROBES:
+        if nprobe > len(index.centroids):
+            break
+        (rows, _), ms = timed(lambda q: index.search_vectors(q, K, nprobe=nprobe), queries)
+        recall = np.mean([len(set(a) & set(b)) / K for a, b in zip(rows, exact_rows)])
+        print(f"{f'nprobe {nprobe}':>12}  recall {recall:.3f}  {ms:8.3f} ms/query")
+
+
+if __name__ == "__main__":
+    rng = np.random.RandomState(1)
+    run(Embeddings.load(sys.argv[1]) if len(sys.argv) > 1 else generated_embeddings(rng), rng)
@@ -0,0 +1,179 @@
+""" Generated bandcamp stand-in for crawl benchmarks: a graph of artists, albums and fans served over http, in the
+markup of benchmarks.pages. Requests are routed here with standin_server.StandInSession, so the crawler sees the
+usual https://<artist>.bandcamp.com and https://bandcamp.com/<fan> urls.
+
+- https://artist<i>.bandcamp.com lists the artist's albums
+- https://artist<i>.bandcamp.com/album/a<j> shows up to MAX_SUPPORTERS fans that bought it
+- https://bandcamp.com/fan<k> shows the first FAN_PAGE_ITEMS items of the collection, larger collections have a
+  'view all' button and are loaded from the collection api at /api/fancollection/1/collection_items
+
+The server runs in its own process, so generating and sending pages doesn't compete with the crawler for the GIL.
+latency seconds are added to every response, and error_rate of the page responses are errors: mostly 503, which
+the http client retries, and some 404, which the scraper skips.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from multiprocessing import get_context
+import random
+import time
+from urllib.parse import urlsplit
+
+from benchmarks.pages import album_page_html, artist_page_html, fan_page_html
+from standin_server import STAND_IN_HOST
+
+
+MAX_SUPPORTERS = 60
+FAN_PAGE_ITEMS = 20
+TAGS = ["ambient", "shoegaze", "dream pop", "post-rock", "techno", "jazz", "folk", "noise", "drone", "house"]
+# Share of the injected errors that is a 404 instead of a 503
+NOT_FOUND_SHARE = 0.2
+
+
+class SiteGraph:
+    """ The generated site: which albums every artist has and which albums every fan bought. Album popularity
+    follows a power law, like on the real site a few albums are in many collections. Collections are newest
+    first, new_purchases adds that many albums to the front of random collections, for the site as it is some
+    time after a crawl of the one with the same seed and no new purchases. """
+    def __init__(self, artists=20, albums_per_artist=5, fans=150, collection_sizes=(5, 80), filler=100_000, seed=1,
+                 new_purchases=0):
+        rng = random.Random(seed)
+        self.filler = filler
+        self.artists = artists
+        self.albums_per_artist = albums_per_artist
+        self.albums = [(artist, album) for artist in range(artists) for album in range(albums_per_artist)]
+        weights = [1 / (rank + 1) for rank in range(len(self.albums))]
+        rng.shuffle(weights)
+
+        self.collections = []
+        for _ in range(fans):
+            size = min(rng.randint(*collection_sizes), len(self.albums))
+            chosen = set()
+            while len(chosen) < size:
+                chosen.update(rng.choices(range(len(self.albums)), weights, k=size - len(chosen)))
+            self.collections.append(sorted(chosen))
+
+        # Its own random generator, so the rest of the site is the same as without new purchases
+        purchase_rng = random.Random(seed + 1)
+        for _ in range(new_purchases):
+            collection = purchase_rng.choice(self.collections)
+            unowned = sorted(set(range(len(self.albums))) - set(collection))
+            if unowned:
+                collection.insert(0, purchase_rng.choice(unowned))
+
+        self.supporters = {album: [] for album in range(len(self.albums))}
+        for fan, collection in enumerate(self.collections):
+            for album in collection:
+                self.supporters[album].append(fan)
+
+    @staticmethod
+    def artist_url(artist):
+        return f"https://artist{artist}.bandcamp.com"
+
+    def album_url(self, album):
+        artist, number = self.albums[album]
+        return f"{self.artist_url(artist)}/album/a{number}"
+
+    @staticmethod
+    def fan_url(fan):
+        return f"https://bandcamp.com/fan{fan}"
+
+    def page(self, host, path):
+        """ Html of the page at host and path, None if there is no such page. """
+        if host == "bandcamp.com" and path.startswith("/fan") and path[4:].isdigit():
+            fan = int(path[4:])
+            if fan < len(self.collections):
+                items = [self.album_url(album) for album in self.collections[fan]]
+                return fan_page_html(fan, f"fan{fan}", items[:FAN_PAGE_ITEMS], show_more=len(items) > FAN_PAGE_ITEMS,
+                                     filler=self.filler)
+        elif host.startswith("artist") and host.endswith(".bandcamp.com"):
+            artist = host[len("artist"):-len(".bandcamp.com")]
+            if not artist.isdigit() or int(artist) >= self.artists:
+                return None
+            artist = int(artist)
+            if path in ("", "/"):
+                return artist_page_html(f"Artist {artist}", [f"/album/a{number}" for number in
+                                                             range(self.albums_per_artist)], filler=self.filler)
+            if path.startswith("/album/a") and path[8:].isdigit() and int(path[8:]) < self.albums_per_artist:
+                album = artist * self.albums_per_artist + int(path[8:])
+                supporters = [f"{self.fan_url(fan)}?from=fanthanks" for fan in self.supporters[album][:MAX_SUPPORTERS]]
+                return album_page_html(f"Album {album}", f"Artist {artist}", self.artist_url(artist), supporters,
+                                       TAGS[album % len(TAGS):][:3], year=2000 + album % 20, filler=self.filler)
+        return None
+
+    def collection_batch(self, fan_id, older_than_token, count):
+        """ Collection api response, the token is the position in the collection to continue from. """
+        collection = self.collections[fan_id]
+        position = int(older_than_token.split(":")[0])
+        # The first request uses the current time as token, which is past the end of any collection
+        start = position if position < len(collection) else 0
+        items = [{"item_url": self.album_url(album)} for album in collection[start:start + count]]
+        end = start + len(items)
+        return {"items": items, "more_available": end < len(collection), "last_token": f"{end}::a::"}
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    site = None
+    latency = 0.0
+    error_rate = 0.0
+    rng = random.Random(1)
+
+    def do_GET(self):
+        if self.delay_or_fail():
+            return
+        html = self.site.page(self.headers.get(STAND_IN_HOST, ""), urlsplit(self.path).path)
+        if html is None:
+            self.send_error(404)
+            return
+        self.respond(html, "text/html; charset=utf-8")
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        # No errors here, a failed collection request makes the scraper fall back to a browser
+        if self.latency:
+            time.sleep(self.latency)
+        batch = self.site.collection_batch(payload["fan_id"], payload["older_than_token"], payload["count"])
+        self.respond(json.dumps(batch), "application/json")
+
+    def delay_or_fail(self):
+        """ Waits latency seconds, then sends an injected error for error_rate of the requests. Returns True if it
+        did. """
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.send_error(404 if self.rng.random() < NOT_FOUND_SHARE else 503)
+            return True
+        return False
+
+    def respond(self, body, content_type):
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_server(connection, site_options, latency, error_rate):
+    """ Server process: generates the site and serves it until terminated. Sends the port over connection. """
+    handler = type("BoundSiteHandler", (SiteHandler,), {"site": SiteGraph(**site_options), "latency": latency,
+                                                        "error_rate": error_rate})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    connection.send(server.server_address[1])
+    server.serve_forever()
+
+
+def start_site(latency=0.0, error_rate=0.0, **site_options):
+    """ Starts a site server process, returns the process and the base url to pass to StandInSession. Stop it with
+    process.terminate(). """
+    context = get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_server, args=(sender, site_options, latency, error_rate), daemon=True)
+    process.start()
+    if not receiver.poll(60):
+        process.terminate()
+        raise RuntimeError("Stand-in site didn't start")
+    return process, f"http://127.0.0.1:{receiver.recv()}"
@@ -0,0 +1,96 @@
+""" Compares tag filters on the album_tag table (BandcampDB.tagged_album_ids) with the LIKE scan of
+album_metadata.tags they used to need, on a generated database. Also times the backfill migration step that fills
+album_tag from album_metadata.tags.
+
+Run from the repository root: python -m benchmarks.tags [amount of albums]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from bandcamp_db import BandcampDB, backfill_album_tags
+
+
+TAG_COUNT = 2000
+TAGS_PER_ALBUM = (2, 10)
+YEARS = (1990, 2024)
+REPEATS = 5
+
+# name: (all_of, any_of, years)
+FILTERS = {
+    "common tag": (["tag 0"], [], None),
+    "rare tag": (["tag 1500"], [], None),
+    "two tags AND": (["tag 0", "tag 3"], [], None),
+    "three tags OR": ([], ["tag 10", "tag 20", "tag 30"], None),
+    "tag and year": (["tag 1"], [], (2020, 2020)),
+    "rare tag years": (["tag 1500"], [], (1990, 2024)),
+    "OR and decade": ([], ["tag 10", "tag 20"], (2000, 2009)),
+}
+
+
+def fill(database, albums, seed=1):
+    """ Writes album_metadata rows with tags drawn from a power law, like on bandcamp a few tags are on many
+    albums. """
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(TAG_COUNT)]
+    rows = []
+    for album_id in range(1, albums + 1):
+        tags = sorted(set(rng.choices(range(TAG_COUNT), weights, k=rng.randint(*TAGS_PER_ALBUM))))
+        rows.append((album_id, 1, f"album {album_id}", rng.randint(*YEARS), ", ".join(f"tag {tag}" for tag in tags)))
+    database.executemany("INSERT INTO album_metadata (id, artist_id, name, year, tags) VALUES (?, ?, ?, ?, ?)", rows)
+    database.commit()
+
+
+def like_scan(database, all_of, any_of, years):
+    """ The filter as a scan of album_metadata. Tags are matched with their separators, a plain '%tag%' would
+    also match tags that contain the tag, like 'pop' in 'dream pop'. """
+    conditions, params = [], []
+    for tag in all_of:
+        conditions.append("(', ' || tags || ',') LIKE ?")
+        params.append(f"%, {tag},%")
+    if any_of:
+        conditions.append("(" + " OR ".join("(', ' || tags || ',') LIKE ?" for _ in any_of) + ")")
+        params.extend(f"%, {tag},%" for tag in any_of)
+    if years is not None:
+        conditions.append("year BETWEEN ? AND ?")
+        params.extend(years)
+    query = f"SELECT id FROM album_metadata WHERE {' AND '.join(conditions)} ORDER BY id"
+    return np.array([row_id for row_id, in database.execute(query, params).fetchall()], dtype=np.int64)
+
+
+def best_time(function, *args):
+    """ Result of function(*args) and the fastest of REPEATS runs in seconds. """
+    seconds = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        result = function(*args)
+        seconds.append(time.perf_counter() - started)
+    return result, min(seconds)
+
+
+if __name__ == "__main__":
+    albums = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = BandcampDB(os.path.join(directory, "tags.db"), create_new_db=True)
+        fill(database, albums)
+
+        started = time.perf_counter()
+        backfill_album_tags(database.conn)
+        database.commit()
+        stats = database.stats()
+        print(f"Backfilled {stats['album_tag']:,} album tags of {stats['tag']:,} tags for {albums:,} albums in "
+              f"{time.perf_counter() - started:.2f}s")
+
+        print(f"{'filter':>14} {'albums':>8} {'LIKE ms':>9} {'album_tag ms':>13} {'speedup':>8}")
+        for name, (all_of, any_of, years) in FILTERS.items():
+            expected, like_seconds = best_time(like_scan, database, all_of, any_of, years)
+            found, tag_seconds = best_time(lambda: database.tagged_album_ids(all_of, any_of, years))
+            assert np.array_equal(expected, found), name
+            print(f"{name:>14} {len(found):>8,} {like_seconds * 1000:>9.2f} {tag_seconds * 1000:>13.2f} "
+                  f"{like_seconds / tag_seconds:>7.1f}x")
+        database.commit_and_close()
@@ -0,0 +1,78 @@
+""" Memory and lookup speed of the visited urls as a set of url strings against urls.FingerprintSet, and throughput
+of urls.canonicalize, on generated bandcamp urls:
+
+    python -m benchmarks.visited [amount of urls]
+"""
+import random
+import sys
+import time
+import tracemalloc
+
+from urls import FingerprintSet, canonicalize
+
+
+def generate_urls(amount, seed=1):
+    """ Album, artist and fan urls like the ones in the logs table, a fifth of them a non canonical variant. """
+    rng = random.Random(seed)
+    urls = []
+    for i in range(amount):
+        kind = i % 3
+        if kind == 0:
+            url = f"https://artist{rng.randrange(10 ** 6)}.bandcamp.com/album/some-album-title-{i}"
+        elif kind == 1:
+            url = f"https://artist{i}.bandcamp.com"
+        else:
+            url = f"https://bandcamp.com/fan{i}"
+        if rng.random() < 0.2:
+            url = rng.choice([url + "/", url + "?from=fanthanks", url.replace("https://", "http://www.")])
+        urls.append(url)
+    return urls
+
+
+def measure(build):
+    """ Returns what build() returns, the bytes it allocated and the seconds it took. """
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - started
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, allocated, elapsed
+
+
+def lookups_per_second(visited, urls):
+    started = time.perf_counter()
+    found = sum(url in visited for url in urls)
+    assert found == len(urls)
+    return len(urls) / (time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    urls = generate_urls(amount)
+
+    canonical, _, elapsed = measure(lambda: [canonicalize(url) for url in urls])
+    print(f"canonicalize: {amount / elapsed:12,.0f} urls/sec, {len(set(canonical)):,} distinct of {amount:,}")
+
+    # The strings are generated before measuring, but a visited set of strings keeps them alive, so they count
+    strings = [url.encode().decode() for url in canonical]
+    del canonical
+    _, string_bytes, _ = measure(lambda: set(strings))
+    string_bytes += sum(sys.getsizeof(url) for url in strings)
+    visited_strings = set(strings)
+
+    visited_fingerprints, fingerprint_bytes, elapsed = measure(lambda: FingerprintSet(strings))
+    print(f"set of strings: {string_bytes / 2 ** 20:8.1f} MB, {string_bytes / amount:6.1f} bytes/url")
+    print(f"FingerprintSet: {fingerprint_bytes / 2 ** 20:8.1f} MB, {fingerprint_bytes / amount:6.1f} bytes/url, "
+          f"built in {elapsed:.2f}s ({string_bytes / fingerprint_bytes:.1f}x smaller)")
+
+    # Adding one at a time, like the frontier does while crawling
+    incremental = FingerprintSet()
+    started = time.perf_counter()
+    for url in strings:
+        incremental.add(url)
+    print(f"FingerprintSet.add: {amount / (time.perf_counter() - started):12,.0f} urls/sec")
+
+    sample = random.Random(2).sample(strings, min(amount, 100_000))
+    print(f"lookups, set of strings: {lookups_per_second(visited_strings, sample):12,.0f} /sec")
+    print(f"lookups, FingerprintSet: {lookups_per_second(visited_fingerprints, sample):12,.0f} /sec")
@@ -0,0 +1,91 @@
+import json
+import time
+
+from http_client import get_default_client
+from urls import canonicalize
+from utils import CollectionLoadError, HttpError
+
+
+# Endpoint the 'show more' button and infinite scroll of a fan page get their items from
+COLLECTION_API_URL = "https://bandcamp.com/api/fancollection/1/collection_items"
+
+
+class CollectionLoader:
+    """ Loads the complete collection of a fan over plain http, without a browser.
+
+    The fan page embeds the fan id in the json data-blob of div#pagedata. With it we can page through the
+    collection api with large batches, older_than_token is the cursor and last_token of a response is where the
+    next batch starts. This costs one request per batch_size items instead of a browser scroll per 20 items, and
+    there is no size limit.
+
+    To load only the items bought since an earlier scrape, pass the known item urls as stop_at. The collection is
+    newest first, so loading stops at the first known item. Batches then start at first_batch_size items and double,
+    as usually only a few items are new.
+
+    Pass api_url to run against a local stand-in server, see standin_server.py.
+    """
+    def __init__(self, api_url=COLLECTION_API_URL, batch_size=500, first_batch_size=20, http_client=None):
+        self.api_url = api_url
+        self.batch_size = batch_size
+        self.first_batch_size = first_batch_size
+        self.http_client = http_client if http_client is not None else get_default_client()
+
+    @staticmethod
+    def fan_id(extractor):
+        """ Reads the fan id from the data-blob of a fan page. """
+        blob = extractor.pagedata_blob()
+        if not blob:
+            raise CollectionLoadError("Fan page has no pagedata blob")
+
+        try:
+            return json.loads(blob)["fan_data"]["fan_id"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise CollectionLoadError(f"Could not read fan id from pagedata blob: {e!r}")
+
+    def load_from_page(self, extractor, stop_at=None):
+        """ Returns the item urls of the collection shown on a fan page, extractor is the parsed fan page. """
+        return self.load(self.fan_id(extractor), stop_at=stop_at)
+
+    def load(self, fan_id, older_than_token=None, stop_at=None):
+        """ Returns the item urls of all collection items older than older_than_token, newest first. Without a
+        token the whole collection is loaded. With stop_at, a set of canonical item urls, only the items newer than
+        the first one in stop_at are returned. """
+        # Token format is "<unix time>::<item type>::", starting at now covers everything
+        token = older_than_token or f"{int(time.time())}::a::"
+        count = self.first_batch_size if stop_at is not None else self.batch_size
+
+        item_urls = []
+        while True:
+            batch = self.load_batch(fan_id, token, count)
+            for item in batch["items"]:
+                if not item.get("item_url"):
+                    continue
+                if stop_at is not None and canonicalize(item["item_url"]) in stop_at:
+                    return item_urls
+                item_urls.append(item["item_url"])
+
+            if not batch.get("more_available") or not batch["items"]:
+                return item_urls
+            token = batch["last_token"]
+            count = min(2 * count, self.batch_size)
+
+    def load_batch(self, fan_id, older_than_token, count=None):
+        """ Single request to the collection api for count items (default batch_size), returns the decoded json
+        response. """
+        payload = {"fan_id": fan_id, "older_than_token": older_than_token, "count": count or self.batch_size}
+        try:
+            response = self.http_client.request("POST", self.api_url, json=payload)
+        except HttpError as e:
+            raise CollectionLoadError(f"Collection request failed: {e}")
+
+        if response.status_code != 200:
+            raise CollectionLoadError(f"Collection request returned faulty response: {response.status_code}")
+
+        try:
+            batch = response.json()
+        except ValueError:
+            raise CollectionLoadError("Collection request did not return json")
+
+        if batch.get("error") or "items" not in batch:
+            raise CollectionLoadError(f"Collection request returned an error: {batch.get('error_message')}")
+        return batch
@@ -0,0 +1,18 @@
+import pytest
+
+from http_client import HttpClient
+from standin_server import Recording, StandInSession, serve
+
+
+@pytest.fixture
+def standin():
+    """ Returns a function that replays the given exchanges and returns a HttpClient pointed at them. """
+    servers = []
+
+    def start(exchanges):
+        server, base_url = serve(Recording(exchanges))
+        servers.append(server)
+        return HttpClient(max_retries=0, session=StandInSession(base_url))
+    yield start
+    for server in servers:
+        server.shutdown()
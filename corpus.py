@@ -0,0 +1,157 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+from queries import USER_SUPPORTS_AFTER_USER_QUERY
+
+
+# Bumped when the layout of the files changes, readers refuse corpora with another version
+FORMAT_VERSION = 1
+
+TOKENS_FILE = "tokens.int32"
+OFFSETS_FILE = "offsets.int64"
+USERS_FILE = "users.int32"
+META_FILE = "corpus.json"
+
+# user_supports rows fetched from sqlite at a time
+EXPORT_CHUNK_SIZE = 100_000
+
+# Tokens counted at a time by Corpus.album_counts, bincount casts its input to int64, so counting the whole memmap at
+# once would copy it in memory at twice its size
+COUNT_CHUNK_SIZE = 10_000_000
+
+
+class Corpus:
+    """ Training corpus of album embeddings: every user's collection is a sentence of album ids.
+
+    Stored as flat binary files in a directory, so it can be memory mapped by NumPy and read without loading
+    it in memory:
+    - tokens.int32: album ids of all collections after each other
+    - offsets.int64: sentence i is tokens[offsets[i]:offsets[i + 1]], has one more entry than there are sentences
+    - users.int32: the user id of every sentence
+    - corpus.json: format version, sizes, and the highest exported user id
+
+    corpus.json is written last, and the sizes in it are what a reader uses, so an export that crashed halfway
+    leaves the previous corpus readable.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, META_FILE)) as f:
+            self.meta = json.load(f)
+        if self.meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"Corpus {directory} has format version {self.meta['format_version']}, "
+                             f"expected {FORMAT_VERSION}")
+
+        self.tokens = self._memmap(TOKENS_FILE, np.int32, self.meta["tokens"])
+        self.offsets = self._memmap(OFFSETS_FILE, np.int64, self.meta["sentences"] + 1)
+        self.users = self._memmap(USERS_FILE, np.int32, self.meta["sentences"])
+
+    def _memmap(self, filename, dtype, length):
+        # np.memmap can't map an empty file
+        if not length:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.directory, filename), dtype=dtype, mode="r", shape=(length,))
+
+    def __len__(self):
+        return self.meta["sentences"]
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def max_user_id(self):
+        return self.meta["max_user_id"]
+
+    def sentence_lengths(self):
+        return np.diff(self.offsets)
+
+    def album_counts(self):
+        """ Amount of collections every album id is in, indexed by album id. Counted in chunks of COUNT_CHUNK_SIZE
+        tokens, so memory use doesn't depend on the size of the corpus. """
+        counts = np.zeros(self.meta["max_album_id"] + 1, dtype=np.int64)
+        for start in range(0, len(self.tokens), COUNT_CHUNK_SIZE):
+            counts += np.bincount(self.tokens[start:start + COUNT_CHUNK_SIZE], minlength=len(counts))
+        return counts
+
+
+def export_corpus(database, directory, chunk_size=EXPORT_CHUNK_SIZE):
+    """ Writes the collections in user_supports of database to a corpus in directory, or appends the users that
+    are new since the last export if directory already has one. Returns the opened Corpus.
+
+    A user's row and collection are written in the same transaction when their page is scraped, and user ids only
+    go up, so everything with a user id above the highest exported one is new. Albums that a refresh added to the
+    collection of a user that was exported already (see Scraper.refresh) are not, export to a new directory to
+    include them. Rows are streamed from sqlite in chunks of chunk_size and written straight to the files, memory
+    use doesn't depend on the size of the database.
+    """
+    os.makedirs(directory, exist_ok=True)
+    meta_path = os.path.join(directory, META_FILE)
+    if os.path.exists(meta_path):
+        meta = Corpus(directory).meta
+    else:
+        meta = {"format_version": FORMAT_VERSION, "sentences": 0, "tokens": 0, "max_user_id": 0, "max_album_id": 0}
+
+    paths = {name: os.path.join(directory, name) for name in [TOKENS_FILE, OFFSETS_FILE, USERS_FILE]}
+    # Cut off whatever a crashed export appended after the last completed one. For a new corpus this also writes
+    # the first offset, 0
+    for name, length in [(TOKENS_FILE, meta["tokens"] * 4), (OFFSETS_FILE, (meta["sentences"] + 1) * 8),
+                         (USERS_FILE, meta["sentences"] * 4)]:
+        with open(paths[name], "ab") as f:
+            f.truncate(length)
+
+    with open(paths[TOKENS_FILE], "ab") as tokens_file, open(paths[OFFSETS_FILE], "ab") as offsets_file, \
+            open(paths[USERS_FILE], "ab") as users_file:
+        # User of the last row of the previous chunk, its collection can continue in the next chunk
+        current_user = None
+        for rows in database.iter_batches(USER_SUPPORTS_AFTER_USER_QUERY, (meta["max_user_id"],), chunk_size):
+            rows = np.array(rows, dtype=np.int64)
+            user_ids, album_ids = rows[:, 0], rows[:, 1]
+
+            # Positions in this chunk where a new user starts, each of those ends the previous sentence
+            starts = np.flatnonzero(np.diff(user_ids, prepend=-1 if current_user is None else current_user))
+            if current_user is not None and len(starts):
+                offsets_file.write((meta["tokens"] + starts).astype(np.int64).tobytes())
+            elif len(starts) > 1:
+                # The first start of the first chunk begins the first sentence, it doesn't end one
+                offsets_file.write((meta["tokens"] + starts[1:]).astype(np.int64).tobytes())
+            users_file.write(user_ids[starts].astype(np.int32).tobytes())
+            tokens_file.write(album_ids.astype(np.int32).tobytes())
+
+            meta["sentences"] += len(starts)
+            meta["tokens"] += len(album_ids)
+            meta["max_album_id"] = max(meta["max_album_id"], int(album_ids.max()))
+            current_user = int(user_ids[-1])
+
+        if current_user is not None:
+            # End of the last sentence
+            offsets_file.write(np.array([meta["tokens"]], dtype=np.int64).tobytes())
+            meta["max_user_id"] = current_user
+
+    # Only now the appended data becomes part of the corpus
+    tmp_path = meta_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, meta_path)
+
+    return Corpus(directory)
+
+
+if __name__ == "__main__":
+    from bandcamp_db import BandcampDB
+
+    if len(sys.argv) != 3:
+        print("Usage: python corpus.py <database> <corpus directory>")
+        sys.exit(1)
+
+    database = BandcampDB(sys.argv[1])
+    before = Corpus(sys.argv[2]).meta["sentences"] if os.path.exists(os.path.join(sys.argv[2], META_FILE)) else 0
+    corpus = export_corpus(database, sys.argv[2])
+    print(f"Exported {len(corpus) - before:,} new collections, corpus has {len(corpus):,} collections with "
+          f"{corpus.meta['tokens']:,} albums in total")
+    database.commit_and_close()
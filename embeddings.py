@@ -0,0 +1,80 @@
+import json
+import os
+
+import numpy as np
+
+
+# Bumped when the layout of the file changes, load refuses files with another version
+FORMAT_VERSION = 1
+
+
+class Embeddings:
+    """ Album vectors keyed by album.id, the output of every embedding method (album2vec, ppmi).
+
+    Saved as an .npz file with a format_version, the sorted album_ids, the float32 vectors (row i belongs to
+    album_ids[i]) and meta, a json string with how the vectors were made. Files of different methods can be
+    compared directly, they only differ in meta. album2vec also stores its output layer as context_vectors,
+    which it needs to continue training from a snapshot.
+    """
+    def __init__(self, album_ids, vectors, meta=None, context_vectors=None):
+        album_ids = np.asarray(album_ids, dtype=np.int64)
+        order = np.argsort(album_ids, kind="stable")
+        self.album_ids = album_ids[order]
+        self.vectors = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32)[order])
+        self.meta = meta or {}
+        self.context_vectors = None
+        if context_vectors is not None:
+            self.context_vectors = np.ascontiguousarray(np.asarray(context_vectors, dtype=np.float32)[order])
+
+    def __len__(self):
+        return len(self.album_ids)
+
+    def __contains__(self, album_id):
+        return self.index_of([album_id])[0] >= 0
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def index_of(self, album_ids):
+        """ Row of every album id in vectors, -1 for albums without a vector. """
+        album_ids = np.asarray(album_ids, dtype=np.int64)
+        if not len(self.album_ids):
+            return np.full(album_ids.shape, -1)
+        rows = np.minimum(np.searchsorted(self.album_ids, album_ids), len(self.album_ids) - 1)
+        return np.where(self.album_ids[rows] == album_ids, rows, -1)
+
+    def subset(self, album_ids):
+        """ Embeddings of only the albums in album_ids that have a vector, e.g. of BandcampDB.tagged_album_ids to
+        search within a genre. """
+        rows = self.index_of(album_ids)
+        rows = np.unique(rows[rows >= 0])
+        context_vectors = self.context_vectors[rows] if self.context_vectors is not None else None
+        return Embeddings(self.album_ids[rows], self.vectors[rows], self.meta, context_vectors)
+
+    def vector(self, album_id):
+        row = self.index_of([album_id])[0]
+        if row < 0:
+            raise KeyError(album_id)
+        return self.vectors[row]
+
+    def save(self, path):
+        """ Writes the embeddings to path. Written to a temporary file first, so path is never half written. """
+        arrays = {"format_version": np.array(FORMAT_VERSION), "album_ids": self.album_ids, "vectors": self.vectors,
+                  "meta": np.array(json.dumps(self.meta))}
+        if self.context_vectors is not None:
+            arrays["context_vectors"] = self.context_vectors
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["format_version"]) != FORMAT_VERSION:
+                raise ValueError(f"Embeddings {path} have format version {int(data['format_version'])}, "
+                                 f"expected {FORMAT_VERSION}")
+            return cls(data["album_ids"], data["vectors"], json.loads(str(data["meta"])),
+                       data["context_vectors"] if "context_vectors" in data else None)
@@ -0,0 +1,149 @@
+import re
+
+from bs4 import BeautifulSoup
+from lxml import etree
+
+
+class SoupExtractor:
+    """ Reads the fields we store from a full BeautifulSoup tree of a page. This is the original extraction, kept
+    as reference for XPathExtractor. Missing elements raise AttributeError. """
+    def __init__(self, html):
+        self.soup = BeautifulSoup(html, "lxml")
+
+    # Album pages
+    def has_more_buttons(self):
+        return self.soup.find("a", class_="more-writing") is not None or self.soup.find("a", class_="more-thumbs") is not None
+
+    def supporters(self):
+        supporter_div = self.soup.find("div", class_="deets populated")
+        if supporter_div is None:
+            return []
+        return [a["href"] for a in supporter_div.find_all("a", class_="pic")]
+
+    def album_name(self):
+        return self.soup.find("h2", class_="trackTitle").text.strip()
+
+    def artist_url(self):
+        return self.soup.find("div", id="name-section").find("a")["href"]
+
+    def artist_name(self):
+        return self.soup.find("p", id="band-name-location").find("span", class_="title").text.strip()
+
+    def credits_text(self):
+        return self.soup.find("div", class_="tralbumData tralbum-credits").text
+
+    def tags(self):
+        # Use regex classname because sometimes we have to add hidden to find tag
+        tags_div = self.soup.find("div", class_=re.compile(r"tralbumData tralbum-tags tralbum-tags-nu( hidden)?"))
+        return [a.text for a in tags_div.find_all("a", class_="tag")]
+
+    # Artist pages
+    def album_hrefs(self):
+        album_ol = self.soup.find("ol", id="music-grid")
+        return [li.find("a")["href"] for li in album_ol.find_all("li", class_="music-grid-item")]
+
+    # User pages
+    def has_show_more(self):
+        # We look at the div first because there exists another button with the class "show-more" if user
+        # collection < 20 items
+        return self.soup.find("div", class_="collection-items").find("button", class_="show-more") is not None
+
+    def collection(self):
+        album_ol = self.soup.find("ol", class_="collection-grid")
+        return [a["href"] for a in album_ol.find_all("a", class_="item-link", target="_blank")]
+
+    def username(self):
+        return self.soup.find("div", class_="name").find("span").text.strip()
+
+    def pagedata_blob(self):
+        pagedata = self.soup.find("div", id="pagedata")
+        return pagedata.get("data-blob") if pagedata is not None else None
+
+
+def has_class(name):
+    """ XPath condition for an element with name among its classes, like BeautifulSoup's class_=name. """
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# Compiled once, every XPath below selects exactly what the matching SoupExtractor method finds. Strings are
+# returned without a reference back to the tree (smart_strings=False), so the tree can be freed right away
+MORE_BUTTONS = etree.XPath(f"//a[{has_class('more-writing')} or {has_class('more-thumbs')}][1]")
+SUPPORTERS = etree.XPath(f"(//div[normalize-space(@class) = 'deets populated'])[1]//a[{has_class('pic')}]/@href", smart_strings=False)
+ALBUM_NAME = etree.XPath(f"(//h2[{has_class('trackTitle')}])[1]")
+ARTIST_URL = etree.XPath("(//div[@id = 'name-section'])[1]/descendant::a[1]/@href", smart_strings=False)
+ARTIST_NAME = etree.XPath(f"(//p[@id = 'band-name-location'])[1]/descendant::span[{has_class('title')}][1]")
+CREDITS = etree.XPath("(//div[normalize-space(@class) = 'tralbumData tralbum-credits'])[1]")
+TAGS_DIV = etree.XPath("(//div[contains(normalize-space(@class), 'tralbumData tralbum-tags tralbum-tags-nu')])[1]")
+TAGS = etree.XPath(f".//a[{has_class('tag')}]")
+ALBUM_GRID = etree.XPath("(//ol[@id = 'music-grid'])[1]")
+ALBUM_ITEMS = etree.XPath(f".//li[{has_class('music-grid-item')}]")
+FIRST_LINK_HREF = etree.XPath("descendant::a[1]/@href", smart_strings=False)
+COLLECTION_ITEMS_DIV = etree.XPath(f"(//div[{has_class('collection-items')}])[1]")
+SHOW_MORE_BUTTON = etree.XPath(f"descendant::button[{has_class('show-more')}][1]")
+COLLECTION_GRID = etree.XPath(f"(//ol[{has_class('collection-grid')}])[1]")
+COLLECTION = etree.XPath(f".//a[{has_class('item-link')}][@target = '_blank']/@href", smart_strings=False)
+USERNAME = etree.XPath(f"(//div[{has_class('name')}])[1]/descendant::span[1]")
+PAGEDATA_BLOB = etree.XPath("(//div[@id = 'pagedata'])[1]/@data-blob", smart_strings=False)
+# String value of an element, like .text in BeautifulSoup
+TEXT = etree.XPath("string()", smart_strings=False)
+
+
+def first(elements, description):
+    """ First result of an XPath, raises AttributeError like a failed BeautifulSoup find would. """
+    if not elements:
+        raise AttributeError(f"{description} not found on page")
+    return elements[0]
+
+
+class XPathExtractor:
+    """ Same fields as SoupExtractor, but read with the compiled XPaths above from a plain lxml tree. Building
+    the lxml tree is much cheaper than a BeautifulSoup tree, and only the elements we need are ever touched. """
+    def __init__(self, html):
+        self.tree = etree.HTML(html)
+        if self.tree is None:
+            # Empty document, use an empty tree so every field is reported as missing
+            self.tree = etree.HTML("<html></html>")
+
+    # Album pages
+    def has_more_buttons(self):
+        return bool(MORE_BUTTONS(self.tree))
+
+    def supporters(self):
+        return SUPPORTERS(self.tree)
+
+    def album_name(self):
+        return TEXT(first(ALBUM_NAME(self.tree), "Album name")).strip()
+
+    def artist_url(self):
+        return first(ARTIST_URL(self.tree), "Artist url")
+
+    def artist_name(self):
+        return TEXT(first(ARTIST_NAME(self.tree), "Artist name")).strip()
+
+    def credits_text(self):
+        return TEXT(first(CREDITS(self.tree), "Credits"))
+
+    def tags(self):
+        return [TEXT(a) for a in TAGS(first(TAGS_DIV(self.tree), "Tags"))]
+
+    # Artist pages
+    def album_hrefs(self):
+        album_grid = first(ALBUM_GRID(self.tree), "Album grid")
+        return [first(FIRST_LINK_HREF(li), "Album link") for li in ALBUM_ITEMS(album_grid)]
+
+    # User pages
+    def has_show_more(self):
+        return bool(SHOW_MORE_BUTTON(first(COLLECTION_ITEMS_DIV(self.tree), "Collection")))
+
+    def collection(self):
+        return COLLECTION(first(COLLECTION_GRID(self.tree), "Collection grid"))
+
+    def username(self):
+        return TEXT(first(USERNAME(self.tree), "Username")).strip()
+
+    def pagedata_blob(self):
+        blobs = PAGEDATA_BLOB(self.tree)
+        return blobs[0] if blobs else None
+
+
+EXTRACTORS = {"soup": SoupExtractor, "xpath": XPathExtractor}
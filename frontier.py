@@ -0,0 +1,263 @@
+from collections import deque
+import os
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from bandcamp_db import BandcampDB, is_locked
+from metrics import METRICS
+from queries import INSERT_LOGS_QUERY, LOGS_FINGERPRINTS_QUERY, OTHER_LEASES_QUERY, PENDING_URLS_COUNT_QUERY,\
+                    PUSH_LOGS_PRIORITY_QUERY, REFRESH_DUE_QUERY, SCHEDULE_REFRESH_QUERY, SKIP_LOGS_URL_QUERY,\
+                    UPDATE_LOGS_TABLE, URL_SCRAPED_QUERY
+from scheduler import FifoScheduler
+from urls import FingerprintSet, canonicalize, fingerprint, stored_fingerprint
+
+
+# Seconds push_front waits before writing again when the database stayed locked by another crawl process
+LOCKED_BACKOFF_SECONDS = 1.0
+
+
+def default_owner():
+    """ Lease owner name that is unique per crawl process, also across hosts. """
+    return f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+
+class Frontier:
+    """ Crawl frontier stored in the logs table instead of in memory.
+
+    Urls to scrape are claimed from the logs table in batches of batch_size rows. With the default FifoScheduler
+    they are claimed in id order, so the crawl order stays FIFO like the old in-memory stack. Urls that are pushed
+    get a higher id than anything claimed so far, so they are picked up by a later batch. Other schedulers give the
+    links of every page a priority, and most of a batch is claimed by priority instead (see scheduler.py). Only the
+    current batch lives in memory, in a deque so dequeueing is O(1).
+
+    Urls are canonicalized (see urls.canonicalize) when they are pushed, so every page gets one logs row. Which
+    urls are in the logs table, and which of them are scraped, is kept in two FingerprintSets of 8 bytes per url,
+    loaded from the fingerprints stored in the logs table at startup, so pushing links that are known already costs no
+    query. An url that isn't
+    in the scraped set is still looked up through the unique index on logs.url, another crawl process may have
+    scraped it. Popped urls that turn out to be scraped already, e.g. under another variant of the url in a database
+    from before canonicalization, are skipped.
+
+    Claimed urls are leased to owner for lease_seconds (see BandcampDB.claim_urls), so several crawl processes,
+    also on other hosts, can share a database without scraping the same urls. Leases are renewed every third of
+    lease_seconds by a thread, also while a single slow page is being scraped, until close() releases them. Only the
+    leases of a process that crashed or hung expire, after which other processes claim its urls again. When another
+    process keeps the database locked, claiming fails, the frontier counts as empty for now and wait_for_others tries
+    again after a backoff.
+    """
+    def __init__(self, database, batch_size=1000, owner=None, lease_seconds=600, scheduler=None):
+        self.database = database
+        self.batch_size = batch_size
+        self.scheduler = scheduler if scheduler is not None else FifoScheduler()
+        self.owner = owner or default_owner()
+        self.lease_seconds = lease_seconds
+
+        self.buffer = deque()
+        # Set when the last claim failed on a locked database, the frontier isn't done then
+        self.claim_locked = False
+        # Urls that were popped and checked already, but not scraped, see requeue
+        self.requeued = deque()
+
+        # Canonical urls in the logs table, and the scraped ones among them
+        self.known = FingerprintSet()
+        self.scraped = FingerprintSet()
+        for rows in self.database.iter_batches(LOGS_FINGERPRINTS_QUERY, batch_size=10_000):
+            # Only rows without a stored fingerprint have their url selected, those are canonicalized and hashed here
+            values = np.array([value if value is not None else stored_fingerprint(fingerprint(canonicalize(url)))
+                               for value, _, url in rows], dtype=np.int64).view(np.uint64)
+            states = np.array([state for _, state, _ in rows])
+            self.known.update_fingerprints(values)
+            self.scraped.update_fingerprints(values[states == 1])
+
+        self.closed = threading.Event()
+        self.renewer = threading.Thread(target=self.renew_leases, daemon=True)
+        self.renewer.start()
+
+    def __bool__(self):
+        return bool(self.requeued) or bool(self.buffer) or self.refill()
+
+    def refill(self):
+        """ Claims the next batch of urls from the logs table. Returns False if there are none left, or if the
+        database stayed locked, then claim_locked is set. """
+        try:
+            urls = self.database.claim_urls(self.owner, self.batch_size, self.lease_seconds,
+                                            exploration=self.scheduler.exploration)
+        except sqlite3.OperationalError as e:
+            if not is_locked(e):
+                raise
+            print(f"Could not claim urls, trying again later: {e}")
+            METRICS.count("claims_locked_total")
+            self.claim_locked = True
+            return False
+
+        self.claim_locked = False
+        if not urls:
+            return False
+
+        self.buffer.extend(urls)
+        return True
+
+    def pop(self):
+        """ Returns the next url to scrape, or None if the frontier is empty or the database is locked. Urls that
+        were scraped already are marked as done themselves and skipped. """
+        if self.requeued:
+            return self.requeued.popleft()
+        while self:
+            url = self.buffer.popleft()
+            if not self.is_visited(url):
+                return url
+            try:
+                self.skip(url)
+            except sqlite3.OperationalError as e:
+                if not is_locked(e):
+                    raise
+                # Skipped on the next pop
+                self.buffer.appendleft(url)
+                return None
+            METRICS.count("duplicate_fetches_avoided_total")
+        return None
+
+    def renew_leases(self):
+        """ Renewal thread: renews the leases of this frontier every third of lease_seconds until it is closed. Urls
+        that are being scraped or were held back are leased as well, so all of them are renewed. sqlite connections
+        can't be shared between threads, so it has its own. With write-behind the renewal waits for the next flush,
+        one that can't get the write lock in time is retried at the next renewal. """
+        database = None
+        try:
+            while not self.closed.wait(self.lease_seconds / 3):
+                try:
+                    if database is None:
+                        database = BandcampDB(self.database.db_name)
+                    database.renew_leases(self.owner, self.lease_seconds)
+                except sqlite3.OperationalError as e:
+                    print(f"Could not renew the leases of {self.owner}: {e}")
+        finally:
+            if database is not None:
+                database.commit_and_close()
+
+    def wait_for_others(self, poll_seconds=1.0):
+        """ For when the frontier ran out of urls: the pages other crawl processes are scraping can still link to new
+        urls, so this waits while they have urls leased. Also waits while claiming fails on a locked database.
+        Returns True as soon as there are urls to claim again, False if no other process has urls leased, then the
+        crawl is done. """
+        # Our writes have to be visible to the others, and they need the write lock to finish their pages
+        self.database.flush()
+        while self.claim_locked or self.database.select_value(OTHER_LEASES_QUERY, (self.owner, time.time())):
+            time.sleep(poll_seconds)
+            if self.refill():
+                return True
+        return False
+
+    def push(self, urls, page=None):
+        """ Adds the canonical form of urls to the logs table, urls that are already known are ignored. Pass the
+        page urls were found on to have the scheduler prioritize them. """
+        urls = list(dict.fromkeys(canonicalize(url) for url in urls))
+        priorities = self.scheduler.priorities(page, urls) if page is not None else None
+        if priorities is not None:
+            self.push_with_priorities(urls, priorities)
+            return
+
+        new = [(url, value) for url, value in zip(urls, map(fingerprint, urls))
+               if not self.known.contains_fingerprint(value)]
+        if len(new) < len(urls):
+            METRICS.count("known_links_skipped_total", len(urls) - len(new))
+        if new:
+            # Known only once written, a write that fails on a locked database is pushed again with its page
+            self.database.executemany(INSERT_LOGS_QUERY, [(url, stored_fingerprint(value)) for url, value in new])
+            for _, value in new:
+                self.known.add_fingerprint(value)
+
+    def push_with_priorities(self, urls, priorities):
+        """ Adds urls to the logs table with a priority, or adds to the priority of the ones that are pending. """
+        new = [(url, value, priority) for url, value, priority in zip(urls, map(fingerprint, urls), priorities)
+               if not self.scraped.contains_fingerprint(value)]
+        if len(new) < len(urls):
+            METRICS.count("known_links_skipped_total", len(urls) - len(new))
+        if new:
+            self.database.executemany(PUSH_LOGS_PRIORITY_QUERY,
+                                      [(url, stored_fingerprint(value), priority) for url, value, priority in new])
+            for _, value, _ in new:
+                self.known.add_fingerprint(value)
+
+    def push_front(self, urls):
+        """ Adds urls to the logs table and schedules them before everything else. Waits while the database is
+        locked. """
+        urls = [canonicalize(url) for url in urls]
+        while True:
+            try:
+                self.push(urls)
+                break
+            except sqlite3.OperationalError as e:
+                if not is_locked(e):
+                    raise
+                print(f"Could not add {len(urls)} urls, trying again: {e}")
+                time.sleep(LOCKED_BACKOFF_SECONDS)
+        self.buffer.extendleft(reversed(urls))
+
+    def requeue(self, urls):
+        """ Puts urls that were popped but not scraped back in front of the frontier. They are still leased to us
+        and were checked when they were popped, so they are handed out again without checking whether they were
+        scraped. """
+        self.requeued.extendleft(reversed(urls))
+
+    def retry(self, url):
+        """ Schedules an url that failed for another attempt at the end of the current batch. The url is still
+        leased, so it is released and retried after a restart. """
+        self.buffer.append(url)
+
+    def is_visited(self, url):
+        url = canonicalize(url)
+        if url in self.scraped:
+            return True
+        if self.database.select_value(URL_SCRAPED_QUERY, (url,)):
+            self.scraped.add(url)
+            return True
+        return False
+
+    def mark_visited(self, url, refresh_interval=None):
+        """ Marks the logs row of url as scraped, and the row of its canonical form if that's another one. With
+        refresh_interval the page is due for a refresh that many seconds from now. """
+        canonical = canonicalize(url)
+        now = time.time()
+        refresh_at = now + refresh_interval if refresh_interval is not None else None
+        self.database.execute(UPDATE_LOGS_TABLE, (now, refresh_interval, refresh_at, canonical))
+        if canonical != url:
+            # The canonical row is the one that is refreshed
+            self.database.execute(UPDATE_LOGS_TABLE, (now, None, None, url))
+        self.scraped.add(canonical)
+
+    def skip(self, url):
+        """ Marks the logs row of url as done without a fetch. The row of the scraped canonical url is left alone, so
+        its fetch time and refresh schedule stay what they are. """
+        self.database.execute(SKIP_LOGS_URL_QUERY, (url,))
+
+    def due_refreshes(self, amount):
+        """ Up to amount (logs id, url, refresh interval) of scraped pages whose refresh is due, longest overdue
+        first. """
+        return self.database.execute(REFRESH_DUE_QUERY, (time.time(), amount)).fetchall()
+
+    def schedule_refresh(self, log_id, refresh_interval):
+        """ Records that the page with log_id was refreshed now, the next refresh is refresh_interval seconds from
+        now, or never if it is None. """
+        now = time.time()
+        refresh_at = now + refresh_interval if refresh_interval is not None else None
+        self.database.execute(SCHEDULE_REFRESH_QUERY, (now, refresh_interval, refresh_at, log_id))
+
+    def pending_count(self):
+        """ Amount of urls in the logs table that are not scraped yet, counted from the logs_pending index. """
+        return self.database.select_value(PENDING_URLS_COUNT_QUERY)
+
+    def close(self):
+        """ Releases the leases of urls that were claimed but not scraped, so other processes can take them, and
+        stops renewing them. """
+        self.closed.set()
+        self.buffer.clear()
+        self.requeued.clear()
+        # Commits, so a renewal that waits for the write lock gets it and the renewal thread can end
+        self.database.release_leases(self.owner)
+        self.renewer.join()
@@ -0,0 +1,167 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS
+from utils import HttpError, LRUCache
+
+
+# urllib3 decodes brotli responses only when the brotli package is installed, so only ask for br if it is
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+# Responses that are worth retrying, anything else is returned or raised right away
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class HttpClient:
+    """ Shared http client for all page fetches.
+
+    Keeps a keep-alive connection pool per host, asks for compressed responses, and retries connection errors,
+    timeouts, 429 and 5xx responses up to max_retries times. Retries wait with exponential backoff and full jitter,
+    or as long as the Retry-After header asks. With revalidate=True the ETag/Last-Modified of the last
+    revalidate_cache_size pages are kept together with their body, so fetching a page again sends
+    If-None-Match/If-Modified-Since and a 304 costs no download.
+
+    With a page_cache every page body is also stored in the cache. With offline=True nothing is requested at all,
+    bodies come from the page cache instead, which is how Scraper.rebuild_from_cache re-parses pages.
+
+    Safe to share between threads.
+    """
+    def __init__(self, timeout=30, max_retries=4, backoff=1.0, max_backoff=60, pool_connections=64, pool_maxsize=8,
+                 revalidate=False, revalidate_cache_size=1000, session=None, page_cache=None, offline=False):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # pool_connections is the amount of hosts we keep a pool for, pool_maxsize the connections per host
+        self.session = session if session is not None else requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+
+        self.revalidate = revalidate
+        self.validators = LRUCache(revalidate_cache_size)
+
+        if offline and page_cache is None:
+            raise ValueError("Offline mode needs a page cache to read pages from")
+        self.page_cache = page_cache
+        self.offline = offline
+
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "retries": 0, "not_modified": 0, "failures": 0}
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+        METRICS.count(f"http_{name}_total", amount)
+
+    def get_text(self, url):
+        """ Returns the body of url as text, raises HttpError if the response is not a 200 (or a 304 for a page we
+        have the body of). """
+        if self.offline:
+            body = self.page_cache.get(url)
+            if body is None:
+                raise HttpError(url, None, "not in page cache")
+            return body
+
+        headers = {}
+        if self.revalidate:
+            with self._lock:
+                cached = self.validators.get(url)
+            if cached is not None:
+                etag, last_modified, _ = cached
+                if etag:
+                    headers["If-None-Match"] = etag
+                if last_modified:
+                    headers["If-Modified-Since"] = last_modified
+
+        response = self.request("GET", url, headers=headers)
+        if response.status_code == 304 and headers:
+            self.count("not_modified")
+            return cached[2]
+        if response.status_code != 200:
+            raise HttpError(url, response.status_code, response.content[:200])
+
+        if self.revalidate and (response.headers.get("ETag") or response.headers.get("Last-Modified")):
+            with self._lock:
+                self.validators[url] = (response.headers.get("ETag"), response.headers.get("Last-Modified"), response.text)
+        self.store(url, response.text)
+        return response.text
+
+    def store(self, url, body, kind="http"):
+        """ Adds a body to the page cache, if there is one. Pages use this for what they render with selenium. """
+        if self.page_cache is not None and not self.offline:
+            self.page_cache.put(url, body, kind)
+
+    def cached(self, url, kind):
+        """ In offline mode returns the cached body of url, None otherwise or if it is not in the cache. """
+        if self.offline:
+            return self.page_cache.get(url, kind)
+        return None
+
+    def request(self, method, url, **kwargs):
+        """ session.request with timeout and retries, returns the last response. """
+        if self.offline:
+            raise HttpError(url, None, "offline")
+
+        for attempt in range(self.max_retries + 1):
+            self.count("requests")
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    self.count("failures")
+                    raise HttpError(url, None, repr(e))
+                retry_after = None
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    return response
+                retry_after = response.headers.get("Retry-After")
+
+            self.count("retries")
+            time.sleep(self.backoff_delay(attempt, retry_after))
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """ Seconds to wait before retry number attempt + 1. """
+        if retry_after is not None and retry_after.isdigit():
+            return min(int(retry_after), self.max_backoff)
+        # Full jitter: uniform between 0 and the exponential backoff, spreads retries of parallel workers
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def connection_stats(self):
+        """ Connections opened and requests sent over the pools that are currently kept, the difference is the
+        amount of requests that reused a keep-alive connection. """
+        pools = self.adapter.poolmanager.pools
+        opened = sent = 0
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                sent += pool.num_requests
+        return {"connections_opened": opened, "requests_sent": sent, "connections_reused": sent - opened}
+
+    def report(self):
+        stats = {**self.counters, **self.connection_stats()}
+        print("HTTP client: " + ", ".join(f"{name.replace('_', ' ')} {value:,}" for name, value in stats.items()))
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_default_client():
+    """ Client shared by all pages that don't get one passed. """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = HttpClient()
+        return _default_client
@@ -1,25 +1,131 @@
+from multiprocessing import get_context
 import os
+import signal
+import sys
 
 from bandcamp_db import BandcampDB
+from metrics import MetricsServer, SnapshotWriter
+from page_cache import PageCache
+from pipeline import CrawlPipeline
+from scheduler import SCHEDULERS, CrawlBudget
 from scraper import Scraper
 
 
 DB_NAME = "BandcampDB.db"
+# Amount of pages fetched in parallel, use scraper.start_scrape() for the old one-by-one crawl
+CONCURRENT_WORKERS = 8
+# Crawl with separate fetch, parse and write stages, parsing in PARSE_WORKERS processes (None = one per core)
+PIPELINE = True
+FETCH_WORKERS = 16
+PARSE_WORKERS = None
+# Crawl processes on this host, they share the database and claim urls with leases so they never scrape the same
+# page. More can be started on other hosts that share the database file. With more than one process every page is
+# committed on its own, write-behind would make the processes wait for each other's flushes
+CRAWL_PROCESSES = 1
+# Crawl order, "fifo" scrapes urls in the order they were found, "yield" the ones expected to bring the most
+# user-album links first (see scheduler.py)
+SCHEDULER = "fifo"
+# Urls a process claims at a time when there are several or with a prioritizing scheduler, smaller batches spread
+# the work when there is little of it and follow priority changes sooner
+CLAIM_BATCH_SIZE = 50
+# Stop each crawl process after this many scraped pages or seconds, None for no limit
+PAGE_BUDGET = None
+TIME_BUDGET = None
+# Amount of headless browsers for pages that need selenium, started only when needed
+SELENIUM_DRIVERS = 2
+# Write-behind: commit once per this many pages or seconds, a crash loses at most this much work
+FLUSH_EVERY_PAGES = 50
+FLUSH_EVERY_SECONDS = 10
+# Every fetched page is kept compressed in this directory, up to PAGE_CACHE_MAX_BYTES
+PAGE_CACHE_DIR = "page_cache"
+PAGE_CACHE_MAX_BYTES = 20 * 2 ** 30
+# Live crawl metrics on http://localhost:METRICS_PORT/metrics (Prometheus) and /metrics.json, None to turn off.
+# A json snapshot is also appended to METRICS_SNAPSHOTS every METRICS_SNAPSHOT_EVERY seconds. Crawl process i
+# uses port METRICS_PORT + i and its own snapshot file
+METRICS_PORT = 9100
+METRICS_SNAPSHOTS = "metrics_{process}.jsonl"
+METRICS_SNAPSHOT_EVERY = 60
 
+# 'python main.py replay [database]' rebuilds a database from the page cache without network access
+REPLAY = sys.argv[1:2] == ["replay"]
+if REPLAY:
+    DB_NAME = sys.argv[2] if len(sys.argv) > 2 else "RebuiltDB.db"
 
-if not os.path.exists(DB_NAME):
-    # Dont need the object, just want to make database with correct tables
-    print(f"Making new database '{DB_NAME}'")
-    _ = BandcampDB(db_name=DB_NAME, create_new_db=True)
+# 'python main.py refresh [database]' scrapes the user pages that are due for a refresh again, for new purchases
+REFRESH = sys.argv[1:2] == ["refresh"]
+if REFRESH:
+    DB_NAME = sys.argv[2] if len(sys.argv) > 2 else DB_NAME
 
-database = BandcampDB(db_name=DB_NAME)
-scraper = Scraper(database=database)
+# 'python main.py migrate [database]' upgrades a database to the latest schema in place
+MIGRATE = sys.argv[1:2] == ["migrate"]
+if MIGRATE:
+    DB_NAME = sys.argv[2] if len(sys.argv) > 2 else DB_NAME
 
-# scraper.start_scrape("https://fffoxtails.bandcamp.com/")
-scraper.start_scrape()
 
-print(f"Total artists: {len(database.select('SELECT * FROM artist')):,}")
-print(f"Total users: {len(database.select('SELECT * FROM user')):,}")
-print(f"Total albums: {len(database.select('SELECT * FROM album')):,}")
-print(f"Total user-artist links: {len(database.select('SELECT * FROM user_supports')):,}")
-scraper.quit()
+def crawl(process=0):
+    """ Runs one crawl process until there is nothing left to claim. """
+    if CRAWL_PROCESSES > 1 and not (REPLAY or REFRESH):
+        database = BandcampDB(db_name=DB_NAME, flush_every_pages=1)
+    else:
+        database = BandcampDB(db_name=DB_NAME, flush_every_pages=FLUSH_EVERY_PAGES,
+                              flush_every_seconds=FLUSH_EVERY_SECONDS)
+    page_cache = PageCache(PAGE_CACHE_DIR, max_bytes=PAGE_CACHE_MAX_BYTES)
+    scraper = Scraper(database=database, selenium_drivers=SELENIUM_DRIVERS, page_cache=page_cache,
+                      scheduler=SCHEDULERS[SCHEDULER](), budget=CrawlBudget(pages=PAGE_BUDGET, seconds=TIME_BUDGET))
+    if CRAWL_PROCESSES > 1 or SCHEDULER != "fifo":
+        scraper.frontier.batch_size = CLAIM_BATCH_SIZE
+
+    # Turn SIGTERM into SystemExit, so the scraper flushes pending writes like it does on KeyboardInterrupt
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+    if METRICS_PORT is not None:
+        metrics_server = MetricsServer(port=METRICS_PORT + process).start()
+        print(f"Serving crawl metrics on {metrics_server.url}")
+    snapshots = SnapshotWriter(METRICS_SNAPSHOTS.format(process=process), every=METRICS_SNAPSHOT_EVERY).start()
+
+    try:
+        if REPLAY:
+            scraper.rebuild_from_cache()
+        elif REFRESH:
+            scraper.refresh()
+        elif PIPELINE:
+            CrawlPipeline(scraper, fetch_workers=FETCH_WORKERS, parse_workers=PARSE_WORKERS).run()
+        else:
+            # scraper.start_scrape("https://fffoxtails.bandcamp.com/")
+            scraper.start_concurrent_scrape(workers=CONCURRENT_WORKERS)
+    finally:
+        snapshots.stop()
+        scraper.quit()
+        page_cache.close()
+
+
+# The parse processes import this module, only crawl in the main process
+if __name__ == "__main__" and MIGRATE:
+    database = BandcampDB(db_name=DB_NAME, allow_outdated=True)
+    migrations = database.migrate()
+    print(f"Ran {migrations} migrations, '{DB_NAME}' is at schema version {database.schema_version()}")
+    for name, plan in database.check_query_plans().items():
+        print(f"Query '{name}' doesn't use its index: {plan}")
+    database.commit_and_close()
+elif __name__ == "__main__":
+    if not os.path.exists(DB_NAME):
+        # Dont need the object, just want to make database with correct tables
+        print(f"Making new database '{DB_NAME}'")
+        _ = BandcampDB(db_name=DB_NAME, create_new_db=True)
+
+    # A rebuild from the page cache and a refresh always run in one process
+    processes = [get_context("spawn").Process(target=crawl, args=(process,))
+                 for process in range(1, 1 if REPLAY or REFRESH else CRAWL_PROCESSES)]
+    for process in processes:
+        process.start()
+    crawl()
+    for process in processes:
+        process.join()
+
+    database = BandcampDB(db_name=DB_NAME)
+    stats = database.stats()
+    print(f"Total artists: {stats['artist']:,}")
+    print(f"Total users: {stats['user']:,}")
+    print(f"Total albums: {stats['album']:,}")
+    print(f"Total user-artist links: {stats['user_supports']:,}")
+    database.commit_and_close()
@@ -0,0 +1,250 @@
+""" Crawl telemetry: counters, gauges and latency histograms, labelled by page type and crawl stage.
+
+The crawler records into the process wide METRICS registry, e.g.
+
+    with METRICS.timer("stage_seconds", stage="fetch", page_type="AlbumPage"):
+        ...
+    METRICS.count("skipped_total", reason="http_404")
+
+and it can be watched while a crawl runs through MetricsServer, which serves the Prometheus text format on
+/metrics and a json snapshot on /metrics.json, or through SnapshotWriter, which appends a json snapshot to a file
+every few seconds. Snapshots include p50/p95 per histogram and pages/sec, so a slow stage stands out without
+attaching a profiler, and user-album links per page, to compare crawl schedulers (see scheduler.py).
+
+Stages timed by the crawler: fetch (http download of the page), collection_api, selenium_get and selenium_clicks
+(browser navigation and pressing buttons/scrolling), parse, db_write (writing a page and its links) and db_commit.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+
+# Upper bounds in seconds, from sqlite writes (~ms) to selenium pages (~tens of seconds)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def series_name(name, labels):
+    """ Prometheus series name, e.g. pages_total{page_type="AlbumPage"}. labels is a tuple of (label, value). """
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+
+class Histogram:
+    """ Amount of observed values per bucket, like a Prometheus histogram. Quantiles are estimated from the bucket
+    counts by linear interpolation within the bucket, like Prometheus' histogram_quantile, so memory is constant
+    no matter how many values are observed. """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # counts[i] is the amount of values <= buckets[i] and > buckets[i - 1], the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """ Estimated q quantile (0 <= q <= 1), None if nothing was observed. """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                if i == len(self.buckets):
+                    # Above the last bucket, the largest value seen is the best estimate
+                    return self.max
+                lower = self.buckets[i - 1] if i else 0.0
+                return min(lower + (self.buckets[i] - lower) * (rank - cumulative) / count, self.max)
+            cumulative += count
+        return self.max
+
+    def summary(self):
+        return {"count": self.count, "sum": self.sum, "p50": self.quantile(0.5), "p95": self.quantile(0.95),
+                "max": self.max}
+
+
+class Metrics:
+    """ Registry of counters, gauges and histograms. Every metric has a name and any labels, each combination of
+    label values is its own series. Safe to use from all crawl threads. Metric names get prefix in the exported
+    formats. """
+    def __init__(self, prefix="bandcamp_", buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.started = time.monotonic()
+
+        self._lock = threading.Lock()
+        # {name: {labels: value}}, labels a sorted tuple of (label, value)
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def labels(labels):
+        return tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def count(self, name, amount=1, **labels):
+        labels = self.labels(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + amount
+
+    def set(self, name, value, **labels):
+        labels = self.labels(labels)
+        with self._lock:
+            self.gauges.setdefault(name, {})[labels] = value
+
+    def observe(self, name, value, **labels):
+        labels = self.labels(labels)
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if labels not in series:
+                series[labels] = Histogram(self.buckets)
+            series[labels].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Observes the seconds the with block took, also when it raises. """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def total(self, name):
+        """ Sum of a counter over all its series. """
+        with self._lock:
+            return sum(self.counters.get(name, {}).values())
+
+    def snapshot(self):
+        """ All metrics as a json serializable dict, histograms summarized to count, sum, p50, p95 and max. """
+        uptime = time.monotonic() - self.started
+        with self._lock:
+            snapshot = {
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "uptime_seconds": round(uptime, 3),
+                "counters": {series_name(self.prefix + name, labels): value
+                             for name, series in self.counters.items() for labels, value in series.items()},
+                "gauges": {series_name(self.prefix + name, labels): value
+                           for name, series in self.gauges.items() for labels, value in series.items()},
+                "histograms": {series_name(self.prefix + name, labels): histogram.summary()
+                               for name, series in self.histograms.items() for labels, histogram in series.items()},
+            }
+        pages = self.total("pages_total")
+        snapshot["pages_per_second"] = round(pages / uptime, 3) if uptime > 0 else 0.0
+        snapshot["links_per_page"] = round(self.total("user_album_links_total") / pages, 3) if pages else 0.0
+        return snapshot
+
+    def prometheus(self):
+        """ All metrics in the Prometheus text exposition format. """
+        lines = []
+        with self._lock:
+            for kind, metrics in [("counter", self.counters), ("gauge", self.gauges)]:
+                for name, series in sorted(metrics.items()):
+                    lines.append(f"# TYPE {self.prefix}{name} {kind}")
+                    lines.extend(f"{series_name(self.prefix + name, labels)} {value}"
+                                 for labels, value in sorted(series.items()))
+
+            for name, series in sorted(self.histograms.items()):
+                name = self.prefix + name
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{series_name(name + '_bucket', labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{series_name(name + '_sum', labels)} {histogram.sum}")
+                    lines.append(f"{series_name(name + '_count', labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+# Registry the crawler records into
+METRICS = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = self.metrics.prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(self.metrics.snapshot()), "application/json"
+        else:
+            self.send_error(404)
+            return
+
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    """ Serves metrics on http://host:port/metrics (Prometheus) and /metrics.json from a background thread. """
+    def __init__(self, metrics=METRICS, host="127.0.0.1", port=9100):
+        handler = type("BoundMetricsHandler", (MetricsHandler,), {"metrics": metrics})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SnapshotWriter:
+    """ Appends a json snapshot of metrics to path every `every` seconds, one snapshot per line, and a last one
+    when stopped. pages_per_second of a snapshot is the rate since the previous one. """
+    def __init__(self, path, metrics=METRICS, every=60):
+        self.path = path
+        self.metrics = metrics
+        self.every = every
+        self._stopped = threading.Event()
+        self._last = (time.monotonic(), metrics.total("pages_total"))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self._stopped.wait(self.every):
+            self.write()
+
+    def write(self):
+        snapshot = self.metrics.snapshot()
+        now, pages = time.monotonic(), self.metrics.total("pages_total")
+        last_time, last_pages = self._last
+        snapshot["pages_per_second"] = round((pages - last_pages) / (now - last_time), 3) if now > last_time else 0.0
+        self._last = (now, pages)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(snapshot) + "\n")
+
+    def stop(self):
+        self._stopped.set()
+        self.thread.join()
+        self.write()
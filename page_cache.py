@@ -0,0 +1,191 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+CREATE_TABLE_PAGES = """
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    digest TEXT NOT NULL
+)
+"""
+
+CREATE_INDEX_PAGES_URL = "CREATE INDEX IF NOT EXISTS pages_url ON pages (url, kind, fetched_at)"
+
+CREATE_INDEX_PAGES_DIGEST = "CREATE INDEX IF NOT EXISTS pages_digest ON pages (digest)"
+
+CREATE_TABLE_OBJECTS = """
+CREATE TABLE IF NOT EXISTS objects (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    stored_at REAL NOT NULL
+)
+"""
+
+# Eviction takes the bodies with the lowest stored_at
+CREATE_INDEX_OBJECTS_STORED_AT = "CREATE INDEX IF NOT EXISTS objects_stored_at ON objects (stored_at)"
+
+# Rows read from the index at a time by PageCache.urls
+URLS_BATCH_SIZE = 1000
+
+
+class PageCache:
+    """ Compressed on-disk store of every raw page body we fetched or rendered, so parsing can be redone without
+    crawling again.
+
+    Bodies are zlib compressed and stored content-addressed under objects/<sha256[:2]>/<sha256>, so a page that
+    didn't change between two fetches is stored once. index.db maps (url, kind, fetched_at) to the digest. kind is
+    "http" for the plain http response, "rendered" for the selenium page source and "collection" for the item urls
+    loaded from the collection api (as json).
+
+    The store is bounded by max_bytes of compressed data. When it grows past that, the bodies that were last
+    fetched longest ago are evicted together with their index rows until it is at 90% of max_bytes. Fetching a page
+    again with the same body only updates the fetched_at of its latest version, and at most max_versions versions
+    of every (url, kind) are kept, so the index is bounded too.
+
+    Safe to share between threads, and between crawl processes. Every process keeps its own estimate of the stored
+    size, so with several processes the store can grow somewhat past max_bytes before one of them evicts.
+    """
+    def __init__(self, directory, max_bytes=20 * 2 ** 30, compression_level=6, max_versions=3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_versions = max_versions
+        self.compression_level = compression_level
+        os.makedirs(os.path.join(self.directory, "objects"), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.index = sqlite3.connect(os.path.join(self.directory, "index.db"), check_same_thread=False)
+        self.index.execute("PRAGMA journal_mode = WAL")
+        self.index.execute("PRAGMA synchronous = NORMAL")
+        for query in [CREATE_TABLE_PAGES, CREATE_INDEX_PAGES_URL, CREATE_INDEX_PAGES_DIGEST, CREATE_TABLE_OBJECTS,
+                      CREATE_INDEX_OBJECTS_STORED_AT]:
+            self.index.execute(query)
+        self.index.commit()
+
+        self.total_bytes = self.index.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def put(self, url, body, kind="http", fetched_at=None):
+        """ Stores body as the version of url fetched at fetched_at (default now). Returns its digest. """
+        data = body.encode("utf-8") if isinstance(body, str) else body
+        digest = hashlib.sha256(data).hexdigest()
+        fetched_at = fetched_at if fetched_at is not None else time.time()
+
+        with self._lock:
+            known = self.index.execute("SELECT 1 FROM objects WHERE digest = ?", (digest,)).fetchone()
+            if known is None:
+                compressed = zlib.compress(data, self.compression_level)
+                path = self.object_path(digest)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write to a temporary file first, so a crash never leaves a truncated object behind. Crawl processes
+                # can share a cache, and store the same body at the same time, so the file is per process
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(compressed)
+                os.replace(tmp_path, path)
+
+                self.index.execute("INSERT OR IGNORE INTO objects (digest, size, stored_at) VALUES (?, ?, ?)",
+                                   (digest, len(compressed), fetched_at))
+                self.total_bytes += len(compressed)
+            else:
+                # Seen again, so it is not among the oldest bodies anymore
+                self.index.execute("UPDATE objects SET stored_at = ? WHERE digest = ?", (fetched_at, digest))
+
+            latest = self.index.execute(
+                "SELECT id, digest FROM pages WHERE url = ? AND kind = ? ORDER BY fetched_at DESC LIMIT 1", (url, kind)
+            ).fetchone()
+            if latest is not None and latest[1] == digest:
+                # Unchanged since the last fetch, e.g. a fan page without new purchases, no new version
+                self.index.execute("UPDATE pages SET fetched_at = MAX(fetched_at, ?) WHERE id = ?",
+                                   (fetched_at, latest[0]))
+            else:
+                self.index.execute("INSERT INTO pages (url, kind, fetched_at, digest) VALUES (?, ?, ?, ?)",
+                                   (url, kind, fetched_at, digest))
+            self._trim_versions(url, kind)
+            self.index.commit()
+
+            if self.total_bytes > self.max_bytes:
+                self._evict(int(self.max_bytes * 0.9))
+        return digest
+
+    def _trim_versions(self, url, kind):
+        """ Removes all but the max_versions most recently fetched versions of url, and the bodies only they used. """
+        old = self.index.execute(
+            "SELECT id, digest FROM pages WHERE url = ? AND kind = ? ORDER BY fetched_at DESC LIMIT -1 OFFSET ?",
+            (url, kind, self.max_versions)
+        ).fetchall()
+        for page_id, digest in old:
+            self.index.execute("DELETE FROM pages WHERE id = ?", (page_id,))
+            if self.index.execute("SELECT 1 FROM pages WHERE digest = ? LIMIT 1", (digest,)).fetchone() is None:
+                self._remove_object(digest)
+
+    def _remove_object(self, digest):
+        size = self.index.execute("SELECT size FROM objects WHERE digest = ?", (digest,)).fetchone()
+        self.index.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+        try:
+            os.remove(self.object_path(digest))
+        except FileNotFoundError:
+            pass
+        if size is not None:
+            self.total_bytes -= size[0]
+
+    def get(self, url, kind="http"):
+        """ Returns the most recently fetched body of url as text, or None if it is not in the cache. """
+        with self._lock:
+            row = self.index.execute(
+                "SELECT digest FROM pages WHERE url = ? AND kind = ? ORDER BY fetched_at DESC LIMIT 1", (url, kind)
+            ).fetchone()
+        if row is None:
+            return None
+
+        try:
+            with open(self.object_path(row[0]), "rb") as f:
+                return zlib.decompress(f.read()).decode("utf-8")
+        except FileNotFoundError:
+            return None
+
+    def urls(self, kind="http"):
+        """ Yields every url with a body of kind once, in the order they were first fetched. The urls are read
+        URLS_BATCH_SIZE at a time, on their own cursor, so the cache can be used between two of them. """
+        with self._lock:
+            cursor = self.index.execute("SELECT url FROM pages WHERE kind = ? GROUP BY url ORDER BY MIN(id)", (kind,))
+        try:
+            while True:
+                with self._lock:
+                    rows = cursor.fetchmany(URLS_BATCH_SIZE)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row[0]
+        finally:
+            cursor.close()
+
+    def evict(self, target_bytes=None):
+        """ Removes the oldest bodies until at most target_bytes (default max_bytes) are stored. """
+        with self._lock:
+            self._evict(self.max_bytes if target_bytes is None else target_bytes)
+
+    def _evict(self, target_bytes):
+        while self.total_bytes > target_bytes:
+            oldest = self.index.execute("SELECT digest FROM objects ORDER BY stored_at LIMIT 256").fetchall()
+            if not oldest:
+                break
+
+            for (digest,) in oldest:
+                self.index.execute("DELETE FROM pages WHERE digest = ?", (digest,))
+                self._remove_object(digest)
+                if self.total_bytes <= target_bytes:
+                    break
+        self.index.commit()
+
+    def close(self):
+        with self._lock:
+            self.index.close()
@@ -0,0 +1,202 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+import os
+from queue import Empty, Full, Queue
+import sqlite3
+import threading
+
+from selenium.common.exceptions import TimeoutException
+
+from metrics import METRICS
+from utils import CollectionTooLargeException, HostLimiter, HttpError, ThroughputMeter
+from webpages import DEFAULT_PARSER, parse_documents
+
+
+# Marks the end of the work for a stage thread
+STOP = None
+# How often a stage thread that waits on a queue checks whether the pipeline is stopping
+STOP_POLL_SECONDS = 0.1
+
+
+class CrawlPipeline:
+    """ Crawl split into three stages connected by bounded queues, so each stage can be scaled on its own:
+
+    - fetch: fetch_workers threads download pages, and render them with selenium or load collections when needed.
+      I/O bound, so threads are fine.
+    - parse: parse_workers processes read the fields from the downloaded documents. CPU bound, so processes, which
+      lets parsing use all cores.
+    - write: the calling thread is the single sqlite writer. It also feeds the fetch stage from the frontier, so
+      the frontier and logs table are only touched from one thread, and resuming works like for Scraper.start_scrape.
+
+    Every queue holds at most queue_size items. When a later stage falls behind, the queue in front of it fills up
+    and the stage before it blocks, so memory stays bounded. Queue depths are printed with the throughput, a stage
+    with a full queue in front of it is the bottleneck.
+    """
+    def __init__(self, scraper, fetch_workers=16, parse_workers=None, queue_size=64, max_per_host=2,
+                 min_host_delay=0.5, parser=DEFAULT_PARSER):
+        self.scraper = scraper
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers or os.cpu_count()
+        self.queue_size = queue_size
+        self.parser = parser
+        self.limiter = HostLimiter(max_per_host=max_per_host, min_delay=min_host_delay)
+
+        # Urls waiting for a fetch thread
+        self.fetch_queue = Queue(maxsize=queue_size)
+        # Fetched documents waiting for a parse process
+        self.parse_queue = Queue(maxsize=queue_size)
+        # Parse results (futures) and fetch failures waiting for the writer, in the order they were fetched
+        self.write_queue = Queue(maxsize=queue_size)
+        # Set when the crawl ends or fails, every stage thread stops waiting on its queues then
+        self.stopping = threading.Event()
+
+    def stage_depths(self):
+        """ Current amount of items waiting in front of every stage. """
+        return {"fetch": self.fetch_queue.qsize(), "parse": self.parse_queue.qsize(), "write": self.write_queue.qsize()}
+
+    def run(self, url=None):
+        """ Crawls until the frontier is empty. """
+        scraper = self.scraper
+        scraper.seed(url)
+
+        meter = ThroughputMeter(details=lambda: "queue depths " + ", ".join(
+            f"{stage} {depth}/{self.queue_size}" for stage, depth in self.stage_depths().items()
+        ))
+        # Spawn instead of fork, forking while the fetch threads hold locks can deadlock the children
+        parse_pool = ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=get_context("spawn"))
+
+        fetchers = [threading.Thread(target=self.fetch_stage, daemon=True) for _ in range(self.fetch_workers)]
+        dispatcher = threading.Thread(target=self.parse_stage, args=(parse_pool,), daemon=True)
+        for thread in fetchers + [dispatcher]:
+            thread.start()
+
+        # Urls somewhere in the pipeline, they are not handed out again until the writer is done with them
+        in_flight = set()
+        try:
+            while True:
+                # Feed the fetch stage. Never block here, the writer has to keep draining the write queue
+                while not self.fetch_queue.full() and scraper.budget_left(len(in_flight)) and scraper.frontier:
+                    url = scraper.frontier.pop()
+                    if url is None or url in in_flight:
+                        continue
+                    print(f"[{datetime.now()}] Scraping {url}")
+                    self.fetch_queue.put_nowait(url)
+                    in_flight.add(url)
+
+                if not in_flight:
+                    if scraper.budget_left() and scraper.frontier.wait_for_others():
+                        continue
+                    break
+
+                try:
+                    url, result, error = self.write_queue.get(timeout=scraper.database.flush_every_seconds or 1)
+                except Empty:
+                    # Nothing finished, give write-behind a chance to commit on time
+                    scraper.database.commit()
+                    continue
+
+                in_flight.discard(url)
+                self.write_stage(url, result, error, meter)
+        finally:
+            self.stopping.set()
+            # Before anything that could wait on the other threads, so buffered writes are never lost
+            scraper.database.flush()
+            self.stop_threads(fetchers, dispatcher)
+            parse_pool.shutdown(cancel_futures=True)
+
+        meter.report()
+        scraper.http_client.report()
+
+    def stop_threads(self, fetchers, dispatcher):
+        """ Ends the stage threads after stopping is set. Their queues can be full, e.g. after an error or
+        KeyboardInterrupt, so STOP is only delivered where there is room and the queues behind the fetch stage are
+        emptied, which unblocks the threads waiting to put into them. The rest notice stopping within
+        STOP_POLL_SECONDS. Urls still in the pipeline stay unscraped and are claimed again on the next run. """
+        for queue, stops in [(self.fetch_queue, len(fetchers)), (self.parse_queue, 1)]:
+            for _ in range(stops):
+                try:
+                    queue.put_nowait(STOP)
+                except Full:
+                    break
+        for thread in fetchers + [dispatcher]:
+            while thread.is_alive():
+                for queue in [self.parse_queue, self.write_queue]:
+                    self.drain(queue)
+                thread.join(STOP_POLL_SECONDS)
+
+    @staticmethod
+    def drain(queue):
+        """ Throws away everything waiting in queue. """
+        while True:
+            try:
+                queue.get_nowait()
+            except Empty:
+                return
+
+    def get(self, queue):
+        """ Next item of queue, or STOP once the pipeline is stopping. """
+        while not self.stopping.is_set():
+            try:
+                return queue.get(timeout=STOP_POLL_SECONDS)
+            except Empty:
+                pass
+        return STOP
+
+    def put(self, queue, item):
+        """ Puts item in queue, waiting for room unless the pipeline is stopping. Returns whether it was put. """
+        while not self.stopping.is_set():
+            try:
+                queue.put(item, timeout=STOP_POLL_SECONDS)
+                return True
+            except Full:
+                pass
+        return False
+
+    def fetch_stage(self):
+        """ Fetch thread: downloads pages without parsing them. """
+        while True:
+            url = self.get(self.fetch_queue)
+            if url is STOP:
+                return
+
+            self.limiter.acquire(url)
+            try:
+                self.limiter.wait_turn(url)
+                pagetype = self.scraper.get_page_type(url)
+                page = pagetype(url, selenium_driver=self.scraper.driver, http_client=self.scraper.http_client,
+                                parser=self.parser, parse=False)
+                self.put(self.parse_queue, (url, pagetype, page.documents))
+            except Exception as e:
+                # Handled by the writer, like the scrape loops do
+                self.put(self.write_queue, (url, None, e))
+            finally:
+                self.limiter.release(url)
+
+    def parse_stage(self, parse_pool):
+        """ Hands fetched documents to the parse processes. The futures go to the write queue right away, so up to
+        queue_size pages are parsed in parallel, and the writer waits for them in order. """
+        while True:
+            item = self.get(self.parse_queue)
+            if item is STOP:
+                return
+
+            url, pagetype, documents = item
+            if self.stopping.is_set():
+                return
+            self.put(self.write_queue, (url, parse_pool.submit(parse_documents, pagetype, url, documents, self.parser),
+                                        None))
+
+    def write_stage(self, url, result, error, meter):
+        """ Writer: stores a parsed page, or handles the failure of fetching or parsing it. """
+        scraper = self.scraper
+        try:
+            if error is not None:
+                raise error
+            page = result.result()
+            # Parsed in a worker process, which has its own metrics, so its parse time is recorded here
+            METRICS.observe("stage_seconds", page.parse_seconds, stage="parse", page_type=page.page_type)
+            scraper.process_page(url, page)
+            meter.add()
+        except (TimeoutException, CollectionTooLargeException, HttpError, sqlite3.OperationalError) as e:
+            scraper.page_failed(url, e)
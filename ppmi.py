@@ -0,0 +1,226 @@
+from datetime import datetime
+import os
+import sys
+import time
+
+import numpy as np
+from scipy import sparse
+
+from corpus import Corpus
+from embeddings import Embeddings
+
+
+class PPMISVD:
+    """ Deterministic alternative to album2vec: album vectors from the truncated SVD of the positive pointwise
+    mutual information (PPMI) of how often two albums are in the same collection.
+
+    Counting: every pair of albums in a collection is one co-occurrence. A collection of n albums has n * (n - 1)
+    pairs, so collections larger than max_collection_size are cut down to a random max_collection_size albums,
+    otherwise a few huge collections would dominate the matrix. Albums in fewer than min_count collections are
+    left out. The corpus is read in blocks of at most chunk_pairs pairs, which are added to a scipy CSR matrix.
+
+    Weighting: PPMI(a, b) = max(log(P(a, b) / (P(a) P_0.75(b))) - log(shift), 0), with the context distribution
+    smoothed to the power 0.75 like word2vec's negatives.
+
+    Factorization: randomized SVD (Halko et al.) with oversample extra dimensions and power_iterations, the album
+    vectors are U * S ** eigenvalue_weight.
+
+    The matrix is built and used in bands of band_albums rows. By default there is one band in memory. With
+    band_albums and a directory, every band is written to the directory after it's built and only one band is in
+    memory at a time, so the matrix can be larger than memory; the corpus is then read once per band.
+    """
+    def __init__(self, dim=100, min_count=2, max_collection_size=1000, shift=1.0, context_smoothing=0.75,
+                 oversample=10, power_iterations=4, eigenvalue_weight=0.5, band_albums=None, chunk_pairs=10_000_000,
+                 seed=1):
+        self.dim = dim
+        self.min_count = min_count
+        self.max_collection_size = max_collection_size
+        self.shift = shift
+        self.context_smoothing = context_smoothing
+        self.oversample = oversample
+        self.power_iterations = power_iterations
+        self.eigenvalue_weight = eigenvalue_weight
+        self.band_albums = band_albums
+        self.chunk_pairs = chunk_pairs
+        self.seed = seed
+
+    def settings(self):
+        return {name: getattr(self, name) for name in ["dim", "min_count", "max_collection_size", "shift",
+                                                       "context_smoothing", "oversample", "power_iterations",
+                                                       "eigenvalue_weight"]}
+
+    def train(self, corpus, directory=None):
+        """ Computes vectors for the albums in corpus (a Corpus or the directory of one), returns Embeddings. Bands
+        are kept in directory if one is given. """
+        if not isinstance(corpus, Corpus):
+            corpus = Corpus(corpus)
+        started = time.monotonic()
+
+        album_ids = np.flatnonzero(corpus.album_counts() >= self.min_count)
+        if len(album_ids) <= self.dim:
+            raise ValueError(f"Need more than {self.dim} albums in at least {self.min_count} collections, "
+                             f"got {len(album_ids)}")
+        index_of = np.full(corpus.meta["max_album_id"] + 1, -1, dtype=np.int64)
+        index_of[album_ids] = np.arange(len(album_ids))
+        blocks = self.blocks(corpus)
+
+        # Every album is in a pair with all other albums of its (capped) collections, so these are the row sums
+        pair_counts = np.zeros(len(album_ids))
+        for block in range(len(blocks)):
+            tokens, lengths = self.block_tokens(corpus, blocks, block, index_of)
+            pair_counts += np.bincount(tokens, weights=np.repeat(lengths - 1, lengths), minlength=len(album_ids))
+
+        band_size = self.band_albums or len(album_ids)
+        bands = Bands(directory)
+        for start in range(0, len(album_ids), band_size):
+            end = min(start + band_size, len(album_ids))
+            counts = self.count_band(corpus, blocks, index_of, start, end, len(album_ids))
+            bands.append(self.ppmi(counts, pair_counts, start))
+            print(f"[{datetime.now()}] PPMI rows {end:,}/{len(album_ids):,}, {bands.nnz:,} non-zero")
+
+        vectors = self.randomized_svd(bands, len(album_ids))
+        elapsed = time.monotonic() - started
+        print(f"[{datetime.now()}] Factorized {len(album_ids):,} x {len(album_ids):,} PPMI matrix with "
+              f"{bands.nnz:,} non-zero in {elapsed:.1f}s")
+
+        return Embeddings(album_ids, vectors, dict(
+            self.settings(),
+            method="ppmi",
+            trained_at=datetime.now().isoformat(timespec="seconds"),
+            corpus_sentences=len(corpus),
+            corpus_max_user_id=corpus.max_user_id,
+            nnz=bands.nnz,
+        ))
+
+    def blocks(self, corpus):
+        """ (first, last) collection ranges with at most chunk_pairs pairs each, after capping. """
+        lengths = np.minimum(corpus.sentence_lengths(), self.max_collection_size)
+        pairs = np.cumsum(lengths * (lengths - 1))
+        bounds, first = [0], 0
+        while first < len(corpus):
+            last = int(np.searchsorted(pairs, (pairs[first - 1] if first else 0) + self.chunk_pairs, side="right"))
+            first = max(last, first + 1)
+            bounds.append(min(first, len(corpus)))
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def block_tokens(self, corpus, blocks, block, index_of):
+        """ Album indices of the collections in a block grouped by collection, and the length of every collection,
+        after leaving out unknown albums and capping. The cap picks the same albums every time a block is read. """
+        first, last = blocks[block]
+        album_ids = np.asarray(corpus.tokens[corpus.offsets[first]:corpus.offsets[last]])
+        sentence_ids = np.repeat(np.arange(last - first), np.diff(corpus.offsets[first:last + 1]))
+        tokens = index_of[album_ids]
+        known = tokens >= 0
+        tokens, sentence_ids = tokens[known], sentence_ids[known]
+
+        # Shuffle within every collection and keep the first max_collection_size albums
+        rng = np.random.RandomState([self.seed, block])
+        order = np.lexsort((rng.random_sample(len(tokens)), sentence_ids))
+        tokens, sentence_ids = tokens[order], sentence_ids[order]
+        lengths = np.bincount(sentence_ids, minlength=last - first)
+        rank = np.arange(len(tokens)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        kept = rank < self.max_collection_size
+        return tokens[kept], np.minimum(lengths, self.max_collection_size)
+
+    def count_band(self, corpus, blocks, index_of, start, end, size):
+        """ Co-occurrence counts of the albums start to end (rows) with all size albums (columns), as CSR. """
+        shape = (end - start, size)
+        # Partial sums as (amount of blocks, counts), added like a binary counter: whenever the last two cover
+        # the same amount of blocks they are summed. Adding every block to a running total would copy the total
+        # for every block, which is quadratic in the amount of blocks, keeping every block until the end would keep
+        # all pairs of the corpus in memory. This way O(log blocks) partial sums are alive at a time
+        partial = []
+        for block in range(len(blocks)):
+            tokens, lengths = self.block_tokens(corpus, blocks, block, index_of)
+            lengths = lengths[lengths > 0]
+            # Every album of a collection against every album of the same collection
+            repeats = np.repeat(lengths, lengths)
+            starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+            rows = np.repeat(np.arange(len(tokens)), repeats)
+            columns = np.repeat(starts, repeats) + np.arange(len(rows)) - np.repeat(np.cumsum(repeats) - repeats,
+                                                                                     repeats)
+            pairs = (rows != columns) & (tokens[rows] >= start) & (tokens[rows] < end)
+            rows, columns = tokens[rows[pairs]] - start, tokens[columns[pairs]]
+            partial.append((1, sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=shape)))
+            while len(partial) > 1 and partial[-1][0] == partial[-2][0]:
+                (amount, last), (_, before) = partial.pop(), partial.pop()
+                partial.append((2 * amount, before + last))
+
+        counts = sparse.csr_matrix(shape, dtype=np.float32)
+        for _, block_counts in partial:
+            counts = counts + block_counts
+        return counts
+
+    def ppmi(self, counts, pair_counts, start):
+        """ Turns a band of co-occurrence counts into PPMI, in place. """
+        context = pair_counts ** self.context_smoothing
+        context /= context.sum()
+        rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr)) + start
+        # log(P(a, b) / (P(a) P_0.75(b))), the total amount of pairs cancels out of the first two
+        pmi = np.log(counts.data) - np.log(pair_counts[rows]) - np.log(context[counts.indices]) - np.log(self.shift)
+        counts.data = np.maximum(pmi, 0).astype(np.float32)
+        counts.eliminate_zeros()
+        return counts
+
+    def randomized_svd(self, bands, size):
+        """ U * S ** eigenvalue_weight of the truncated SVD of the matrix in bands. Only needs products with the
+        matrix and its transpose, which are computed one band at a time. """
+        rng = np.random.RandomState(self.seed)
+        samples = min(self.dim + self.oversample, size)
+        basis = orthonormal(bands.dot(rng.standard_normal((size, samples)).astype(np.float32)))
+        for _ in range(self.power_iterations):
+            basis = orthonormal(bands.dot(orthonormal(bands.transpose_dot(basis))))
+
+        # Small SVD of basis.T @ matrix, then back to the full space
+        u, s, _ = np.linalg.svd(bands.transpose_dot(basis).T, full_matrices=False)
+        return (basis @ u[:, :self.dim]) * s[:self.dim] ** self.eigenvalue_weight
+
+
+def orthonormal(matrix):
+    return np.linalg.qr(matrix)[0].astype(np.float32)
+
+
+class Bands:
+    """ The rows of a sparse matrix in bands, kept in memory or, with a directory, on disk. """
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.bands = []
+        self.nnz = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def append(self, band):
+        self.nnz += band.nnz
+        if self.directory is None:
+            self.bands.append(band)
+        else:
+            path = os.path.join(self.directory, f"band_{len(self.bands)}.npz")
+            sparse.save_npz(path, band)
+            self.bands.append(path)
+
+    def __iter__(self):
+        for band in self.bands:
+            yield sparse.load_npz(band) if self.directory is not None else band
+
+    def dot(self, matrix):
+        """ self @ matrix """
+        return np.concatenate([band @ matrix for band in self])
+
+    def transpose_dot(self, matrix):
+        """ self.T @ matrix """
+        result, start = None, 0
+        for band in self:
+            product = band.T @ matrix[start:start + band.shape[0]]
+            result = product if result is None else result + product
+            start += band.shape[0]
+        return result
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python ppmi.py <corpus directory> <embeddings.npz>")
+        sys.exit(1)
+
+    embeddings = PPMISVD().train(sys.argv[1])
+    embeddings.save(sys.argv[2])
+    print(f"Saved {len(embeddings):,} album vectors to {sys.argv[2]}")
@@ -1,8 +1,4 @@
-ARTIST_ID_QUERY = "SELECT id FROM artist WHERE url = '{artist_url}'"
-
-ALBUM_ID_QUERY = "SELECT id FROM album WHERE url = '{album_url}'"
-
-USER_ID_QUERY = "SELECT id FROM user WHERE url = '{user_url}'"
+IDS_BY_URL_QUERY = "SELECT id, url FROM {table} WHERE url IN ({placeholders})"
 
 CREATE_TABLE_ALBUM = """
 CREATE TABLE album (
@@ -29,11 +25,25 @@ CREATE TABLE artist (
 );
 """
 
+# state is 0 for pending, 1 for done and 2 for leased: claimed by the crawl process lease_owner until lease_expires
+# (unix time). Done is 1 so databases from when this was a scraped boolean keep their meaning. priority is the
+# expected yield of the page according to the crawl scheduler, higher is claimed first (see scheduler.py).
+# fingerprint is urls.fingerprint of the canonical url, as stored by urls.stored_fingerprint, so the frontier loads
+# the urls it knows without hashing them.
+# fetched_at is when the page was last scraped. Pages that are refreshed (user pages) are scraped again at
+# refresh_at, refresh_interval seconds after the last time, see Scraper.refresh
 CREATE_TABLE_LOGS = """
 CREATE TABLE logs (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     url varchar(128) NOT NULL UNIQUE,
-    scraped BOOLEAN NOT NULL DEFAULT 0
+    state INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    priority REAL NOT NULL DEFAULT 0,
+    fetched_at REAL,
+    refresh_interval REAL,
+    refresh_at REAL,
+    fingerprint INTEGER
 );
 """
 
@@ -45,57 +55,270 @@ CREATE TABLE user (
 );
 """
 
+# Without rowid the rows are stored in the primary key b-tree itself, which is ordered by (user_id, album_id).
+# A collection is then one range of the table, and the table doesn't need a separate index for the unique constraint
 CREATE_TABLE_USER_SUPPORTS = """
-CREATE TABLE user_supports (
+CREATE TABLE {table} (
     user_id INTEGER NOT NULL,
     album_id INTEGER NOT NULL,
-    UNIQUE(user_id, album_id)
+    PRIMARY KEY (user_id, album_id)
+) WITHOUT ROWID;
+"""
+
+# Tag names, normalized with bandcamp_db.normalize_tag
+CREATE_TABLE_TAG = """
+CREATE TABLE tag (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name varchar(64) NOT NULL UNIQUE
+);
+"""
+
+# Tags of every album. Ordered by tag first, so all albums with a tag are one range of the table
+CREATE_TABLE_ALBUM_TAG = """
+CREATE TABLE album_tag (
+    tag_id INTEGER NOT NULL,
+    album_id INTEGER NOT NULL,
+    PRIMARY KEY (tag_id, album_id)
+) WITHOUT ROWID;
+"""
+
+CREATE_TABLE_SCHEMA_VERSION = """
+CREATE TABLE schema_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
 );
 """
 
+# Who supports an album, covering so it never touches the table
+CREATE_INDEX_USER_SUPPORTS_ALBUM = "CREATE INDEX IF NOT EXISTS user_supports_album ON user_supports (album_id, user_id)"
+
+# Only the urls that are not done, stays small however many pages were scraped
+CREATE_INDEX_LOGS_PENDING = "CREATE INDEX IF NOT EXISTS logs_pending ON logs (id) WHERE state != 1"
+
+# Urls that are not done by priority, to claim the highest ones
+CREATE_INDEX_LOGS_PRIORITY = "CREATE INDEX IF NOT EXISTS logs_priority ON logs (priority DESC, id) WHERE state != 1"
+
+# Scraped pages by when they are due for a refresh
+CREATE_INDEX_LOGS_REFRESH = "CREATE INDEX IF NOT EXISTS logs_refresh ON logs (refresh_at) WHERE refresh_at IS NOT NULL"
+
+# The urls leased by a crawl process, to renew or release them
+CREATE_INDEX_LOGS_LEASES = "CREATE INDEX IF NOT EXISTS logs_leases ON logs (lease_owner) WHERE state = 2"
+
+CREATE_INDEX_ALBUM_METADATA_ARTIST = "CREATE INDEX IF NOT EXISTS album_metadata_artist ON album_metadata (artist_id)"
+
+# Albums by release year, to combine tag filters with a year range
+CREATE_INDEX_ALBUM_METADATA_YEAR = "CREATE INDEX IF NOT EXISTS album_metadata_year ON album_metadata (year)"
+
+# The tags of an album, covering like user_supports_album
+CREATE_INDEX_ALBUM_TAG_ALBUM = "CREATE INDEX IF NOT EXISTS album_tag_album ON album_tag (album_id, tag_id)"
+
+TABLE_EXISTS_QUERY = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?"
+
+SCHEMA_VERSION_QUERY = "SELECT version FROM schema_version WHERE id = 1"
+
+# Statements that create the tables and indexes of a database, in the order they were created. Leaves out what
+# sqlite makes itself: the indexes of unique constraints, sqlite_sequence and the ANALYZE statistics
+SCHEMA_SQL_QUERY = "SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY rowid"
+
+SET_SCHEMA_VERSION_QUERY = "INSERT OR REPLACE INTO schema_version (id, version) VALUES (1, ?)"
+
+COPY_USER_SUPPORTS_QUERY = """
+INSERT OR IGNORE INTO user_supports_new (user_id, album_id)
+SELECT user_id, album_id FROM user_supports
+ORDER BY user_id, album_id
+"""
+
+DROP_USER_SUPPORTS_QUERY = "DROP TABLE user_supports"
+
+RENAME_USER_SUPPORTS_QUERY = "ALTER TABLE user_supports_new RENAME TO user_supports"
+
+RENAME_LOGS_SCRAPED_QUERY = "ALTER TABLE logs RENAME COLUMN scraped TO state"
+
+ADD_LOGS_LEASE_OWNER_QUERY = "ALTER TABLE logs ADD COLUMN lease_owner TEXT"
+
+ADD_LOGS_LEASE_EXPIRES_QUERY = "ALTER TABLE logs ADD COLUMN lease_expires REAL"
+
+DROP_INDEX_LOGS_PENDING = "DROP INDEX IF EXISTS logs_pending"
+
+ADD_LOGS_PRIORITY_QUERY = "ALTER TABLE logs ADD COLUMN priority REAL NOT NULL DEFAULT 0"
+
+ADD_LOGS_FETCHED_AT_QUERY = "ALTER TABLE logs ADD COLUMN fetched_at REAL"
+
+ADD_LOGS_REFRESH_INTERVAL_QUERY = "ALTER TABLE logs ADD COLUMN refresh_interval REAL"
+
+ADD_LOGS_REFRESH_AT_QUERY = "ALTER TABLE logs ADD COLUMN refresh_at REAL"
+
+ADD_LOGS_FINGERPRINT_QUERY = "ALTER TABLE logs ADD COLUMN fingerprint INTEGER"
+
+# Batch of logs rows after an id, for backfilling their fingerprints
+LOGS_URLS_AFTER_ID_QUERY = "SELECT id, url FROM logs WHERE id > ? ORDER BY id LIMIT ?"
+
+SET_LOGS_FINGERPRINT_QUERY = "UPDATE logs SET fingerprint = ? WHERE id = ?"
+
+# User pages scraped before there were refreshes are all due right away. User pages are the only ones on bandcamp.com
+# itself, artists have their own subdomain
+SCHEDULE_USER_REFRESHES_QUERY = """
+UPDATE logs SET refresh_at = 0
+WHERE state = 1 AND url LIKE 'https://bandcamp.com/_%'
+"""
+
 INSERT_ALBUM_QUERY = """
 INSERT OR IGNORE INTO album (url)
-VALUES ('{album_url}')
+VALUES (?)
 """
 
 INSERT_ALBUM_METADATA_QUERY = """
 INSERT OR IGNORE INTO album_metadata (id, artist_id, name, year, tags)
-VALUES ({album_id}, {artist_id}, '{album_name}', {year}, '{tags}')
+VALUES (?, ?, ?, ?, ?)
 """
 
 INSERT_ARTIST_QUERY = """
 INSERT OR IGNORE INTO artist (name, url)
-VALUES ('{artist_name}', '{artist_url}')
+VALUES (?, ?)
 """
 
 INSERT_LOGS_QUERY = """
-INSERT OR IGNORE INTO logs (url)
-VALUES {urls}
+INSERT OR IGNORE INTO logs (url, fingerprint)
+VALUES (?, ?)
+"""
+
+# Adds an url with a priority, or raises the priority of an url that is known but not scraped yet
+PUSH_LOGS_PRIORITY_QUERY = """
+INSERT INTO logs (url, fingerprint, priority)
+VALUES (?, ?, ?)
+ON CONFLICT (url) DO UPDATE SET priority = priority + excluded.priority WHERE state != 1
+"""
+
+INSERT_TAG_QUERY = """
+INSERT OR IGNORE INTO tag (name)
+VALUES (?)
+"""
+
+INSERT_ALBUM_TAG_QUERY = """
+INSERT OR IGNORE INTO album_tag (tag_id, album_id)
+VALUES (?, ?)
 """
 
 INSERT_USER_QUERY = """
 INSERT OR IGNORE INTO user (name, url)
-VALUES ('{username}', '{user_url}')
+VALUES (?, ?)
 """
 
 INSERT_USER_SUPPORTS_QUERY = """
 INSERT OR IGNORE INTO user_supports (user_id, album_id)
-VALUES ({user_id}, {album_id})
+VALUES (?, ?)
 """
 
 UPDATE_LOGS_TABLE = """
 UPDATE logs
-SET scraped = 1
-WHERE url = '{url}'
+SET state = 1, lease_owner = NULL, lease_expires = NULL, fetched_at = ?, refresh_interval = ?, refresh_at = ?
+WHERE url = ?
+"""
+
+# Marks a claimed url as done without a fetch, for variants of an url that is scraped under another logs row
+SKIP_LOGS_URL_QUERY = """
+UPDATE logs
+SET state = 1, lease_owner = NULL, lease_expires = NULL
+WHERE url = ? AND state != 1
 """
 
-VISITED_URLS_QUERY = """
-SELECT url FROM logs
-WHERE scraped = 1
+# Scraped pages whose refresh is due, the longest overdue first
+REFRESH_DUE_QUERY = """
+SELECT id, url, refresh_interval FROM logs
+WHERE refresh_at IS NOT NULL AND refresh_at <= ?
+ORDER BY refresh_at ASC
+LIMIT ?
 """
 
-TO_VISIT_URLS_QUERY = """
-SELECT url FROM logs
-WHERE scraped = 0
+SCHEDULE_REFRESH_QUERY = "UPDATE logs SET fetched_at = ?, refresh_interval = ?, refresh_at = ? WHERE id = ?"
+
+# Album urls in the collection of a user
+USER_COLLECTION_URLS_QUERY = """
+SELECT album.url FROM user
+JOIN user_supports ON user_supports.user_id = user.id
+JOIN album ON album.id = user_supports.album_id
+WHERE user.url = ?
+"""
+
+URL_SCRAPED_QUERY = "SELECT state = 1 FROM logs WHERE url = ?"
+
+# The url is only needed for rows without a fingerprint
+LOGS_FINGERPRINTS_QUERY = "SELECT fingerprint, state, CASE WHEN fingerprint IS NULL THEN url END FROM logs"
+
+# Pending and leased urls, both still have to be scraped
+PENDING_URLS_COUNT_QUERY = "SELECT COUNT(*) AS count FROM logs WHERE state != 1"
+
+# Urls that can be claimed: pending, or leased by a process that didn't renew its lease in time. The state != 1 term
+# lets sqlite use the logs_pending partial index
+CLAIMABLE_URLS_QUERY = """
+SELECT id, url, state FROM logs
+WHERE state != 1 AND (state = 0 OR lease_expires < ?)
 ORDER BY id ASC
+LIMIT ?
+"""
+
+# Same, highest priority first
+CLAIMABLE_URLS_BY_PRIORITY_QUERY = """
+SELECT id, url, state FROM logs
+WHERE state != 1 AND (state = 0 OR lease_expires < ?)
+ORDER BY priority DESC, id ASC
+LIMIT ?
 """
+
+LEASE_URL_QUERY = "UPDATE logs SET state = 2, lease_owner = ?, lease_expires = ? WHERE id = ?"
+
+RENEW_LEASES_QUERY = "UPDATE logs SET lease_expires = ? WHERE state = 2 AND lease_owner = ?"
+
+# Whether another crawl process still has urls leased, expired leases don't count
+OTHER_LEASES_QUERY = "SELECT 1 FROM logs WHERE state = 2 AND lease_owner != ? AND lease_expires >= ? LIMIT 1"
+
+RELEASE_LEASES_QUERY = "UPDATE logs SET state = 0, lease_owner = NULL, lease_expires = NULL WHERE state = 2 AND lease_owner = ?"
+
+USER_SUPPORTS_AFTER_USER_QUERY = """
+SELECT user_id, album_id FROM user_supports
+WHERE user_id > ?
+ORDER BY user_id ASC, album_id ASC
+"""
+
+ALBUM_DETAILS_QUERY = """
+SELECT album.id, album.url, album_metadata.name, album_metadata.year, album_metadata.tags, artist.name, artist.url
+FROM album
+LEFT JOIN album_metadata ON album_metadata.id = album.id
+LEFT JOIN artist ON artist.id = album_metadata.artist_id
+WHERE album.id IN ({placeholders})
+"""
+
+ALBUM_SUPPORTERS_QUERY = "SELECT user_id FROM user_supports WHERE album_id = ?"
+
+TAG_IDS_BY_NAME_QUERY = "SELECT id, name FROM tag WHERE name IN ({placeholders})"
+
+# Ids as one comma separated string, turning that into an array is several times faster than reading a row per id
+TAGGED_ALBUMS_QUERY = "SELECT group_concat(album_id) FROM album_tag WHERE tag_id = ?"
+
+ALBUMS_BY_YEAR_QUERY = "SELECT group_concat(id) FROM album_metadata WHERE year BETWEEN ? AND ?"
+
+# Albums with a tag released in a range of years, from the albums of the tag, for when the tag has fewer albums
+TAGGED_ALBUMS_IN_YEARS_QUERY = """
+SELECT group_concat(album_tag.album_id) FROM album_tag
+JOIN album_metadata ON album_metadata.id = album_tag.album_id
+WHERE album_tag.tag_id = ? AND album_metadata.year BETWEEN ? AND ?
+"""
+
+# Same, from the albums of the years, for when the years have fewer albums. CROSS JOIN makes sqlite read
+# album_metadata first
+YEAR_ALBUMS_WITH_TAG_QUERY = """
+SELECT group_concat(album_metadata.id) FROM album_metadata
+CROSS JOIN album_tag ON album_tag.album_id = album_metadata.id AND album_tag.tag_id = ?
+WHERE album_metadata.year BETWEEN ? AND ?
+"""
+
+# Amount of albums with a tag or released in a range of years, counting stops at the last parameter
+TAGGED_ALBUMS_COUNT_QUERY = "SELECT COUNT(*) FROM (SELECT 1 FROM album_tag WHERE tag_id = ? LIMIT ?)"
+
+ALBUMS_BY_YEAR_COUNT_QUERY = "SELECT COUNT(*) FROM (SELECT 1 FROM album_metadata WHERE year BETWEEN ? AND ? LIMIT ?)"
+
+ALBUM_METADATA_TAGS_QUERY = "SELECT id, tags FROM album_metadata WHERE tags IS NOT NULL AND tags != ''"
+
+TABLE_COUNT_QUERY = "SELECT COUNT(*) FROM {table}"
+
+TABLE_MAX_ROWID_QUERY = "SELECT COALESCE(MAX(rowid), 0) FROM {table}"
@@ -0,0 +1,91 @@
+""" Crawl order and crawl budgets.
+
+A scheduler decides which urls the Frontier claims first. When a page is written, the scheduler gives every url it
+links to a priority, which is added to the url's logs.priority, so an url that is linked from many pages adds up.
+The Frontier then claims the urls with the highest priority, except for an exploration share of every batch, which
+is claimed in the order the urls were found so no url waits forever.
+
+What the embeddings are trained on is the user-album links, one per album in a scraped collection, so the yield
+of a page is the amount of those links it brings, directly or through the pages it leads to.
+"""
+import time
+
+
+class FifoScheduler:
+    """ Urls are scraped in the order they were found, the crawl order from before there were schedulers. """
+    name = "fifo"
+    # Everything is claimed in logs order
+    exploration = 1.0
+
+    def priorities(self, page, links):
+        """ Priority to add for every url in links, found on page. None means links only have to be added. """
+        return None
+
+
+class YieldScheduler:
+    """ Scrapes the pages that are expected to bring the most user-album links first.
+
+    - User pages are where the links come from, a user linked from an album page gets user_weight. Every album
+      page a user is a supporter on adds it again, so the priority of a user grows with the amount of their albums
+      that are already known, which is a lower bound on their collection size.
+    - An album found in a collection gets album_weight, so the priority of an album grows with the amount of
+      supporters seen so far. Popular albums lead to many users, but album pages bring no links themselves, so
+      the weight is small enough that users go first.
+    - Albums found on artist pages get artist_album_weight, they are usually found in collections as well.
+
+    exploration is the share of every claimed batch that is taken in the order the urls were found instead.
+    """
+    name = "yield"
+
+    def __init__(self, exploration=0.1, user_weight=1.0, album_weight=0.01, artist_album_weight=0.01):
+        self.exploration = exploration
+        self.weights = {
+            "AlbumPage": user_weight,
+            "UserPage": album_weight,
+            "ArtistPage": artist_album_weight,
+        }
+
+    def priorities(self, page, links):
+        return [self.weights[page.page_type]] * len(links)
+
+
+# Schedulers by name, for main.SCHEDULER
+SCHEDULERS = {scheduler.name: scheduler for scheduler in [FifoScheduler, YieldScheduler]}
+
+
+class CrawlBudget:
+    """ Stops a crawl after pages scraped pages or seconds seconds, whichever comes first, None is no limit. The
+    time counts from when the budget is made. """
+    def __init__(self, pages=None, seconds=None):
+        self.pages = pages
+        self.seconds = seconds
+        self.started = time.monotonic()
+        self.pages_done = 0
+
+    def page_done(self):
+        self.pages_done += 1
+
+    def left(self, in_flight=0):
+        """ Whether another page can be started while in_flight pages are still being scraped. """
+        if self.pages is not None and self.pages_done + in_flight >= self.pages:
+            return False
+        return self.seconds is None or time.monotonic() - self.started < self.seconds
+
+
+class RefreshSchedule:
+    """ How often a scraped user page is scraped again for new purchases. A page starts at initial seconds between
+    refreshes. A refresh that finds new albums halves the interval, one that finds nothing makes it grow by half,
+    within minimum and maximum, so active collectors are refreshed often and dormant ones rarely. """
+    def __init__(self, initial=7 * 86400, minimum=86400, maximum=180 * 86400):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def next_interval(self, interval, changed):
+        """ Seconds until the next refresh, after a refresh interval seconds after the last one. Pages scraped
+        before there were refreshes have no interval, they start at initial. """
+        if interval is None:
+            interval = self.initial
+        if changed:
+            return max(self.minimum, interval / 2)
+        return min(self.maximum, interval * 1.5)
@@ -1,127 +1,443 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import datetime
-import re
+import sqlite3
+import threading
+import time
 
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.chrome.options import Options
 
-from queries import INSERT_LOGS_QUERY, TO_VISIT_URLS_QUERY, UPDATE_LOGS_TABLE, VISITED_URLS_QUERY
-from utils import CollectionTooLargeException
+from frontier import Frontier
+from http_client import HttpClient
+from metrics import METRICS
+from scheduler import RefreshSchedule
+from urls import ALBUM_URL, ARTIST_URL, USER_URL, canonicalize
+from utils import CollectionTooLargeException, HostLimiter, HttpError, ThroughputMeter
 from webpages import AlbumPage, ArtistPage, UserPage
 
 
+# Seconds between two counts of the pending urls for the frontier_pending metric
+FRONTIER_COUNT_EVERY = 30
+
+
 class SeleniumDriver:
-    def __init__(self, path_to_driver="chromedriver.exe"):
+    def __init__(self, path_to_driver="chromedriver.exe", page_load_timeout=60):
         self.path_to_driver = path_to_driver
         self.options = Options()
         self.options.add_argument("--headless")
         self.options.add_experimental_option("excludeSwitches", ["enable-logging"])
 
         self.driver = webdriver.Chrome(executable_path=self.path_to_driver, options=self.options)
+        self.driver.set_page_load_timeout(page_load_timeout)
+
+        # A single browser can only render one page at a time
+        self.lock = threading.Lock()
+        # Pages rendered by this browser, used by SeleniumDriverPool to recycle browsers before they use too much memory
+        self.pages = 0
+
+    @contextmanager
+    def acquire(self):
+        """ Gives exclusive use of the browser for the duration of the with block. """
+        with self.lock:
+            yield self
+            self.pages += 1
+
+    def is_healthy(self, timeout=10):
+        """ Checks whether the browser still responds within timeout seconds. """
+        checker = ThreadPoolExecutor(max_workers=1)
+        try:
+            return checker.submit(self.driver.execute_script, "return 1").result(timeout=timeout) == 1
+        except Exception:
+            return False
+        finally:
+            # Don't wait for a hung check, the browser gets killed anyway
+            checker.shutdown(wait=False)
+
+    def quit(self):
+        """ Closes the browser, kills the chromedriver process if it doesn't respond. """
+        try:
+            self.driver.quit()
+        except Exception:
+            self.driver.service.process.kill()
+
+
+class SeleniumDriverPool:
+    """ Pool of headless browsers with the same acquire() interface as SeleniumDriver, so pages that need selenium
+    can render in parallel.
+
+    Browsers are only started when a page needs one, up to size browsers. Before a browser is handed out, and after
+    a page using it raised an exception, it has to pass a health check. A browser that crashed or hangs is killed
+    and replaced by a new one. Browsers are also replaced after max_pages_per_driver pages, as Chrome keeps growing
+    in memory the longer it runs.
+    """
+    def __init__(self, size=2, path_to_driver="chromedriver.exe", max_pages_per_driver=200, health_check_timeout=10):
+        self.size = size
+        self.path_to_driver = path_to_driver
+        self.max_pages_per_driver = max_pages_per_driver
+        self.health_check_timeout = health_check_timeout
+
+        self._available = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._drivers = []
+        self.restarts = 0
+
+    @contextmanager
+    def acquire(self):
+        """ Gives exclusive use of one of the browsers for the duration of the with block. Blocks while all
+        browsers are in use. """
+        with self._available:
+            selenium_driver = self._take()
+            try:
+                with selenium_driver.acquire():
+                    yield selenium_driver
+            except BaseException:
+                # Page specific exceptions (e.g. a button that doesn't load) leave the browser working, but a crash or
+                # hang also shows up as an exception here, so check before giving the browser to the next page
+                if not selenium_driver.is_healthy(self.health_check_timeout):
+                    self._discard(selenium_driver)
+                    selenium_driver = None
+                raise
+            finally:
+                if selenium_driver is not None:
+                    self._give_back(selenium_driver)
+
+    def _take(self):
+        with self._lock:
+            selenium_driver = self._idle.pop() if self._idle else None
+
+        if selenium_driver is not None and not selenium_driver.is_healthy(self.health_check_timeout):
+            print(f"[{datetime.now()}] Browser not responding, restarting it")
+            self._discard(selenium_driver)
+            selenium_driver = None
+
+        if selenium_driver is None:
+            selenium_driver = SeleniumDriver(path_to_driver=self.path_to_driver)
+            with self._lock:
+                self._drivers.append(selenium_driver)
+        return selenium_driver
+
+    def _give_back(self, selenium_driver):
+        if selenium_driver.pages >= self.max_pages_per_driver:
+            self._discard(selenium_driver)
+        else:
+            with self._lock:
+                self._idle.append(selenium_driver)
+
+    def _discard(self, selenium_driver):
+        with self._lock:
+            self._drivers.remove(selenium_driver)
+            self.restarts += 1
+        selenium_driver.quit()
+
+    def quit(self):
+        """ Closes all browsers. """
+        with self._lock:
+            drivers, self._drivers, self._idle = self._drivers, [], []
+        for selenium_driver in drivers:
+            selenium_driver.quit()
 
 
 class Scraper:
-    def __init__(self, database):
-        self.driver = SeleniumDriver()
+    def __init__(self, database, selenium_drivers=2, page_cache=None, scheduler=None, budget=None,
+                 refresh_schedule=None):
+        # Browsers are started lazily, only pages that need selenium cause one to be started
+        self.driver = SeleniumDriverPool(size=selenium_drivers)
         self.database = database
+        # Keep-alive connections, compression and retries shared by all pages. With a page cache every fetched
+        # and rendered page body is also kept on disk, see rebuild_from_cache
+        self.page_cache = page_cache
+        self.http_client = HttpClient(page_cache=page_cache)
 
-        # Urls to visit
-        self.stack = []
-
-        # Load urls of visited pages from database so we can skip them if we see them again
-        # Also use sets instead of lists as order doesnt matter, but speed of value in operation does
-        visited_urls = [row["url"] for row in self.database.select(VISITED_URLS_QUERY)]
-        self.visited = set(visited_urls)
+        # Urls to visit, claimed from the logs table in batches. Also answers whether a url was already scraped,
+        # from compact url fingerprints instead of a set of every visited url
+        self.frontier = Frontier(self.database, scheduler=scheduler)
+        # Optional CrawlBudget, the crawl stops when it is spent
+        self.budget = budget
+        # When user pages are scraped again for new purchases, see refresh
+        self.refresh_schedule = refresh_schedule if refresh_schedule is not None else RefreshSchedule()
+        # When the pending urls were last counted for the metrics
+        self.frontier_counted = float("-inf")
 
+    def seed(self, url=None):
+        """ Schedules url before all unvisited urls from the log table. Without url the crawl just resumes
+        from the log table. """
+        if url is not None:
+            self.frontier.push_front([url])
 
     def start_scrape(self, url=None):
-        """ """
-        # Fill stack with unvisited urls from log table
-        if url is None:
-            self.stack = [row["url"] for row in self.database.select(TO_VISIT_URLS_QUERY)]
-        # Add passed url to empty stack and start from there
-        else:
-            self.stack.append(url)
+        """ Scrapes pages one by one until the frontier is empty. """
+        self.seed(url)
+        meter = ThroughputMeter()
 
-        while self.stack:
-            url = self.stack.pop(0)
-            print(f"[{datetime.now()}] Scraping {url}")
+        # Pending writes are flushed also when the crawl is interrupted, e.g. by KeyboardInterrupt or SIGTERM
+        try:
+            while self.budget_left() and (self.frontier or self.frontier.wait_for_others()):
+                # None when the rest of the batch was scraped already
+                url = self.frontier.pop()
+                if url is None:
+                    continue
+                print(f"[{datetime.now()}] Scraping {url}")
 
-            if url not in self.visited:
-                pagetype = self.get_page_type(url)
                 try:
-                    page = pagetype(url, selenium_driver=self.driver)
-
-                    # Write page data to database, functionality differs for every page type,
-                    # but function call is the same
-                    page.write_to_database(self.database)
-
-                    # Depending on page type decide what urls to add to stack
-                    if isinstance(page, AlbumPage):
-                        add_to_stack = page.supporters
-                    elif isinstance(page, ArtistPage):
-                        # Should only be reached if the url passed to this function is an album url
-                        # Artist data is written to database through AlbumPage.write_to_database()
-                        add_to_stack = page.albums
-                    elif isinstance(page, UserPage):
-                        add_to_stack = page.collection
-                    else:
-                        raise Exception("Page is not in types (AlbumPage, ArtistPage, UserPage)")
-
-                    # Add scraped urls to stack
-                    self.stack.extend(add_to_stack)
-
-                    # Save scraped urls AND current url in logs table
-                    self.database.execute(
-                        INSERT_LOGS_QUERY.format(
-                            urls=self.format_urls_for_insert_log_query([url] + add_to_stack)
-                        )
-                    )
-
-                    # Set scraped indicator for current url to True
-                    self.database.execute(
-                        UPDATE_LOGS_TABLE.format(url=url)
-                    )
-
-                    # Commit changes to prevent data loss on crash
+                    page = self.fetch_page(url)
+                    self.process_page(url, page)
+                    meter.add()
+                except (TimeoutException, CollectionTooLargeException, HttpError, sqlite3.OperationalError) as e:
+                    self.page_failed(url, e)
+        finally:
+            self.database.flush()
+        meter.report()
+        self.http_client.report()
+
+    def start_concurrent_scrape(self, url=None, workers=8, max_per_host=2, min_host_delay=0.5):
+        """ Same crawl as start_scrape, but keeps up to `workers` page fetches in flight. Fetching and parsing
+        happens in worker threads, while writing to the database and updating the frontier and logs table stays
+        on this thread, so the logs table can be used to resume an interrupted run exactly like before. """
+        self.seed(url)
+        meter = ThroughputMeter()
+        limiter = HostLimiter(max_per_host=max_per_host, min_delay=min_host_delay)
+
+        # Maps futures to the url they are fetching
+        in_flight = {}
+        in_flight_urls = set()
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                while in_flight or self.budget_left() and (self.frontier or self.frontier.wait_for_others()):
+                    # Top up the workers. Urls of saturated hosts are held back and put in front of the frontier again,
+                    # we only look at a bounded amount of urls so a long run of same host urls can't stall this loop
+                    held_back = []
+                    while len(in_flight) < workers and len(held_back) < 4 * workers and \
+                            self.budget_left(len(in_flight)) and self.frontier:
+                        url = self.frontier.pop()
+                        if url is None or url in in_flight_urls:
+                            continue
+                        if not limiter.try_acquire(url):
+                            held_back.append(url)
+                            continue
+
+                        print(f"[{datetime.now()}] Scraping {url}")
+                        in_flight[pool.submit(self.fetch_page, url, limiter)] = url
+                        in_flight_urls.add(url)
+                    self.frontier.requeue(held_back)
+
+                    if not in_flight:
+                        continue
+
+                    # Wake up at least every flush interval so write-behind commits are not held back by slow pages
+                    done, _ = wait(in_flight, timeout=self.database.flush_every_seconds, return_when=FIRST_COMPLETED)
                     self.database.commit()
-                    
-                    self.visited.add(url)
-                except TimeoutException:
-                    print(f"TimeoutException for {url}")
-                    self.stack.append(url)
-                except CollectionTooLargeException:
-                    print(f"Skipped {url}; collection too large")
-            else:
-                print(f"Already visited {url}, skipping")
+                    for future in done:
+                        url = in_flight.pop(future)
+                        in_flight_urls.discard(url)
+                        limiter.release(url)
+                        try:
+                            self.process_page(url, future.result())
+                            meter.add()
+                        except (TimeoutException, CollectionTooLargeException, HttpError,
+                                sqlite3.OperationalError) as e:
+                            self.page_failed(url, e)
+        finally:
+            self.database.flush()
+        meter.report()
+        self.http_client.report()
+
+    def rebuild_from_cache(self):
+        """ Fills the database from the page cache instead of the network, e.g. after changing how pages are parsed.
+        Every cached page is parsed and written in the order it was first fetched. Pages that needed selenium use
+        their rendered version from the cache, no browser is started. Use an empty database, pages that are
+        already scraped according to the logs table are skipped. """
+        if self.page_cache is None:
+            raise ValueError("Scraper has no page cache to rebuild from")
+
+        offline_client = HttpClient(page_cache=self.page_cache, offline=True)
+        meter = ThroughputMeter()
+
+        try:
+            for url in self.page_cache.urls():
+                if self.frontier.is_visited(url):
+                    continue
+                try:
+                    page = self.get_page_type(url)(url, http_client=offline_client)
+                    self.process_page(url, page)
+                    meter.add()
+                except Exception as e:
+                    print(f"Could not rebuild {url} from page cache: {e!r}")
+        finally:
+            self.database.flush()
+        meter.report()
+
+    def refresh(self, batch_size=100):
+        """ Scrapes the user pages whose refresh is due again and writes the albums bought since they were last
+        scraped. Only the newest part of a collection is loaded, up to the first album that is already in the
+        database (see UserPage), so a refresh costs one request for most users. How soon a page is refreshed again
+        depends on whether it changed, see RefreshSchedule. New albums are added to the frontier, a normal crawl
+        scrapes them afterwards. Runs until no refresh is due or the budget is spent. """
+        meter = ThroughputMeter()
+        # Canonical urls refreshed in this run. Databases from before urls were canonicalized can have a user page
+        # under several urls, the others stop being refreshed
+        refreshed = set()
+
+        try:
+            while self.budget_left():
+                due = self.frontier.due_refreshes(batch_size)
+                if not due:
+                    break
+                for log_id, url, interval in due:
+                    if not self.budget_left():
+                        break
+                    url = canonicalize(url)
+                    if url in refreshed or self.get_page_type(url) is not UserPage:
+                        self.frontier.schedule_refresh(log_id, None)
+                        continue
+                    refreshed.add(url)
+
+                    print(f"[{datetime.now()}] Refreshing {url}")
+                    try:
+                        page = UserPage(url, selenium_driver=self.driver, http_client=self.http_client,
+                                        known_albums=self.database.user_collection_urls(url))
+                    except (TimeoutException, CollectionTooLargeException, HttpError) as e:
+                        self.refresh_failed(log_id, url, interval, e)
+                        continue
+                    self.process_refresh(log_id, interval, page)
+                    meter.add()
+        finally:
+            self.database.flush()
+        meter.report()
+        self.http_client.report()
+
+    def process_refresh(self, log_id, interval, page):
+        """ Writes the new purchases of a refreshed user page, adds them to the frontier and schedules the next
+        refresh. """
+        changed = bool(page.collection)
+        if changed:
+            page.write_to_database(self.database)
+            self.frontier.push(page.collection, page=page)
+        self.frontier.schedule_refresh(log_id, self.refresh_schedule.next_interval(interval, changed))
+        self.database.page_done()
+
+        METRICS.count("refreshes_total", result="changed" if changed else "unchanged")
+        METRICS.count("user_album_links_total", len(page.collection))
+        if self.budget is not None:
+            self.budget.page_done()
+
+    def refresh_failed(self, log_id, url, interval, error):
+        """ A failed refresh is tried again after the same interval, pages that don't exist anymore never again. """
+        print(f"Refreshing {url} failed: {error!r}")
+        METRICS.count("refreshes_total", result="failed")
+        gone = isinstance(error, HttpError) and error.status_code in (404, 410)
+        self.frontier.schedule_refresh(log_id, None if gone else interval or self.refresh_schedule.initial)
+        self.database.page_done()
+
+    def budget_left(self, in_flight=0):
+        """ Whether the crawl budget allows starting another page while in_flight pages are being scraped. """
+        return self.budget is None or self.budget.left(in_flight)
+
+    def fetch_page(self, url, limiter=None):
+        """ Downloads and parses url into its WebPage subclass. Safe to call from worker threads. """
+        if limiter is not None:
+            limiter.wait_turn(url)
+
+        pagetype = self.get_page_type(url)
+        return pagetype(url, selenium_driver=self.driver, http_client=self.http_client)
+
+    def page_failed(self, url, error):
+        """ Handles a page that could not be scraped. Selenium timeouts and pages that could not be written because
+        another crawl process held the database lock too long are retried later in this run, the other failures are
+        skipped. All are counted per page type, skips also per reason. """
+        page_type = self.get_page_type(url).__name__
+        if isinstance(error, TimeoutException):
+            print(f"TimeoutException for {url}")
+            METRICS.count("timeouts_total", page_type=page_type)
+            self.frontier.retry(url)
+        elif isinstance(error, sqlite3.OperationalError):
+            # Raised by the first write of the page, nothing of it was written (see BandcampDB.raise_if_locked)
+            print(f"Could not write {url}, retrying later: {error}")
+            METRICS.count("database_locked_total", page_type=page_type)
+            self.frontier.retry(url)
+        elif isinstance(error, CollectionTooLargeException):
+            print(f"Skipped {url}; collection too large")
+            METRICS.count("skipped_total", page_type=page_type, reason="collection_too_large")
+        else:
+            METRICS.count("skipped_total", page_type=page_type, reason=f"http_{error.status_code or 'error'}")
+            self.http_failed(url, error)
+
+    def http_failed(self, url, error):
+        """ Pages that don't exist anymore are marked as scraped so they are never tried again. Other failures
+        already were retried by the http client, they stay unscraped and are tried again on the next run. """
+        print(f"Skipped {url}; {error}")
+        if error.status_code in (404, 410):
+            self.frontier.mark_visited(url)
+            self.database.page_done()
+
+    def process_page(self, url, page):
+        """ Writes a scraped page to the database, adds the urls it links to to the frontier and marks it as
+        scraped in the logs table. """
+        started = time.perf_counter()
+        # Write page data to database, functionality differs for every page type,
+        # but function call is the same
+        page.write_to_database(self.database)
+
+        # Depending on page type decide what urls to add to the frontier
+        if isinstance(page, AlbumPage):
+            add_to_frontier = page.supporters
+        elif isinstance(page, ArtistPage):
+            # Should only be reached if the url passed to this function is an album url
+            # Artist data is written to database through AlbumPage.write_to_database()
+            add_to_frontier = page.albums
+        elif isinstance(page, UserPage):
+            add_to_frontier = page.collection
+        else:
+            raise Exception("Page is not in types (AlbumPage, ArtistPage, UserPage)")
+
+        # Save scraped urls AND current url in logs table, which is where the frontier reads from. The scheduler
+        # decides how soon the links are scraped
+        self.frontier.push([url])
+        self.frontier.push(add_to_frontier, page=page)
+
+        # Set scraped indicator for current url to True, user pages are refreshed later for new purchases
+        refresh_interval = self.refresh_schedule.initial if isinstance(page, UserPage) else None
+        self.frontier.mark_visited(url, refresh_interval=refresh_interval)
+
+        # Commit changes to prevent data loss on crash, in write-behind mode this commits once every few pages
+        self.database.page_done()
+
+        METRICS.observe("stage_seconds", time.perf_counter() - started, stage="db_write", page_type=page.page_type)
+        METRICS.count("pages_total", page_type=page.page_type)
+        METRICS.count("frontier_links_total", len(add_to_frontier), page_type=page.page_type)
+        if isinstance(page, UserPage):
+            METRICS.count("user_album_links_total", len(page.collection))
+        if self.budget is not None:
+            self.budget.page_done()
+        self.update_frontier_metrics()
+
+    def update_frontier_metrics(self):
+        """ Sets the frontier size gauges. The amount of pending urls is counted in the database, so that is only
+        done every FRONTIER_COUNT_EVERY seconds. """
+        METRICS.set("frontier_buffered", len(self.frontier.buffer) + len(self.frontier.requeued))
+        now = time.monotonic()
+        if now - self.frontier_counted >= FRONTIER_COUNT_EVERY:
+            self.frontier_counted = now
+            METRICS.set("frontier_pending", self.frontier.pending_count())
 
     def quit(self):
-        """ Shut down selenium driver and database connection. """
-        self.driver.driver.quit()
+        """ Shut down selenium driver and database connection, releasing the urls this crawl claimed but didn't
+        scrape. """
+        self.driver.quit()
+        self.frontier.close()
         self.database.commit_and_close()
 
     @staticmethod
     def get_page_type(url):
         """ Transforms an url to its corresponsing WebPage subclass. """
-        # Format is not always artist.bandcamp.com, so we have to match
-        # a very broad regex
-        album_page_pattern = r"https://[\w\d\-.]+/[\w]+/[\w\d-]+$"
-        artist_page_pattern = r"https://[\w\d\-.]+[/]?$"
-        user_page_pattern = r"https://bandcamp.com/[\w\d-]+(\?from=fanthanks)?$"
-
-        if re.match(album_page_pattern, url):
+        if ALBUM_URL.match(url):
             return AlbumPage
-        elif re.match(artist_page_pattern, url):
+        elif ARTIST_URL.match(url):
             return ArtistPage
-        elif re.match(user_page_pattern, url):
+        elif USER_URL.match(url):
             return UserPage
         else:
             raise Exception(f"Could not match url {url} to any regex pattern.")
-
-    @staticmethod
-    def format_urls_for_insert_log_query(urls):
-        """
-        Formats list of urls to format needed for insert query, e.g.:
-        ['a', 'b', 'c'] > "('a'), ('b'), ('c')"
-        """
-        return ',\n'.join([f"('{url}')" for url in urls])
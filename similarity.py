@@ -0,0 +1,234 @@
+import sys
+
+import numpy as np
+
+from embeddings import Embeddings
+
+
+def normalize(vectors):
+    """ Rows scaled to unit length, so a dot product is the cosine similarity. Zero rows stay zero. """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(scores, rows, k):
+    """ Per query the k highest scores and their rows, sorted from high to low. """
+    if k < scores.shape[1]:
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, best, axis=1)
+        rows = np.take_along_axis(rows, best, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(rows, order, axis=1)
+
+
+class ExactIndex:
+    """ Exact cosine nearest neighbours. Queries are scored against block_size albums at a time with one matrix
+    multiplication, and only the top k of every block is kept, so memory is bounded by queries x block_size no
+    matter how many albums there are. """
+    def __init__(self, embeddings, block_size=65_536):
+        self.embeddings = embeddings
+        self.block_size = block_size
+        self.vectors = normalize(embeddings.vectors)
+
+    def search_vectors(self, queries, k=10):
+        """ Returns (rows, scores), both queries x k, of the k albums most similar to every query vector. """
+        queries = normalize(np.atleast_2d(queries))
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.vectors), self.block_size):
+            block = self.vectors[start:start + self.block_size]
+            scores = queries @ block.T
+            rows = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+            scores, rows = top_k(scores, rows, k)
+            best_scores, best_rows = top_k(np.concatenate([best_scores, scores], axis=1),
+                                           np.concatenate([best_rows, rows], axis=1), k)
+        return best_rows, best_scores
+
+
+class IVFIndex:
+    """ Approximate cosine nearest neighbours with an inverted file: the albums are clustered with spherical
+    k-means into lists, and a query is only scored against the albums of the nprobe lists with the closest
+    centroids. More probes is higher recall and slower queries, nprobe = lists is exact.
+
+    lists defaults to 4 * sqrt(albums). k-means is trained on at most train_size albums per list.
+    """
+    def __init__(self, embeddings, lists=None, nprobe=8, iterations=10, train_size=256, seed=1, block_size=65_536):
+        self.embeddings = embeddings
+        self.nprobe = nprobe
+        self.block_size = block_size
+        vectors = normalize(embeddings.vectors)
+        lists = min(lists or max(int(4 * np.sqrt(len(vectors))), 1), len(vectors))
+
+        self.centroids = self.kmeans(vectors, lists, iterations, train_size, np.random.RandomState(seed))
+        assignments = self.assign(vectors)
+        # Albums sorted by list, list i is rows[list_offsets[i]:list_offsets[i + 1]]
+        order = np.argsort(assignments, kind="stable")
+        self.rows = order
+        self.vectors = vectors[order]
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=lists))])
+
+    def kmeans(self, vectors, lists, iterations, train_size, rng):
+        sample = vectors[rng.choice(len(vectors), min(len(vectors), lists * train_size), replace=False)]
+        centroids = sample[rng.choice(len(sample), lists, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            # A list that lost all its albums keeps its old centroid
+            empty = np.bincount(assignments, minlength=lists) == 0
+            sums[empty] = centroids[empty]
+            centroids = normalize(sums)
+        return centroids
+
+    def assign(self, vectors):
+        """ List of every vector, in blocks to bound memory. """
+        return np.concatenate([np.argmax(vectors[start:start + self.block_size] @ self.centroids.T, axis=1)
+                               for start in range(0, len(vectors), self.block_size)])
+
+    def search_vectors(self, queries, k=10, nprobe=None):
+        """ Returns (rows, scores), both queries x k, of the k albums most similar to every query vector that are
+        in its nprobe closest lists. Missing results, when those lists have fewer than k albums, are -1 with a
+        score of -inf. """
+        queries = normalize(np.atleast_2d(queries))
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probes = top_k(queries @ self.centroids.T, np.broadcast_to(np.arange(len(self.centroids)),
+                                                                   (len(queries), len(self.centroids))), nprobe)[1]
+
+        # Every probed list is scored with one matrix multiplication against all queries that probe it, and only
+        # its top k per query is kept. The candidates of all lists are merged per query with a single sort at the end
+        order = np.argsort(probes.ravel(), kind="stable")
+        probed_lists, starts = np.unique(probes.ravel()[order], return_index=True)
+        candidate_queries, candidate_scores, candidate_positions = [], [], []
+        for probe, group in zip(probed_lists, np.split(order // nprobe, starts[1:])):
+            start, end = self.list_offsets[probe], self.list_offsets[probe + 1]
+            if start == end:
+                continue
+            scores = queries[group] @ self.vectors[start:end].T
+            if k < end - start:
+                best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, best, axis=1)
+            else:
+                best = np.broadcast_to(np.arange(end - start), scores.shape)
+            candidate_queries.append(np.repeat(group, scores.shape[1]))
+            candidate_scores.append(scores.ravel())
+            candidate_positions.append(start + best.ravel())
+
+        result_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        result_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        if candidate_queries:
+            candidate_queries, candidate_scores, candidate_positions = (
+                np.concatenate(candidates) for candidates in [candidate_queries, candidate_scores, candidate_positions]
+            )
+            # By query, then from high to low score, and the first k of every query are its results
+            order = np.lexsort((-candidate_scores, candidate_queries))
+            candidate_queries = candidate_queries[order]
+            ranks = np.arange(len(order)) - np.searchsorted(candidate_queries, candidate_queries)
+            keep = ranks < k
+            result_rows[candidate_queries[keep], ranks[keep]] = self.rows[candidate_positions[order[keep]]]
+            result_scores[candidate_queries[keep], ranks[keep]] = candidate_scores[order[keep]]
+        return result_rows, result_scores
+
+
+def neighbour_overlap(embeddings, other, k=10, queries=1000, seed=1):
+    """ Average share of the k nearest neighbours that two embeddings agree on, for a sample of the albums both
+    have vectors for. Vectors of two training runs are not in the same space, but good embeddings of the same data
+    should mostly have the same neighbours, so this is how two runs or methods are compared. """
+    album_ids = np.intersect1d(embeddings.album_ids, other.album_ids)
+    rng = np.random.RandomState(seed)
+    sample = rng.choice(album_ids, min(queries, len(album_ids)), replace=False)
+
+    neighbours = []
+    for vectors in [embeddings, other]:
+        # Only rank the shared albums, albums that one of them doesn't know about can't count as a disagreement
+        shared = Embeddings(album_ids, vectors.vectors[vectors.index_of(album_ids)])
+        # One extra for the query album itself. It is usually, but not always, the first result, e.g. with duplicate
+        # vectors, so it's dropped wherever it is and the rest cut to k
+        rows, _ = ExactIndex(shared).search_vectors(shared.vectors[shared.index_of(sample)], k + 1)
+        neighbours.append([set(album_ids[row][album_ids[row] != album_id][:k]) for album_id, row in zip(sample, rows)])
+    return float(np.mean([len(a & b) / k for a, b in zip(*neighbours)]))
+
+
+INDEXES = {
+    "exact": ExactIndex,
+    "ivf": IVFIndex,
+}
+
+
+class AlbumSearch:
+    """ Similar albums and recommendations by album id, with the results joined to their metadata from the
+    database. All methods take a batch of queries and answer them with one search. """
+    def __init__(self, embeddings, database=None, index="exact", **index_options):
+        if not isinstance(embeddings, Embeddings):
+            embeddings = Embeddings.load(embeddings)
+        self.embeddings = embeddings
+        self.database = database
+        self.index = INDEXES[index](embeddings, **index_options)
+
+    def search(self, queries, k, exclude):
+        """ Top k album ids per query vector, leaving out the album ids in exclude[i] for query i. """
+        extra = max((len(excluded) for excluded in exclude), default=0)
+        rows, scores = self.index.search_vectors(queries, k + extra)
+
+        results = []
+        for i in range(len(rows)):
+            found = [(int(self.embeddings.album_ids[row]), float(score)) for row, score in zip(rows[i], scores[i])
+                     if row >= 0 and int(self.embeddings.album_ids[row]) not in exclude[i]]
+            results.append(found[:k])
+        return self.describe(results)
+
+    def similar(self, album_ids, k=10):
+        """ For every album id the k most similar albums, as a list of result dicts. Albums without a vector
+        get an empty list. """
+        rows = self.embeddings.index_of(album_ids)
+        known = rows >= 0
+        results = [[] for _ in album_ids]
+        if known.any():
+            found = self.search(self.embeddings.vectors[rows[known]], k,
+                                [{int(album_id)} for album_id in np.asarray(album_ids)[known]])
+            for i, result in zip(np.flatnonzero(known), found):
+                results[i] = result
+        return results
+
+    def recommend(self, collections, k=10):
+        """ For every collection (a list of album ids) the k albums closest to the mean of its albums, leaving out
+        the albums already in it. Collections without any known album get an empty list. """
+        queries, exclude, positions = [], [], []
+        for i, collection in enumerate(collections):
+            rows = self.embeddings.index_of(collection)
+            rows = rows[rows >= 0]
+            if len(rows):
+                queries.append(normalize(self.embeddings.vectors[rows]).mean(axis=0))
+                exclude.append({int(album_id) for album_id in collection})
+                positions.append(i)
+
+        results = [[] for _ in collections]
+        if queries:
+            for i, result in zip(positions, self.search(np.array(queries), k, exclude)):
+                results[i] = result
+        return results
+
+    def describe(self, results):
+        """ Turns lists of (album id, score) into lists of dicts with the album's metadata. """
+        details = self.database.album_details({album_id for result in results for album_id, _ in result}) \
+            if self.database is not None else {}
+        return [[dict(album_id=album_id, score=score, **details.get(album_id, {})) for album_id, score in result]
+                for result in results]
+
+
+if __name__ == "__main__":
+    from bandcamp_db import BandcampDB
+
+    if len(sys.argv) < 4:
+        print("Usage: python similarity.py <embeddings.npz> <database> <album id> [album id ...]")
+        sys.exit(1)
+
+    database = BandcampDB(sys.argv[2])
+    album_ids = [int(album_id) for album_id in sys.argv[3:]]
+    search = AlbumSearch(sys.argv[1], database)
+    details = database.album_details(album_ids)
+    for album_id, similar in zip(album_ids, search.similar(album_ids)):
+        print(f"Albums similar to {details.get(album_id, {}).get('name') or album_id}:")
+        for result in similar:
+            print(f"  {result['score']:.3f}  {result.get('name') or result.get('url')}  ({result.get('tags') or ''})")
+    database.commit_and_close()
@@ -0,0 +1,161 @@
+""" Local stand-in for bandcamp.com, so pages and the collection api can be used without network access.
+
+The server replays recorded http exchanges. A recording is a json file with a list of exchanges:
+
+    [{"method": "POST", "path": "/api/fancollection/1/collection_items", "status": 200,
+      "content_type": "application/json", "body": "{...}"}, ...]
+
+Exchanges with the same method and path are served in the order they were recorded, the last one is repeated
+once they run out. This way paging through a collection replays batch after batch, even though the first
+older_than_token depends on the current time.
+
+Record the collection of a fan and replay it:
+
+    python standin_server.py record https://bandcamp.com/<fan> fan.json
+    python standin_server.py serve fan.json 8000
+
+and point the page and loader at it:
+
+    UserPage("http://127.0.0.1:8000/<fan>",
+             collection_loader=CollectionLoader(api_url="http://127.0.0.1:8000/api/fancollection/1/collection_items"))
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import sys
+import threading
+from urllib.parse import urlsplit
+
+import requests
+
+
+# Header StandInSession puts the host of the original url in
+STAND_IN_HOST = "X-Stand-In-Host"
+
+
+class Recording:
+    """ Recorded http exchanges, see module docstring for the format. """
+    def __init__(self, exchanges=None):
+        self.exchanges = exchanges if exchanges is not None else []
+        self._lock = threading.Lock()
+        self._served = {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.exchanges, f, indent=1)
+
+    def add(self, method, url, response):
+        """ Stores a requests.Response. """
+        parts = urlsplit(url)
+        self.exchanges.append({
+            "method": method.upper(),
+            "path": parts.path + (f"?{parts.query}" if parts.query else ""),
+            "status": response.status_code,
+            "content_type": response.headers.get("Content-Type", "text/html; charset=utf-8"),
+            "body": response.text,
+        })
+
+    def next_response(self, method, path):
+        """ Returns the next recorded exchange for method and path, or None if there is none. """
+        matches = [exchange for exchange in self.exchanges if exchange["method"] == method and exchange["path"] == path]
+        if not matches:
+            return None
+
+        with self._lock:
+            served = self._served.get((method, path), 0)
+            self._served[(method, path)] = served + 1
+        return matches[min(served, len(matches) - 1)]
+
+
+class RecordingSession(requests.Session):
+    """ requests.Session that adds every response to a Recording, e.g. HttpClient(session=RecordingSession(...)). """
+    def __init__(self, recording):
+        super().__init__()
+        self.recording = recording
+
+    def request(self, method, url, *args, **kwargs):
+        response = super().request(method, url, *args, **kwargs)
+        self.recording.add(method, url, response)
+        return response
+
+
+class StandInSession(requests.Session):
+    """ requests.Session that sends requests for any host to a local stand-in server at base_url instead, e.g.
+    HttpClient(session=StandInSession("http://127.0.0.1:8000")). The original host is sent in the STAND_IN_HOST
+    header, so a server can tell https://artist.bandcamp.com/ and https://bandcamp.com/ apart. Pages keep their
+    real urls, so page type detection and the links they contain work as usual. """
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url.rstrip("/")
+
+    def request(self, method, url, *args, headers=None, **kwargs):
+        parts = urlsplit(url)
+        headers = dict(headers or {}, **{STAND_IN_HOST: parts.netloc})
+        local_url = self.base_url + (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        return super().request(method, local_url, *args, headers=headers, **kwargs)
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    recording = None
+
+    def do_GET(self):
+        self.replay("GET")
+
+    def do_POST(self):
+        # Read the body so the client doesn't get a connection reset, the content is not matched
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.replay("POST")
+
+    def replay(self, method):
+        exchange = self.recording.next_response(method, self.path)
+        if exchange is None:
+            self.send_error(404, f"No recorded response for {method} {self.path}")
+            return
+
+        body = exchange["body"].encode("utf-8")
+        self.send_response(exchange["status"])
+        self.send_header("Content-Type", exchange["content_type"])
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(recording, host="127.0.0.1", port=0):
+    """ Starts a replay server on a background thread. Returns the server and its base url, call
+    server.shutdown() to stop it. Port 0 picks a free port. """
+    handler = type("BoundReplayHandler", (ReplayHandler,), {"recording": recording})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def record_fan(fan_url, path):
+    """ Records a fan page and all collection api batches needed to load its collection. """
+    from collection_loader import CollectionLoader
+    from extractors import XPathExtractor
+    from http_client import HttpClient
+
+    recording = Recording()
+    http_client = HttpClient(session=RecordingSession(recording))
+    html = http_client.get_text(fan_url)
+    CollectionLoader(http_client=http_client).load_from_page(XPathExtractor(html))
+    recording.save(path)
+    print(f"Recorded {len(recording.exchanges)} responses to {path}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["record"]:
+        record_fan(sys.argv[2], sys.argv[3])
+    elif sys.argv[1:2] == ["serve"]:
+        server, base_url = serve(Recording.load(sys.argv[2]), port=int(sys.argv[3]) if len(sys.argv) > 3 else 8000)
+        print(f"Replaying {sys.argv[2]} on {base_url}")
+        threading.Event().wait()
+    else:
+        print("Usage: python standin_server.py record <fan url> <recording.json> | serve <recording.json> [port]")
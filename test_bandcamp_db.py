@@ -0,0 +1,114 @@
+import os
+import sqlite3
+
+import pytest
+
+import bandcamp_db
+from bandcamp_db import HOT_QUERIES, SCHEMA_VERSION, BandcampDB, backfill_logs_fingerprints
+from frontier import Frontier
+from queries import INSERT_LOGS_QUERY, SET_SCHEMA_VERSION_QUERY
+from urls import fingerprint, stored_fingerprint
+from utils import OutdatedSchemaError
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = BandcampDB(os.path.join(tmp_path, "test.db"), create_new_db=True)
+    yield database
+    database.commit_and_close()
+
+
+@pytest.mark.parametrize("name, query, params, index", HOT_QUERIES, ids=[query[0] for query in HOT_QUERIES])
+def test_hot_query_uses_index(database, name, query, params, index):
+    plan = database.explain(query, params)
+    assert any(index in step for step in plan), plan
+
+
+def test_check_query_plans_fresh_database(database):
+    assert database.check_query_plans() == {}
+
+
+def test_check_query_plans_ignores_small_table_statistics(database):
+    # After ANALYZE of a few rows sqlite scans the tiny tables, that is not what happens on a real crawl
+    for album_id in range(1, 30):
+        database.execute("INSERT INTO album (url) VALUES (?)", (f"https://artist.bandcamp.com/album/{album_id}",))
+        database.set_album_tags(album_id, "rock, pop")
+    database.execute("ANALYZE")
+    database.commit()
+
+    assert database.check_query_plans() == {}
+
+
+def test_outdated_schema_is_refused(tmp_path):
+    db_name = os.path.join(tmp_path, "old.db")
+    database = BandcampDB(db_name, create_new_db=True)
+    database.execute(SET_SCHEMA_VERSION_QUERY, (SCHEMA_VERSION - 1,))
+    database.commit_and_close()
+
+    with pytest.raises(OutdatedSchemaError):
+        BandcampDB(db_name)
+    database = BandcampDB(db_name, allow_outdated=True)
+    assert database.schema_version() == SCHEMA_VERSION - 1
+    database.commit_and_close()
+
+
+def test_locked_write_is_raised(tmp_path, monkeypatch):
+    monkeypatch.setattr(bandcamp_db, "BUSY_TIMEOUT", 0.1)
+    database = BandcampDB(os.path.join(tmp_path, "test.db"), create_new_db=True)
+    other = BandcampDB(database.db_name)
+    other.artist_id("Other", "https://other.bandcamp.com")
+
+    # Another crawl process holds the write lock, the write must fail instead of being skipped
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        database.artist_id("Artist", "https://artist.bandcamp.com")
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        database.album_ids(["https://artist.bandcamp.com/album/a"])
+
+    # The page can be written once the lock is released, also when it read before that
+    assert database.select_value("SELECT COUNT(*) FROM artist") == 0
+    other.commit_and_close()
+    assert database.artist_id("Artist", "https://artist.bandcamp.com") == 2
+    database.commit_and_close()
+
+
+def test_frontier_waits_for_a_locked_claim(tmp_path, monkeypatch):
+    monkeypatch.setattr(bandcamp_db, "BUSY_TIMEOUT", 0.1)
+    url = "https://artist.bandcamp.com/album/a"
+    database = BandcampDB(os.path.join(tmp_path, "test.db"), create_new_db=True)
+    database.executemany(INSERT_LOGS_QUERY, [(url, stored_fingerprint(fingerprint(url)))])
+    database.commit()
+    frontier = Frontier(database)
+
+    # Another crawl process holds the write lock while the frontier claims
+    other = BandcampDB(database.db_name)
+    other.execute(INSERT_LOGS_QUERY, ("https://other.bandcamp.com", None))
+    assert frontier.pop() is None
+    assert frontier.claim_locked
+
+    # Not done, the claim is tried again once the lock is released
+    other.commit_and_close()
+    assert frontier.wait_for_others(poll_seconds=0.01)
+    assert frontier.pop() == url
+    frontier.close()
+    database.commit_and_close()
+
+
+def test_frontier_loads_stored_fingerprints(database):
+    pushed = "https://artist.bandcamp.com/album/a"
+    # A row from before logs.fingerprint, not in canonical form
+    old = "http://Other.bandcamp.com/album/b?from=fanpub"
+    database.execute("INSERT INTO logs (url, state) VALUES (?, 1)", (old,))
+    frontier = Frontier(database)
+    frontier.push([pushed])
+    assert database.select_value("SELECT fingerprint FROM logs WHERE url = ?", (pushed,)) == \
+        stored_fingerprint(fingerprint(pushed))
+    frontier.close()
+
+    frontier = Frontier(database)
+    assert pushed in frontier.known and pushed not in frontier.scraped
+    assert "https://other.bandcamp.com/album/b" in frontier.scraped
+    frontier.close()
+
+    backfill_logs_fingerprints(database.conn)
+    assert database.select_value("SELECT fingerprint FROM logs WHERE url = ?", (old,)) == \
+        stored_fingerprint(fingerprint("https://other.bandcamp.com/album/b"))
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+from collection_loader import CollectionLoader
+from http_client import HttpClient
+from standin_server import Recording, StandInSession, serve
+from test_webpages import API_PATH, FAN_URL, api_batch, exchange, fan_page, item_url
+from urls import canonicalize
+from utils import CollectionLoadError
+from webpages import UserPage
+
+
+def sent_counts(http_client):
+    """ Returns the list the item count of every collection api request sent by http_client is appended to. """
+    counts = []
+    request = http_client.session.request
+
+    def counting_request(method, url, **kwargs):
+        if "json" in kwargs:
+            counts.append(kwargs["json"]["count"])
+        return request(method, url, **kwargs)
+    http_client.session.request = counting_request
+    return counts
+
+
+def test_collection_is_paged_in_batches(standin):
+    collection = [item_url(i) for i in range(1200)]
+    http_client = standin([exchange("GET", "/fan", fan_page(collection[:20])), api_batch(collection[:500], True),
+                           api_batch(collection[500:1000], True), api_batch(collection[1000:], False)])
+    counts = sent_counts(http_client)
+
+    page = UserPage(FAN_URL, http_client=http_client)
+    assert page.collection == collection
+    assert counts == [500, 500, 500]
+
+
+def test_refresh_doubles_batches_until_a_known_item(standin):
+    collection = [item_url(i) for i in range(200)]
+    http_client = standin([api_batch(collection[:20], True), api_batch(collection[20:60], True),
+                           api_batch(collection[60:110], True), api_batch(collection[110:160], True)])
+    counts = sent_counts(http_client)
+
+    loader = CollectionLoader(batch_size=50, http_client=http_client)
+    known = {canonicalize(url) for url in collection[120:]}
+    assert loader.load(7, stop_at=known) == collection[:120]
+    assert counts == [20, 40, 50, 50]
+
+
+def test_failed_request_raises_collection_load_error():
+    # Nothing listens anymore, the request fails without a response
+    server, base_url = serve(Recording())
+    server.shutdown()
+    server.server_close()
+    loader = CollectionLoader(http_client=HttpClient(max_retries=0, session=StandInSession(base_url)))
+
+    with pytest.raises(CollectionLoadError, match="request failed"):
+        loader.load(7)
+
+
+@pytest.mark.parametrize("exchanges, match", [
+    ([], "faulty response: 404"),
+    ([exchange("POST", API_PATH, "<html></html>")], "did not return json"),
+    ([exchange("POST", API_PATH, json.dumps({"error": True, "error_message": "no"}),
+               "application/json")], "returned an error: no"),
+])
+def test_faulty_response_raises_collection_load_error(standin, exchanges, match):
+    loader = CollectionLoader(http_client=standin(exchanges))
+    with pytest.raises(CollectionLoadError, match=match):
+        loader.load(7)
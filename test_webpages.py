@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+from webpages import AlbumPage, UserPage
+
+
+FAN_URL = "https://bandcamp.com/fan"
+ALBUM_URL = "https://artist.bandcamp.com/album/a"
+API_PATH = "/api/fancollection/1/collection_items"
+
+
+def item_url(i):
+    return f"https://artist{i}.bandcamp.com/album/a"
+
+
+def fan_page(shown, show_more=True):
+    # Attribute values with '>' in them, like the json of the data-blob and the titles of real pages
+    blob = json.dumps({"fan_data": {"fan_id": 7, "name": "fan"}, "note": "a > b"}).replace('"', "&quot;")
+    items = "".join(f'<li><a class="item-link" target="_blank" title="Artist > Album" href="{url}">x</a></li>'
+                    for url in shown)
+    more = '<button class="show-more" title="more > less">view all</button>' if show_more else ""
+    return (f'<html><body><div id="pagedata" data-blob="{blob}"></div><div class="name"><span>fan</span></div>'
+            f'<div class="collection-items"><ol class="collection-grid">{items}</ol>{more}</div></body></html>')
+
+
+def album_page(more_button):
+    more = '<a class="more-thumbs" title="more > less" href="#">more...</a>' if more_button else \
+        '<a class="tag" title="no more-thumbs > here" href="#">tag</a>'
+    return (f'<html><body><div id="name-section"><h2 class="trackTitle">Album</h2>'
+            f'<h3><span><a href="https://artist.bandcamp.com">Artist</a></span></h3></div>'
+            f'<p id="band-name-location"><span class="title">Artist</span></p>'
+            f'<div class="tralbumData tralbum-credits">released March 3, 2021</div>'
+            f'<div class="tralbumData tralbum-tags tralbum-tags-nu"><a class="tag">rock</a></div>'
+            f'<div class="deets populated"><a class="pic" href="https://bandcamp.com/fan">x</a>{more}</div>'
+            f'</body></html>')
+
+
+def exchange(method, path, body, content_type="text/html; charset=utf-8"):
+    return {"method": method, "path": path, "status": 200, "content_type": content_type, "body": body}
+
+
+def api_batch(urls, more_available):
+    body = json.dumps({"items": [{"item_url": url} for url in urls], "more_available": more_available,
+                       "last_token": "1::a::"})
+    return exchange("POST", API_PATH, body, "application/json")
+
+
+def test_user_page_with_quoted_gt(standin):
+    collection = [item_url(i) for i in range(30)]
+    http_client = standin([exchange("GET", "/fan", fan_page(collection[:20])), api_batch(collection, False)])
+
+    page = UserPage(FAN_URL, http_client=http_client)
+    assert page.username == "fan"
+    # Loaded from the collection api with the fan id of the data-blob
+    assert page.collection == collection
+
+
+def test_user_page_without_show_more_is_not_loaded(standin):
+    collection = [item_url(i) for i in range(3)]
+    page = UserPage(FAN_URL, http_client=standin([exchange("GET", "/fan", fan_page(collection, show_more=False))]))
+    assert "collection" not in page.documents
+    assert page.collection == collection
+
+
+def test_album_page_mentioning_more_button_is_not_rendered(standin):
+    # The class name only occurs in a title, parsing finds no button so selenium isn't needed
+    page = AlbumPage(ALBUM_URL, http_client=standin([exchange("GET", "/album/a", album_page(more_button=False))]))
+    assert page.supporters == ["https://bandcamp.com/fan"]
+    assert page.tags == "rock"
+
+
+def test_album_page_with_more_button_is_rendered(standin):
+    with pytest.raises(Exception, match="no selenium driver"):
+        AlbumPage(ALBUM_URL, http_client=standin([exchange("GET", "/album/a", album_page(more_button=True))]))
+
+
+def test_user_page_falls_back_to_rendering(standin, monkeypatch):
+    collection = [item_url(i) for i in range(30)]
+    # No collection api in the recording, so loading it over http fails
+    http_client = standin([exchange("GET", "/fan", fan_page(collection[:20]))])
+    monkeypatch.setattr(UserPage, "render_collection", lambda page: fan_page(collection, show_more=False))
+
+    page = UserPage(FAN_URL, http_client=http_client)
+    assert "collection" not in page.documents
+    assert page.collection == collection
@@ -0,0 +1,114 @@
+""" Url handling for the crawl: canonical urls, page type patterns and a compact set of seen urls. """
+from hashlib import blake2b
+import re
+from urllib.parse import urlsplit
+
+import numpy as np
+
+
+# Page types by url. Artist pages are not always on artist.bandcamp.com, so these are very broad
+ALBUM_URL = re.compile(r"https://[\w\d\-.]+/[\w]+/[\w\d-]+$")
+ARTIST_URL = re.compile(r"https://[\w\d\-.]+[/]?$")
+USER_URL = re.compile(r"https://bandcamp.com/[\w\d-]+(\?from=fanthanks)?$")
+
+# Already canonical: https, lowercase host without port, no query, fragment or trailing slash. Almost every url
+# bandcamp links to is, those skip parsing
+CANONICAL_URL = re.compile(r"https://(?!www\.)[a-z0-9.-]+(/[^?#]*[^/?#])?$")
+
+
+def canonicalize(url):
+    """ The canonical form of a page url, so variants of the same page are crawled and stored once: https, lowercase
+    host without www. and default port, and no query string, fragment or trailing slash. No page type we crawl
+    depends on the query string, it's referral info like ?from=fanthanks. The path is kept as is. """
+    if CANONICAL_URL.match(url):
+        return url
+
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").rstrip(".")
+    if host.startswith("www."):
+        host = host[len("www."):]
+    if parts.port not in (None, 80, 443):
+        host = f"{host}:{parts.port}"
+    return f"https://{host}{parts.path.rstrip('/')}"
+
+
+def fingerprint(url):
+    """ 64-bit hash of an url. """
+    return int.from_bytes(blake2b(url.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def stored_fingerprint(value):
+    """ A fingerprint as the signed 64-bit integer sqlite stores in logs.fingerprint. Read back into a FingerprintSet
+    with update_fingerprints(np.array(values, dtype=np.int64).view(np.uint64)). """
+    return value - 2 ** 64 if value >= 2 ** 63 else value
+
+
+class FingerprintSet:
+    """ Set of urls kept as 64-bit fingerprints, 8 bytes per url instead of the ~150 bytes of an url string in a
+    set. Most fingerprints are in a sorted numpy array, so a lookup is a binary search; new ones go to a small set
+    first, which is merged into the array once it holds a sixty-fourth of it (at least merge_size), so adding is
+    amortized O(1). Fingerprints added with update are kept as they are until they add up to the size of the array
+    (at least merge_size) or a lookup needs them, so filling a set with many update calls, e.g. one per batch of
+    rows, sorts O(log n) times instead of once per call.
+
+    Two urls get the same fingerprint with a chance of about n^2 / 2^65, one in 300,000 for 10 million urls. The
+    second url would then wrongly count as seen.
+    """
+    def __init__(self, urls=(), merge_size=65_536):
+        self.merge_size = merge_size
+        self.sorted = np.zeros(0, dtype=np.uint64)
+        self.recent = set()
+        # Unsorted arrays of fingerprints from update
+        self.pending = []
+        self.pending_size = 0
+        self.update(urls)
+
+    def __len__(self):
+        if self.pending:
+            self.merge()
+        return len(self.sorted) + len(self.recent)
+
+    def __contains__(self, url):
+        return self.contains_fingerprint(fingerprint(url))
+
+    def contains_fingerprint(self, value):
+        if self.pending:
+            self.merge()
+        if value in self.recent:
+            return True
+        position = np.searchsorted(self.sorted, np.uint64(value))
+        return position < len(self.sorted) and int(self.sorted[position]) == value
+
+    def add(self, url):
+        self.add_fingerprint(fingerprint(url))
+
+    def add_fingerprint(self, value):
+        if not self.contains_fingerprint(value):
+            self.recent.add(value)
+            if len(self.recent) >= max(self.merge_size, len(self.sorted) // 64):
+                self.merge()
+
+    def update(self, urls):
+        """ Adds many urls at once. They are merged into the array later, see the class docstring. """
+        self.update_fingerprints(np.fromiter((fingerprint(url) for url in urls), dtype=np.uint64))
+
+    def update_fingerprints(self, values):
+        """ Same as update, for a uint64 array of fingerprints. """
+        if len(values):
+            self.pending.append(values)
+            self.pending_size += len(values)
+            if self.pending_size >= max(self.merge_size, len(self.sorted)):
+                self.merge()
+
+    def merge(self):
+        """ Moves the recent and pending fingerprints into the sorted array. """
+        added = self.pending + [np.fromiter(self.recent, dtype=np.uint64, count=len(self.recent))]
+        self.sorted = np.union1d(self.sorted, np.concatenate(added))
+        self.recent = set()
+        self.pending = []
+        self.pending_size = 0
+
+    @property
+    def nbytes(self):
+        """ Approximate memory use. """
+        return self.sorted.nbytes + self.pending_size * 8 + 64 * len(self.recent)
@@ -1,3 +1,10 @@
+from collections import OrderedDict
+from datetime import datetime
+import threading
+import time
+from urllib.parse import urlparse
+
+
 class ElementCountChanged(object):
     """An expectation for checking that an elements has changes.
 
@@ -19,5 +26,130 @@ class ElementCountChanged(object):
             return False
 
 
+class HostLimiter:
+    """ Politeness limits per host: at most max_per_host requests in flight for a single host, and
+    at least min_delay seconds between the start of two requests to the same host. """
+    def __init__(self, max_per_host=2, min_delay=0.5):
+        self.max_per_host = max_per_host
+        self.min_delay = min_delay
+
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._next_start = {}
+
+    @staticmethod
+    def host(url):
+        return urlparse(url).netloc.lower()
+
+    def try_acquire(self, url):
+        """ Claims an in flight slot for the host of url. Returns False if the host is saturated. """
+        host = self.host(url)
+        with self._lock:
+            if self._in_flight.get(host, 0) >= self.max_per_host:
+                return False
+            self._in_flight[host] = self._in_flight.get(host, 0) + 1
+            return True
+
+    def release(self, url):
+        host = self.host(url)
+        with self._lock:
+            self._in_flight[host] -= 1
+            if not self._in_flight[host]:
+                del self._in_flight[host]
+
+    def acquire(self, url):
+        """ Blocking variant of try_acquire, for callers without their own scheduling. """
+        while not self.try_acquire(url):
+            time.sleep(max(self.min_delay / 2, 0.01))
+
+    def wait_turn(self, url):
+        """ Sleeps until min_delay has passed since the previous request to the same host started. """
+        host = self.host(url)
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + self.min_delay
+        if start > now:
+            time.sleep(start - now)
+
+
+class ThroughputMeter:
+    """ Counts scraped pages and periodically prints the pages/sec rate, followed by the result of details() if
+    passed. """
+    def __init__(self, report_every=30, details=None):
+        self.report_every = report_every
+        self.details = details
+        self.pages = 0
+        self.started = time.monotonic()
+        self._last_report = self.started
+
+    def add(self, pages=1):
+        self.pages += pages
+        now = time.monotonic()
+        if self.report_every and now - self._last_report >= self.report_every:
+            self._last_report = now
+            self.report()
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.pages / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        details = f", {self.details()}" if self.details is not None else ""
+        print(f"[{datetime.now()}] {self.pages:,} pages scraped, {self.rate():.2f} pages/sec{details}")
+
+
+class LRUCache:
+    """ Dict with a maximum size, when full the least recently used key is evicted. """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def clear(self):
+        self.data.clear()
+
+
 class CollectionTooLargeException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class CollectionLoadError(Exception):
+    """ Collection could not be loaded over http, callers fall back to selenium. """
+    pass
+
+
+class OutdatedSchemaError(Exception):
+    """ Database has an older schema than the code, it has to be migrated first. """
+    pass
+
+
+class HttpError(ConnectionError):
+    """ Request failed after all retries, status_code is None if no response was received at all. """
+    def __init__(self, url, status_code, detail=""):
+        super().__init__(f"Request to {url} returned faulty response: {status_code}: {detail}")
+        self.url = url
+        self.status_code = status_code
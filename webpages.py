@@ -1,94 +1,186 @@
+import json
 from math import ceil
 import re
-import requests
-
-from bs4 import BeautifulSoup
-from selenium.common.exceptions import NoSuchElementException, ElementNotInteractableException, TimeoutException
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.wait import WebDriverWait
+import time
+
 from tqdm import tqdm
 
-from queries import ALBUM_ID_QUERY, ARTIST_ID_QUERY, USER_ID_QUERY,\
-                    INSERT_ALBUM_METADATA_QUERY, INSERT_ALBUM_QUERY, INSERT_ARTIST_QUERY,\
-                    INSERT_USER_QUERY, INSERT_USER_SUPPORTS_QUERY
-from utils import CollectionTooLargeException, ElementCountChanged
+from collection_loader import CollectionLoader
+from extractors import EXTRACTORS
+from http_client import get_default_client
+from metrics import METRICS
+from queries import INSERT_ALBUM_METADATA_QUERY
+from urls import canonicalize
+from utils import CollectionLoadError, CollectionTooLargeException, ElementCountChanged
+
+
+# Default extraction, "xpath" only looks at the fields we need, "soup" builds a full BeautifulSoup tree
+DEFAULT_PARSER = "xpath"
+
+# Selenium is imported by the methods that drive a browser, so the parse processes of the pipeline, which only
+# import this module to parse pages, start without it
+
+
+def parse_documents(pagetype, url, documents, parser):
+    """ Parse stage of the pipeline, runs in a worker process. Returns the parsed page, which pickles to just its
+    fields. """
+    return pagetype(url, documents=documents, parser=parser)
 
 
 class WebPage:
+    """ A scraped page. Creating one happens in two steps:
+
+    - fetch(): all network and browser work. Stores the raw bodies needed to read the page in self.documents,
+      {"http": html} plus "rendered" (selenium page source) or "collection" (json list of item urls) when needed.
+      Fetching only parses the page when mentions() finds what it looks for in the raw html.
+    - parse(): reads the page fields from self.documents, without any network access.
+
+    Pass documents to skip fetching, e.g. to parse pages fetched by another thread or process, and parse=False to
+    only fetch. Pages are picklable, only the url and the parsed fields are kept.
+    """
     # TODO check super.__init__ calls in subclasses to see if this can be cleaner
-    def __init__(self, url, selenium_driver=None):
-        # Remove leading slashes to make joining relative page urls easier
+    def __init__(self, url, selenium_driver=None, http_client=None, parser=DEFAULT_PARSER, documents=None, parse=True):
+        # Remove trailing slashes to make joining relative page urls easier
         if url.endswith("/"):
             url = url[:-1]
 
         self.url = url
         self.selenium_driver = selenium_driver
-        self.html = self.get_html()
-        self.soup = BeautifulSoup(self.html, "lxml")
+        self.http_client = http_client if http_client is not None else get_default_client()
+        self.extractor_class = EXTRACTORS[parser]
+
+        # Parsed document, kept so a document is never parsed twice
+        self.extractor = None
+        self.extracted_kind = None
+
+        self.documents = dict(documents) if documents else {}
+        if "http" not in self.documents:
+            self.fetch()
+        if parse:
+            started = time.perf_counter()
+            self.parse()
+            # Kept on the page, so the time of pages parsed in another process can be recorded by the writer
+            self.parse_seconds = time.perf_counter() - started
+            METRICS.observe("stage_seconds", self.parse_seconds, stage="parse", page_type=self.page_type)
+        # Fetched under the url it was given, so pages cached under another variant of the url are still found,
+        # but stored under the canonical url
+        self.url = canonicalize(self.url)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attribute in ["selenium_driver", "http_client", "collection_loader", "documents"]:
+            state.pop(attribute, None)
+        state["extractor"] = state["extracted_kind"] = None
+        return state
+
+    @property
+    def page_type(self):
+        """ Label of the page's metrics. """
+        return type(self).__name__
 
     def get_html(self):
-        """ Use simple get request to retrieve page html and store this as instance variable. """
-        response = requests.get(self.url)
-        if response.status_code == 200:
-            return response.text
-        else:
-            raise ConnectionError(f"Request returned faulty response: {response.status_code}: {response.content}")
+        """ Use get request to retrieve page html. Raises HttpError if the page can't be retrieved. """
+        return self.http_client.get_text(self.url)
+
+    def fetch(self):
+        """ Retrieves the page html, subclasses add what else has to be loaded. """
+        with METRICS.timer("stage_seconds", stage="fetch", page_type=self.page_type):
+            self.documents["http"] = self.get_html()
+
+    def parse(self):
+        """ Reads the page fields from self.documents, implemented by subclasses. """
+        raise NotImplementedError
+
+    def extract(self, kind="http"):
+        """ Returns the extractor for documents[kind], parsing it if it isn't the one parsed last. """
+        if self.extracted_kind != kind:
+            self.extractor = self.extractor_class(self.documents[kind])
+            self.extracted_kind = kind
+        return self.extractor
+
+    def mentions(self, *markers, kind="http"):
+        """ Whether any of markers occurs anywhere in the raw documents[kind]. fetch() runs on the fetch threads,
+        where parsing would hold the GIL and be done again by the parse stage, so it checks this before parsing. """
+        return any(marker in self.documents[kind] for marker in markers)
+
+    def load_document(self, kind, load):
+        """ Returns the body of kind, from the page cache when rebuilding from it, otherwise from load(). Fetched
+        bodies are added to the page cache. """
+        # When rebuilding from the page cache, use what was loaded on an earlier run
+        body = self.http_client.cached(self.url, kind)
+        if body is None:
+            body = load()
+            self.http_client.store(self.url, body, kind)
+        return body
 
 
 class AlbumPage(WebPage):
-    def __init__(self, url, selenium_driver=None):
-        super().__init__(url, selenium_driver)
-        self.supporters = self.get_supporters()
-
+    def __init__(self, url, selenium_driver=None, http_client=None, parser=DEFAULT_PARSER, documents=None, parse=True):
         # Placeholders for metadata
+        self.supporters = None
         self.album_name = None
         self.artist_url = None  # Not written to db, but needed to get artist_id
         self.artist_name = None  # Not written to db, but needed to get artist_id
         self.year = None
         self.tags = None
 
+        super().__init__(url, selenium_driver, http_client, parser, documents, parse)
+
+    def fetch(self):
+        super().fetch()
+        # Load content shown by pressing button using selenium
+        if self.mentions("more-writing", "more-thumbs") and self.extract("http").has_more_buttons():
+            self.documents["rendered"] = self.load_document("rendered", self.render)
+
+    def parse(self):
+        self.supporters = self.get_supporters()
+
         # Fill placeholder variables
         self.set_metadata()
 
-    def get_supporters(self):
-        # Load content shown by pressing button using selenium
-        if self.soup.find("a", class_="more-writing") is not None or self.soup.find("a", class_="more-thumbs") is not None:
-            if self.selenium_driver is None:
-                raise Exception("Need to use selenium to load content, but no selenium driver was passed.")
+    def render(self):
+        """ Returns the html of the page after all 'more...' buttons are pressed in selenium. """
+        if self.selenium_driver is None:
+            raise Exception("Need to use selenium to load content, but no selenium driver was passed.")
 
-            self.selenium_driver.driver.get(self.url)
+        # The browser is shared between crawl workers, so hold it for the whole navigate/click sequence
+        with self.selenium_driver.acquire() as selenium_driver:
+            with METRICS.timer("stage_seconds", stage="selenium_get", page_type=self.page_type):
+                selenium_driver.driver.get(self.url)
 
-            self.press_more_buttons("//a[@class='more-writing']")
-            self.press_more_buttons("//a[@class='more-thumbs']")
+            with METRICS.timer("stage_seconds", stage="selenium_clicks", page_type=self.page_type):
+                self.press_more_buttons(selenium_driver, "//a[@class='more-writing']")
+                self.press_more_buttons(selenium_driver, "//a[@class='more-thumbs']")
 
-            # Update html and soup attribute with html containing content loaded using selenium
-            self.html = self.selenium_driver.driver.page_source.encode("utf-8")
-            # Decode html to prevent BeautifulSoup from incorrectly parsing html
-            self.soup = BeautifulSoup(self.html.decode("utf8"), "lxml")
+            # Html containing content loaded using selenium, page_source already is a str so it can be parsed
+            # without re-encoding
+            return selenium_driver.driver.page_source
 
-        supporter_div = self.soup.find("div", class_="deets populated")
-        if supporter_div is not None:
-            supporter_profiles = [a["href"] for a in supporter_div.find_all("a", class_="pic")]
-            return supporter_profiles
-        else:
-            return []
+    def get_supporters(self):
+        # The rendered page, if there is one, contains all supporters and everything else from the http page
+        extractor = self.extract("rendered" if "rendered" in self.documents else "http")
+        return [canonicalize(url) for url in extractor.supporters()]
 
-    def press_more_buttons(self, xpath_selector):
+    @staticmethod
+    def press_more_buttons(selenium_driver, xpath_selector):
         """ Keeps pressing the specified 'more...' button on the webpage until it doesn't show up anymore. """
+        from selenium.common.exceptions import NoSuchElementException, ElementNotInteractableException, TimeoutException
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.wait import WebDriverWait
+
         counter = 1
         while True:
             try:
                 # We dont know how many times we need to click the button, so we just keep trying until
                 # we cant find the button on the page anymore
-                a_tag = self.selenium_driver.driver.find_element(By.XPATH, xpath_selector)
+                a_tag = selenium_driver.driver.find_element(By.XPATH, xpath_selector)
 
                 a_tag.click()
                 
                 # Wait until element is clickable again, with max wait time of 5 seconds. If element could not clicked in
                 # 5 seconds WebDriverWait raises a TimeoutException, and the while loop will be broken.
-                WebDriverWait(self.selenium_driver.driver, 5).until(EC.element_to_be_clickable((By.XPATH, xpath_selector)))
+                WebDriverWait(selenium_driver.driver, 5).until(EC.element_to_be_clickable((By.XPATH, xpath_selector)))
 
                 # Print amount of times clicked, easy to see if program still running
                 print(f"{counter}/?", end='\r')
@@ -97,122 +189,155 @@ class AlbumPage(WebPage):
                 break
 
     def set_metadata(self):
-        """ Use beautifulsoup to scrape metadata from html. """
-        self.album_name = self.soup.find("h2", class_="trackTitle").text.strip()
+        """ Scrape metadata from html. """
+        extractor = self.extract("rendered" if "rendered" in self.documents else "http")
+        self.album_name = extractor.album_name()
 
         # Needed for getting artist id
-        self.artist_url = self.soup.find("div", id="name-section").find("a")["href"]
-        self.artist_name = self.soup.find("p", id="band-name-location").find("span", class_="title").text.strip()
+        self.artist_url = canonicalize(extractor.artist_url())
+        self.artist_name = extractor.artist_name()
 
         # Year is written in plaintext in a div, we use regex to extract the year from the text
-        year_div = self.soup.find("div", class_="tralbumData tralbum-credits").text
+        year_div = extractor.credits_text()
         try:
             self.year = re.search(r"release[sd][\s\w\d]+,\s([\d]{4})", year_div).group(1)
         except AttributeError:
             self.year = 9999  # Column is NOT NULL so if no year could be found we put 9999 as placeholder
 
-        # Use regex classname because sometimes we have to add hidden to find tag
-        tags_div = self.soup.find("div", class_=re.compile(r"tralbumData tralbum-tags tralbum-tags-nu( hidden)?"))
-        tags = sorted([a.text for a in tags_div.find_all("a", class_="tag")])
+        tags = sorted(extractor.tags())
         # Want a single column for tags, so we use a comma separated string
         self.tags = ', '.join(tags)
 
     def write_to_database(self, database):
         """ Write album data to database. If album artist does not appear in artist table we write the artist as well.
         This is done because we need an artist id to link the album to the artist. """
-        # Check if artist is already in artist table
-        artist_id = database.select(ARTIST_ID_QUERY.format(artist_url=self.artist_url))
-        # If artist not in table we add it here so we have an artist id we can link to the album
-        if not artist_id:
-            database.execute(INSERT_ARTIST_QUERY.format(
-                artist_name=self.artist_name.replace("'", "''"),
-                artist_url=self.artist_url
-            ))
-            # Retrieve artist id we've just written to database
-            artist_id = database.select(ARTIST_ID_QUERY.format(artist_url=self.artist_url))[0]["id"]
-        else:
-            # Retrieve artist id from json
-            artist_id = artist_id[0]["id"]
-
-        # Insert url into album table (if not in table already) to get an album id
-        database.execute(INSERT_ALBUM_QUERY.format(
-            album_url=self.url
-        ))
-
-        # Get id of row written above, we need this to fill metadata table
-        album_id = database.select(ALBUM_ID_QUERY.format(
-            album_url=self.url
-        ))[0]["id"]
-
-        # Use above retrieved album id to write metadata to table
-        database.execute(INSERT_ALBUM_METADATA_QUERY.format(
-            album_id=album_id,
-            album_name=self.album_name.replace("'", "''"),
-            artist_id=artist_id,
-            year=self.year,
-            tags=self.tags.replace("'", "''")
-        ))
+        # Get the artist id to link the album to, the artist is inserted if it is not in the artist table yet
+        artist_id = database.artist_id(self.artist_name, self.artist_url)
+
+        # Insert url into album table (if not in table already) to get an album id, we need this to fill
+        # metadata table
+        album_id = database.album_ids([self.url])[self.url]
+
+        # Use above retrieved album id to write metadata to table, and link the album to its tags
+        database.execute(INSERT_ALBUM_METADATA_QUERY, (album_id, artist_id, self.album_name, self.year, self.tags))
+        database.set_album_tags(album_id, self.tags)
 
         # Make sure inserts are saved
         database.commit()
 
 
 class ArtistPage(WebPage):
-    def __init__(self, url, selenium_driver=None):
-        super().__init__(url, selenium_driver)
+    def __init__(self, url, selenium_driver=None, http_client=None, parser=DEFAULT_PARSER, documents=None, parse=True):
+        self.albums = None
+        self.artist_name = None
+
+        super().__init__(url, selenium_driver, http_client, parser, documents, parse)
+
+    def parse(self):
         self.albums = self.get_albums()
         self.artist_name = self.get_artist_name()
 
     def get_albums(self):
         """ Returns list of AlbumPage objects, one for every project of an artist. Projects are
         referred to as albums but also include tracks. """
-        # Get album urls from li elements in ol tag
-        album_ol = self.soup.find("ol", id="music-grid")
-        li_elements = album_ol.find_all("li", class_="music-grid-item")
-        # Append page url to relative urls that are retrieved from href attribute
-        album_urls = [self.url + li.find("a")["href"] for li in li_elements]
+        # Get album urls from li elements in ol tag, append page url to relative urls that are retrieved from
+        # href attribute
+        album_urls = [canonicalize(self.url + href) for href in self.extract("http").album_hrefs()]
 
         return album_urls
 
     def get_artist_name(self):
         """ Retrieve artists name from specified tag. """
-        return self.soup.find("p", id="band-name-location").find("span", class_="title").text.strip()
+        return self.extract("http").artist_name()
 
     def write_to_database(self, database):
         """ Store self in database. """
-        database.execute(INSERT_ARTIST_QUERY.format(
-            artist_name=self.artist_name.replace("'", "''"),
-            artist_url=self.url
-        ))
+        database.artist_id(self.artist_name, self.url)
 
         # Make sure inserts are saved
         database.commit()
 
 
 class UserPage(WebPage):
-    def __init__(self, url, selenium_driver=None):
-        super().__init__(url, selenium_driver)
-        # Clean referral part in url
-        if self.url.endswith("?from=fanthanks"):
-            self.url = self.url.replace("?from=fanthanks", "")
+    """ A fan page and the fan's collection.
+
+    For a refresh, pass the canonical urls of the albums already in the database for this fan as known_albums.
+    Only the part of the collection that is newer than the first known album is loaded then, and only the albums
+    that are not known end up in self.collection, so writing the page inserts just the new purchases.
+    """
+    def __init__(self, url, selenium_driver=None, http_client=None, parser=DEFAULT_PARSER, documents=None, parse=True,
+                 collection_loader=None, known_albums=None):
+        self.collection_loader = collection_loader
+        self.known_albums = known_albums
+        self.collection = None
+        self.username = None
+
+        super().__init__(url, selenium_driver, http_client, parser, documents, parse)
+
+    def fetch(self):
+        super().fetch()
+        # The page shows the newest items, when one of them is known there can't be anything new further down
+        if self.known_albums is not None and self.shows_known_album():
+            return
+
+        # If the show whole collection button is found, the page only shows part of the collection. We load the rest
+        # from the collection api, only if that fails we use selenium to click it and scroll down the webpage to load
+        # the whole collection
+        if self.mentions("show-more") and self.extract("http").has_show_more():
+            try:
+                self.documents["collection"] = self.load_document("collection", self.load_collection)
+            except CollectionLoadError as e:
+                print(f"Loading collection of {self.url} over http failed, falling back to selenium: {e}")
+                self.documents["rendered"] = self.load_document("rendered", self.render_collection)
 
-        self.selenium_driver = selenium_driver
+    def parse(self):
         self.collection = self.get_collection()
+        if self.known_albums is not None:
+            self.collection = [url for url in dict.fromkeys(self.collection) if url not in self.known_albums]
         self.username = self.get_username()
 
+    def shows_known_album(self):
+        return any(canonicalize(url) in self.known_albums for url in self.extract("http").collection())
+
+    def load_collection(self):
+        """ Returns all item urls of the collection as json, loaded from the collection api. When refreshing only
+        the new items are loaded, the known albums are added after them so the page cache still gets the whole
+        collection. """
+        if self.collection_loader is None:
+            self.collection_loader = CollectionLoader(http_client=self.http_client)
+        with METRICS.timer("stage_seconds", stage="collection_api", page_type=self.page_type):
+            if self.known_albums is None:
+                return json.dumps(self.collection_loader.load_from_page(self.extract("http")))
+            new = self.collection_loader.load_from_page(self.extract("http"), stop_at=self.known_albums)
+            return json.dumps(new + sorted(self.known_albums.difference(canonicalize(url) for url in new)))
+
     def get_collection(self):
-        """ """
-        # Try to find show whole collection button. We look at the div first because there exists another
-        # button with the class "show-more" if user collection < 20 items+
-        show_collection_button = self.soup.find("div", class_="collection-items").find("button", class_="show-more")
-        # If the button is found, we use selenium to click it and scroll down the webpage to load the whole collection
-        if show_collection_button is not None:
+        """ Returns urls of all items in the user's collection. """
+        if "collection" in self.documents:
+            collection = json.loads(self.documents["collection"])
+        else:
+            # Find ol tag containg all albums and retrieve album urls from a tag hrefs
+            collection = self.extract("rendered" if "rendered" in self.documents else "http").collection()
+        return [canonicalize(url) for url in collection]
+
+    def render_collection(self):
+        """ Uses selenium to show the whole collection, returns the html of the rendered page. """
+        if self.selenium_driver is None:
+            raise Exception("Need to use selenium to load content, but no selenium driver was passed.")
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.common.keys import Keys
+        from selenium.webdriver.support.wait import WebDriverWait
+
+        # The browser is shared between crawl workers, so hold it until the rendered html is read
+        with self.selenium_driver.acquire() as selenium_driver:
             # TODO check why below line is very slow
-            self.selenium_driver.driver.get(self.url)
+            with METRICS.timer("stage_seconds", stage="selenium_get", page_type=self.page_type):
+                selenium_driver.driver.get(self.url)
+            clicks_started = time.perf_counter()
 
             # Click show more button, this doesn't show all content, it is loaded dynamically as we scroll down the page, so
             # we simulate this after pressing the button
-            button = self.selenium_driver.driver.find_element(By.XPATH, "//button[@class='show-more']")
+            button = selenium_driver.driver.find_element(By.XPATH, "//button[@class='show-more']")
             button.click()
 
             # XPATH matching the album li elements
@@ -220,70 +345,43 @@ class UserPage(WebPage):
 
             # Each scroll loads 20 new albums, use the total collection size to calculate how often we need to scroll
             # to the bottom of the page to load new content
-            collection_size = int(self.selenium_driver.driver.find_element(By.XPATH, "//span[@class='count']").text)
+            collection_size = int(selenium_driver.driver.find_element(By.XPATH, "//span[@class='count']").text)
             # We get a timeout exception for collections ~ > 100 (2000 albums), so we skip the user if the collection is too large
             # TODO fix above
             if collection_size < 2000:
                 for _ in tqdm(range(ceil((collection_size - 20) / 20)), desc=f"Loading collection for user {self.url}"):
                     # Count amount of albums loaded, we wait until this amount has changed before scrolling down to the bottom
-                    li_count = len(self.selenium_driver.driver.find_elements(By.XPATH, li_locator))
+                    li_count = len(selenium_driver.driver.find_elements(By.XPATH, li_locator))
                     # TODO handle timeouts
-                    WebDriverWait(self.selenium_driver.driver, 10).until(ElementCountChanged((By.XPATH, li_locator), li_count))
-                    self.selenium_driver.driver.find_element(By.XPATH, '//body').send_keys(Keys.CONTROL+Keys.END)
+                    WebDriverWait(selenium_driver.driver, 10).until(ElementCountChanged((By.XPATH, li_locator), li_count))
+                    selenium_driver.driver.find_element(By.XPATH, '//body').send_keys(Keys.CONTROL+Keys.END)
             else:
                 raise CollectionTooLargeException
 
             # Bigger is no problem, that just means duplicates (which can happen sometimes)
-            # assert(len(self.selenium_driver.driver.find_elements(By.XPATH, li_locator)) >= collection_size), f"Not all albums able to be loaded"
+            # assert(len(selenium_driver.driver.find_elements(By.XPATH, li_locator)) >= collection_size), f"Not all albums able to be loaded"
 
-            # Update html and soup attribute with html containing content loaded using selenium
-            self.html = self.selenium_driver.driver.page_source.encode("utf-8")
-            # Decode self.html to prevent beautifulsoup from incorrectly parsing pages
-            # containing emojis
-            self.soup = BeautifulSoup(self.html.decode("utf-8"), "lxml")
-
-        # Find ol tag containg all albums and retrieve album urls from a tag hrefs
-        album_ol = self.soup.find("ol", class_="collection-grid")
-        albums = [a["href"] for a in album_ol.find_all("a", class_="item-link", target="_blank")]
-
-        return albums
+            METRICS.observe("stage_seconds", time.perf_counter() - clicks_started, stage="selenium_clicks",
+                            page_type=self.page_type)
+            # Html containing content loaded using selenium, page_source already is a str so it can be parsed as is
+            return selenium_driver.driver.page_source
 
     def get_username(self):
-        return self.soup.find("div", class_="name").find("span").text.strip()
+        return self.extract("http").username()
 
     def write_to_database(self, database):
         """ Stores user data in database. Also makes entry for all supported albums in album table. This does not
         fill the album metadata table, we do this when writing album to table. This is done to prevent expensive operation
         of scraping the album page. """
-        # Write user data to database
-        database.execute(INSERT_USER_QUERY.format(
-            username=self.username.replace("'", "''"),
-            user_url=self.url
-        ))
-
-        # Retrieve user id used for linking album ids to user
-        user_id = database.select(USER_ID_QUERY.format(
-            user_url=self.url
-        ))[0]["id"]
-
-        # Make entries for all supported albums, we need these to get album ids we store in user_supports table
-        for album_url in self.collection:
-            # TODO could be done in batch query instead of one by one if this proves to be a bottleneck
-            # Fill album entry
-            database.execute(INSERT_ALBUM_QUERY.format(
-                album_url=album_url
-            ))
-
-            # Retrieve album id
-            album_id = database.select(ALBUM_ID_QUERY.format(
-                album_url=album_url
-            ))[0]["id"]
-
-            # Enter user/album id combination in user_supports table
-            database.execute(INSERT_USER_SUPPORTS_QUERY.format(
-                user_id=user_id,
-                album_id=album_id
-            ))
+        # Write user data to database and retrieve user id used for linking album ids to user
+        user_id = database.user_id(self.username, self.url)
+
+        # Make entries for all supported albums in one batch, we need these to get album ids we store in
+        # user_supports table
+        album_ids = database.album_ids(self.collection)
+
+        # Enter user/album id combinations in user_supports table
+        database.insert_user_supports(user_id, album_ids.values())
 
         # Make sure inserts are saved
         database.commit()